@@ -0,0 +1,295 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# times the main code paths of SVPV on a synthetic dataset and writes the results as json
+# results of different versions run on the same dataset parameters can be compared with -compare
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from timeit import default_timer
+import numpy as np
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from benchmark.synthetic import Dataset, defaults, parse_args
+from svpv.vcf import VCFManager
+from svpv.sam import SamStats, LibraryStats
+from svpv.plot import Plot
+from svpv.batch import RenderBatch
+from svpv.timing import Timer
+
+usage = 'Usage example:\n' \
+        'python -m benchmark.bench -o /bench/directory/ -depth 30 -samples 10 -compare old_results.json\n' \
+        '\nArgs:\n' \
+        '-o\t\tdirectory for datasets, plot output and results.\n' \
+        '-results\tjson file to write results to.\n' \
+        '\t\t\tdefault: svpv_bench.json in the output directory\n' \
+        '-repeats\tnumber of times each benchmark is timed.\n' \
+        '\t\t\tdefault: 3\n' \
+        '-queries\tnumber of random range queries for get_svs_in_range.\n' \
+        '\t\t\tdefault: 1000\n' \
+        '-plot_svs\tnumber of SVs for the get_sam_stats and Plot benchmarks.\n' \
+        '\t\t\tdefault: 10\n' \
+        '-render\t\talso render the plots with Rscript.\n' \
+        '-compare\tprevious results to compare with, exits with an error if any benchmark is slower\n' \
+        '\t\tby more than the tolerance.\n' \
+        '-tolerance\tallowed slowdown before a comparison fails, as a ratio.\n' \
+        '\t\t\tdefault: 1.2\n' \
+        '-startup_budget\tseconds allowed for starting SVPV and importing svpv, exits with an error if over.\n' \
+        '\t\t\tdefault: 0.5\n' \
+        '\nDataset args are as for benchmark.synthetic:\n' + \
+        ' '.join('-' + k for k in sorted(defaults)) + '\n'
+
+
+# load the SVPV script, which has no .py extension, to build parameters as the command line does
+def load_cli():
+    path = os.path.join(root, 'SVPV')
+    try:
+        from importlib.machinery import SourceFileLoader
+        import importlib.util
+        loader = SourceFileLoader('svpv_cli', path)
+        spec = importlib.util.spec_from_loader('svpv_cli', loader)
+        cli = importlib.util.module_from_spec(spec)
+        loader.exec_module(cli)
+        return cli
+    except ImportError:
+        import imp
+        return imp.load_source('svpv_cli', path)
+
+
+class Bench:
+    def __init__(self, data, out_dir, repeats=3, num_queries=1000, plot_svs=10, render=False):
+        self.data = data
+        self.out_dir = out_dir
+        self.repeats = repeats
+        self.num_queries = num_queries
+        self.plot_svs = plot_svs
+        self.render = render
+        self.cli = load_cli()
+        # dict by benchmark of seconds of each repeat, number of items and any stage breakdown
+        self.results = {}
+        self.rng = np.random.RandomState(0)
+
+    # time fn repeats times, items is the number of things done by each call for per item times
+    def time(self, name, fn, items=1):
+        seconds = []
+        for i in range(self.repeats):
+            start = default_timer()
+            fn()
+            seconds.append(default_timer() - start)
+        self.results[name] = {'seconds': seconds, 'min': min(seconds), 'median': float(np.median(seconds)),
+                              'items': items, 'per_item': min(seconds) / max(items, 1)}
+        print('{:<20}{:>12.4f}s{:>12.6f}s/item ({} items)'.format(name, min(seconds), min(seconds) / max(items, 1),
+                                                                  items))
+
+    def params(self, plot_dir):
+        args = ['SVPV', '-vcf', self.data.vcf, '-aln', ','.join(self.data.bams), '-samples',
+                ','.join(self.data.samples), '-o', plot_dir, '-fa', self.data.fa]
+        if self.render:
+            args.append('-batch')
+        return self.cli.Params(args)
+
+    # time taken to start python and SVPV, for a usage error, importing the package and a run plotting nothing
+    def startup(self):
+        cli = os.path.join(root, 'SVPV')
+        devnull = open(os.devnull, 'w')
+        cmds = [('startup_usage', [sys.executable, cli]),
+                ('startup_import', [sys.executable, '-c', 'import svpv']),
+                ('startup_run', [sys.executable, cli, '-vcf', self.data.vcf, '-aln', ','.join(self.data.bams),
+                                 '-samples', ','.join(self.data.samples), '-o', os.path.join(self.out_dir, 'startup'),
+                                 '-sv', 'none:0'])]
+        for name, cmd in cmds:
+            self.time(name, lambda: subprocess.call(cmd, cwd=root, stdout=devnull, stderr=devnull))
+        devnull.close()
+
+    def run(self):
+        data = self.data
+        self.startup()
+        self.time('vcf_load', lambda: VCFManager(data.vcf))
+        vcf = VCFManager(data.vcf)
+        par = self.params(os.path.join(self.out_dir, 'plots'))
+
+        svs = vcf.filter_svs(par.filter)
+        self.time('filter_svs', lambda: vcf.filter_svs(par.filter), items=len(svs))
+
+        # filter changes as made from the GUI, the widgets are not included
+        filters = []
+        for chrom, length in data.chrom_lens:
+            filters.append({'chrom': chrom})
+        for svtype in ('DEL', 'DUP', 'INV', 'BND'):
+            filters.append({'svtype': svtype})
+        filters.append({'AF_thresh': 0.5, 'AF_thresh_is_LT': True})
+        filters.append({'min_len': 1000, 'max_len': 10000})
+        filters.append({'sample_GTs': {data.samples[0]: ['0/1', '1/1']}})
+
+        def gui_filter():
+            for f in filters:
+                filter_par = self.cli.FilterParams(par)
+                for k in f:
+                    setattr(filter_par, k, f[k])
+                vcf.filter_svs(filter_par)
+        self.time('gui_filter', gui_filter, items=len(filters))
+
+        queries = []
+        for i in range(self.num_queries):
+            chrom, length = data.chrom_lens[self.rng.randint(len(data.chrom_lens))]
+            start = self.rng.randint(0, length - 1)
+            queries.append((chrom, start, min(length, start + self.rng.randint(100, 100000))))
+
+        def in_range():
+            for q in queries:
+                vcf.get_svs_in_range(*q, lrg_svs=True)
+        self.time('get_svs_in_range', in_range, items=len(queries))
+        self.time('join_ranges', lambda: vcf.join_ranges(queries, lrg_svs=True), items=len(queries))
+
+        plot_svs = svs[0:self.plot_svs]
+        bams = par.run.get_bams(data.samples)
+        # library baselines are sampled once per alignment and cached, so they are kept out of the timings
+        for bam in bams:
+            LibraryStats.get(bam)
+
+        def sam_stats():
+            for sv in plot_svs:
+                region_bins, bkpt_bins = Plot.get_bins(sv, par)
+                if region_bins and bkpt_bins:
+                    SamStats.get_sam_stats(bams, bkpt_bins, depth_bins=region_bins)
+                elif bkpt_bins:
+                    SamStats.get_sam_stats(bams, bkpt_bins)
+                else:
+                    SamStats.get_sam_stats(bams, [region_bins])
+        self.time('get_sam_stats', sam_stats, items=len(plot_svs))
+
+        # end to end, with the stage breakdown of the last repeat
+        def plots():
+            Timer.seconds = {}
+            Timer.calls = {}
+            Timer.counters = {}
+            if par.run.render_batch is not None:
+                par.run.render_batch.jobs = []
+                par.run.render_batch.svs = []
+            for sv in plot_svs:
+                plot = Plot(sv, data.samples, par)
+                if self.render:
+                    plot.plot_figure(group=par.plot.grouping)
+            if par.run.render_batch is not None:
+                par.run.render_batch.render()
+        if self.render:
+            par.run.render_batch = RenderBatch(par.run.out_dir, par.plot.get_R_args())
+        Timer.enabled = True
+        self.time('plot', plots, items=len(plot_svs))
+        Timer.enabled = False
+        self.results['plot']['stages'] = dict((s, Timer.seconds[s]) for s in Timer.seconds)
+        self.results['plot']['counters'] = dict(Timer.counters)
+        shutil.rmtree(par.run.out_dir, ignore_errors=True)
+
+    def write(self, path):
+        commit = None
+        try:
+            commit = subprocess.check_output(['git', '-C', root, 'rev-parse', 'HEAD'], universal_newlines=True,
+                                             stderr=subprocess.STDOUT).strip()
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        report = {'svpv_version': self.cli.version, 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                  'dataset': self.data.par, 'repeats': self.repeats, 'results': self.results}
+        out = open(path, 'wt')
+        json.dump(report, out, indent=1, sort_keys=True)
+        out.close()
+        print('\nresults written to {}\n'.format(path))
+
+
+# print the ratio of new to old times, returns the benchmarks slower than tolerance
+def compare(old_path, new_path, tolerance=1.2):
+    old = json.load(open(old_path))
+    new = json.load(open(new_path))
+    if old['dataset'] != new['dataset']:
+        print('Warning: results are from different datasets\n')
+    slower = []
+    print('{:<20}{:>12}{:>12}{:>8}'.format('benchmark', 'old', 'new', 'ratio'))
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a = old['results'][name]['min']
+        b = new['results'][name]['min']
+        ratio = b / a if a else float('inf')
+        print('{:<20}{:>12.4f}{:>12.4f}{:>8.2f}'.format(name, a, b, ratio))
+        if ratio > tolerance:
+            slower.append(name)
+    return slower
+
+
+def main(argv=sys.argv):
+    args = argv[1:]
+    out_dir = None
+    results = None
+    old = None
+    tolerance = 1.2
+    startup_budget = 0.5
+    opts = {'repeats': 3, 'num_queries': 1000, 'plot_svs': 10, 'render': False}
+    data_args = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-render':
+            opts['render'] = True
+            i += 1
+            continue
+        if i + 1 >= len(args):
+            print(usage)
+            print('Error: missing value for {}'.format(a))
+            exit(1)
+        if a == '-o':
+            out_dir = os.path.expanduser(args[i + 1])
+        elif a == '-results':
+            results = os.path.expanduser(args[i + 1])
+        elif a == '-compare':
+            old = os.path.expanduser(args[i + 1])
+        elif a == '-tolerance':
+            tolerance = float(args[i + 1])
+        elif a == '-startup_budget':
+            startup_budget = float(args[i + 1])
+        elif a == '-repeats':
+            opts['repeats'] = int(args[i + 1])
+        elif a == '-queries':
+            opts['num_queries'] = int(args[i + 1])
+        elif a == '-plot_svs':
+            opts['plot_svs'] = int(args[i + 1])
+        else:
+            data_args.extend(args[i:i + 2])
+        i += 2
+    if out_dir is None:
+        print(usage)
+        print('Error: output directory required')
+        exit(1)
+    par = parse_args(data_args)[0]
+    data = Dataset(par, out_dir).generate()
+    if results is None:
+        results = os.path.join(out_dir, 'svpv_bench.json')
+    work_dir = tempfile.mkdtemp(prefix='svpv_bench.', dir=out_dir)
+    bench = Bench(data, work_dir, **opts)
+    try:
+        bench.run()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    bench.write(results)
+    over = [b for b in ('startup_usage', 'startup_import') if bench.results[b]['min'] > startup_budget]
+    if over:
+        print('Error: over the startup budget of {}s: {}'.format(startup_budget, ', '.join(over)))
+        exit(1)
+    if old is not None:
+        slower = compare(old, results, tolerance)
+        if slower:
+            print('\nError: slower than {} by more than {}x: {}'.format(old, tolerance, ', '.join(slower)))
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# generates synthetic datasets for benchmarking SVPV: a reference, a vcf of simulated SVs and one alignment per sample
+# reads are simulated from the two haplotypes of each sample so depth, orientation, insert size and clipping reflect
+# the SVs each sample carries. only samtools is needed, datasets are reproducible from their parameters and seed
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import subprocess
+from hashlib import sha1
+import numpy as np
+
+
+defaults = {'chroms': 2, 'chrom_len': 1000000, 'depth': 20, 'read_len': 100, 'ins_mean': 400, 'ins_sd': 50,
+            'svs': 40, 'svtypes': 'DEL,DUP,INV', 'min_len': 500, 'max_len': 20000, 'samples': 3,
+            'bnd_density': 1.0, 'seed': 0}
+
+usage = 'Usage example:\n' \
+        'python -m benchmark.synthetic -o /data/directory/ -depth 30 -samples 10\n' \
+        '\nArgs:\n' \
+        '-o\t\tdirectory to write the dataset to, in a subdirectory named by the parameters.\n' \
+        '-chroms\t\tnumber of chromosomes.\n\t\t\tdefault: {chroms}\n' \
+        '-chrom_len\tlength of each chromosome (bp).\n\t\t\tdefault: {chrom_len}\n' \
+        '-depth\t\tmean read depth of each sample.\n\t\t\tdefault: {depth}\n' \
+        '-read_len\tread length (bp).\n\t\t\tdefault: {read_len}\n' \
+        '-ins_mean\tmean insert size (bp).\n\t\t\tdefault: {ins_mean}\n' \
+        '-ins_sd\t\tstandard deviation of insert size (bp).\n\t\t\tdefault: {ins_sd}\n' \
+        '-svs\t\tnumber of DEL/DUP/INV SVs.\n\t\t\tdefault: {svs}\n' \
+        '-svtypes\tcomma separated SV types to simulate, from DEL, DUP and INV.\n\t\t\tdefault: {svtypes}\n' \
+        '-min_len\tminimum SV length (bp).\n\t\t\tdefault: {min_len}\n' \
+        '-max_len\tmaximum SV length (bp).\n\t\t\tdefault: {max_len}\n' \
+        '-samples\tnumber of samples.\n\t\t\tdefault: {samples}\n' \
+        '-bnd_density\ttranslocations (pairs of BND records) per Mbp, needs 2 or more chromosomes.\n' \
+        '\t\t\tdefault: {bnd_density}\n' \
+        '-seed\t\trandom seed.\n\t\t\tdefault: {seed}\n'.format(**defaults)
+
+
+# a simulated SV, pos and end are 0 based half open reference coordinates
+# translocations join chrom:pos to chr2:pos2, swapping the chromosome ends after them
+class Event:
+    def __init__(self, id, svtype, chrom, pos, end, chr2=None, pos2=None, af=0.5):
+        self.id = id
+        self.svtype = svtype
+        self.chrom = chrom
+        self.pos = pos
+        self.end = end
+        self.chr2 = chr2
+        self.pos2 = pos2
+        self.af = af
+        # number of haplotypes of each sample carrying the event
+        self.gts = []
+
+    def gt(self, sample):
+        return ('0/0', '0/1', '1/1')[self.gts[sample]]
+
+
+# a haplotype is a dict of chromosomes, each a list of (chrom, start, end, strand) reference pieces
+class Haplotype:
+    def __init__(self, chrom_lens):
+        self.chroms = dict((c, [(c, 0, l, 1)]) for c, l in chrom_lens)
+        self.order = [c for c, l in chrom_lens]
+
+    # apply the intra-chromosomal events carried by this haplotype, events must not overlap
+    def apply(self, events):
+        for c in self.order:
+            pieces = []
+            cur = 0
+            for e in sorted([e for e in events if e.chrom == c], key=lambda x: x.pos):
+                pieces.append((c, cur, e.pos, 1))
+                if e.svtype == 'DEL':
+                    cur = e.end
+                elif e.svtype == 'DUP':
+                    # tandem copy, then the reference copy
+                    pieces.append((c, e.pos, e.end, 1))
+                    cur = e.pos
+                elif e.svtype == 'INV':
+                    pieces.append((c, e.pos, e.end, -1))
+                    cur = e.end
+            pieces.append((c, cur, self.chroms[c][-1][2], 1))
+            self.chroms[c] = [p for p in pieces if p[2] > p[1]]
+
+    # find the haplotype chromosome and piece containing reference position chrom:pos
+    def find(self, chrom, pos):
+        for h in self.chroms:
+            for i, p in enumerate(self.chroms[h]):
+                if p[0] == chrom and p[1] < pos < p[2]:
+                    return h, i
+        return None, None
+
+    # swap the ends of the chromosomes after the breakpoints, returns False if both are on one chromosome
+    def translocate(self, e):
+        h1, i1 = self.find(e.chrom, e.pos)
+        h2, i2 = self.find(e.chr2, e.pos2)
+        if h1 is None or h2 is None or h1 == h2:
+            return False
+        a, b = self.chroms[h1], self.chroms[h2]
+        c1, s1, t1, d1 = a[i1]
+        c2, s2, t2, d2 = b[i2]
+        self.chroms[h1] = a[:i1] + [(c1, s1, e.pos, d1), (c2, e.pos2, t2, d2)] + b[i2 + 1:]
+        self.chroms[h2] = b[:i2] + [(c2, s2, e.pos2, d2), (c1, e.pos, t1, d1)] + a[i1 + 1:]
+        return True
+
+
+class Dataset:
+    def __init__(self, par, out_dir):
+        self.par = dict(defaults)
+        self.par.update(par)
+        name = sha1(json.dumps(self.par, sort_keys=True).encode('utf-8')).hexdigest()[0:10]
+        self.dir = os.path.join(out_dir, 'synthetic_' + name)
+        self.chrom_lens = [('chr{}'.format(i + 1), self.par['chrom_len']) for i in range(self.par['chroms'])]
+        self.samples = ['SAMPLE{}'.format(i + 1) for i in range(self.par['samples'])]
+        self.fa = os.path.join(self.dir, 'reference.fa')
+        self.vcf = os.path.join(self.dir, 'svs.vcf')
+        self.bams = [os.path.join(self.dir, '{}.bam'.format(s)) for s in self.samples]
+        self.rng = np.random.RandomState(self.par['seed'])
+        self.events = []
+
+    # generate the dataset unless it was generated before
+    def generate(self):
+        done = os.path.join(self.dir, 'params.json')
+        if os.path.isfile(done):
+            return self
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        print('generating synthetic dataset in {}\n'.format(self.dir))
+        self.write_reference()
+        self.place_events()
+        self.write_vcf()
+        for i, s in enumerate(self.samples):
+            self.write_bam(i, s)
+        out = open(done, 'wt')
+        json.dump(self.par, out, indent=1, sort_keys=True)
+        out.close()
+        return self
+
+    def write_reference(self):
+        out = open(self.fa, 'wt')
+        for chrom, length in self.chrom_lens:
+            seq = np.array(list('ACGT'))[self.rng.randint(0, 4, length)]
+            out.write('>{}\n'.format(chrom))
+            for i in range(0, length, 60):
+                out.write(''.join(seq[i:i + 60]) + '\n')
+        out.close()
+        run(['samtools', 'faidx', self.fa])
+
+    # SVs at random non-overlapping positions, lengths log uniform between min_len and max_len
+    def place_events(self):
+        par = self.par
+        gap = 2 * (par['ins_mean'] + 4 * par['ins_sd'])
+        taken = dict((c, []) for c, l in self.chrom_lens)
+
+        def free(chrom, start, end):
+            for s, e in taken[chrom]:
+                if start < e + gap and s < end + gap:
+                    return False
+            return True
+
+        svtypes = [t for t in par['svtypes'].split(',') if t]
+        for t in svtypes:
+            if t not in ('DEL', 'DUP', 'INV'):
+                print('Error: can not simulate SV type {}'.format(t))
+                exit(1)
+        tries = 0
+        while len(self.events) < par['svs'] and svtypes and tries < 100 * par['svs']:
+            tries += 1
+            chrom, length = self.chrom_lens[self.rng.randint(len(self.chrom_lens))]
+            size = int(np.exp(self.rng.uniform(np.log(par['min_len']), np.log(par['max_len']))))
+            start = self.rng.randint(gap, length - size - gap)
+            if free(chrom, start, start + size):
+                taken[chrom].append((start, start + size))
+                self.events.append(Event(len(self.events) + 1, svtypes[self.rng.randint(len(svtypes))], chrom, start,
+                                         start + size, af=self.rng.uniform(0.05, 0.6)))
+        num_bnds = 0
+        if len(self.chrom_lens) > 1:
+            num_bnds = int(round(par['bnd_density'] * sum(l for c, l in self.chrom_lens) / 1e6))
+        tries = 0
+        while num_bnds and tries < 100 * num_bnds:
+            tries += 1
+            i, j = self.rng.choice(len(self.chrom_lens), 2, replace=False)
+            (c1, l1), (c2, l2) = self.chrom_lens[i], self.chrom_lens[j]
+            p1 = self.rng.randint(gap, l1 - gap)
+            p2 = self.rng.randint(gap, l2 - gap)
+            if free(c1, p1, p1 + 1) and free(c2, p2, p2 + 1):
+                taken[c1].append((p1, p1 + 1))
+                taken[c2].append((p2, p2 + 1))
+                self.events.append(Event(len(self.events) + 1, 'BND', c1, p1, p1 + 1, chr2=c2, pos2=p2,
+                                         af=self.rng.uniform(0.05, 0.6)))
+                num_bnds -= 1
+        self.events.sort(key=lambda x: (x.chrom, x.pos))
+
+    # the haplotypes of a sample, recording the genotype of each event
+    def haplotypes(self, sample):
+        haps = []
+        for h in range(2):
+            hap = Haplotype(self.chrom_lens)
+            carried = [e for e in self.events if self.rng.uniform() < e.af]
+            hap.apply([e for e in carried if e.svtype != 'BND'])
+            # translocations that would join a chromosome to itself are not carried
+            carried = [e for e in carried if e.svtype != 'BND' or hap.translocate(e)]
+            for e in self.events:
+                if len(e.gts) <= sample:
+                    e.gts.append(0)
+                if e in carried:
+                    e.gts[sample] += 1
+            haps.append(hap)
+        return haps
+
+    def write_vcf(self):
+        # genotypes are drawn with the haplotypes, which are kept to simulate the reads from
+        self.haps = [self.haplotypes(i) for i in range(len(self.samples))]
+        out = open(self.vcf, 'wt')
+        out.write('##fileformat=VCFv4.2\n')
+        for c, l in self.chrom_lens:
+            out.write('##contig=<ID={},length={}>\n'.format(c, l))
+        for tag, num, type, desc in (('END', '1', 'Integer', 'End position of the variant'),
+                                     ('SVTYPE', '1', 'String', 'Type of structural variant'),
+                                     ('SVLEN', '.', 'Integer', 'Length of structural variant'),
+                                     ('MATEID', '.', 'String', 'ID of mate breakend'),
+                                     ('EVENTID', '1', 'String', 'ID of event associated to breakend'),
+                                     ('PAIRID', '1', 'String', 'ID of partner breakend'),
+                                     ('INSLEN', '1', 'Integer', 'Length of inserted sequence'),
+                                     ('CHR2', '1', 'String', 'Chromosome of the other breakpoint')):
+            out.write('##INFO=<ID={},Number={},Type={},Description="{}">\n'.format(tag, num, type, desc))
+        for alt in ('DEL', 'DUP', 'INV'):
+            out.write('##ALT=<ID={},Description="{}">\n'.format(alt, alt))
+        out.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        out.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] +
+                            self.samples) + '\n')
+        records = []
+        for e in self.events:
+            gts = [e.gt(i) for i in range(len(self.samples))]
+            if e.svtype == 'BND':
+                id1, id2 = 'bnd{}_1'.format(e.id), 'bnd{}_2'.format(e.id)
+                records.append((e.chrom, e.pos, id1, 'N[{}:{}['.format(e.chr2, e.pos2 + 1),
+                                'SVTYPE=BND;MATEID={};EVENTID=bnd{}'.format(id2, e.id), gts))
+                records.append((e.chr2, e.pos2, id2, 'N[{}:{}['.format(e.chrom, e.pos + 1),
+                                'SVTYPE=BND;MATEID={};EVENTID=bnd{}'.format(id1, e.id), gts))
+            else:
+                svlen = e.end - e.pos
+                if e.svtype == 'DEL':
+                    svlen = -svlen
+                records.append((e.chrom, e.pos, '{}{}'.format(e.svtype.lower(), e.id), '<{}>'.format(e.svtype),
+                                'SVTYPE={};END={};SVLEN={}'.format(e.svtype, e.end, svlen), gts))
+        for chrom, pos, id, alt, info, gts in sorted(records, key=lambda x: (x[0], x[1])):
+            out.write('\t'.join([chrom, str(pos), id, 'N', alt, '.', 'PASS', info, 'GT'] + gts) + '\n')
+        out.close()
+
+    # simulate read pairs from both haplotypes of a sample, piped to samtools sort
+    def write_bam(self, sample, name):
+        par = self.par
+        p = subprocess.Popen(['samtools', 'sort', '-o', self.bams[sample], '-'], stdin=subprocess.PIPE,
+                             universal_newlines=True)
+        p.stdin.write('@HD\tVN:1.6\tSO:unsorted\n')
+        for c, l in self.chrom_lens:
+            p.stdin.write('@SQ\tSN:{}\tLN:{}\n'.format(c, l))
+        p.stdin.write('@RG\tID:{}\tSM:{}\n'.format(name, name))
+        seq = 'N' * par['read_len']
+        n = 0
+        for h, hap in enumerate(self.haps[sample]):
+            for chrom in hap.order:
+                pieces = hap.chroms[chrom]
+                for line in self.simulate(pieces, '{}.{}.{}'.format(name, h, chrom), seq):
+                    p.stdin.write(line)
+                    n += 1
+        p.stdin.close()
+        if p.wait():
+            print('Error: samtools sort failed for {}'.format(self.bams[sample]))
+            exit(1)
+        run(['samtools', 'index', self.bams[sample]])
+        print('{}: {} reads\n'.format(self.bams[sample], n))
+
+    # sam lines of read pairs from one haplotype chromosome, at half the sample depth
+    def simulate(self, pieces, prefix, seq):
+        par = self.par
+        rl = par['read_len']
+        lens = np.array([p[2] - p[1] for p in pieces])
+        offsets = np.concatenate(([0], np.cumsum(lens)))
+        hap_len = offsets[-1]
+        num = int(par['depth'] * hap_len / (4 * rl))
+        if not num:
+            return
+        ins = np.clip(self.rng.normal(par['ins_mean'], par['ins_sd'], num).astype(int), rl, None)
+        starts = self.rng.randint(0, max(1, hap_len - ins.max()), num)
+        left = self.map_reads(pieces, offsets, starts, rl, 1)
+        right = self.map_reads(pieces, offsets, starts + ins - rl, rl, -1)
+        first_left = self.rng.uniform(size=num) < 0.5
+        mapq = np.where(self.rng.uniform(size=num) < 0.02, 0, 60)
+        for i in range(num):
+            a = tuple(x[i] for x in left)
+            b = tuple(x[i] for x in right)
+            # (chrom, pos, reverse, cigar, ref end)
+            same = a[0] == b[0]
+            tlen = 0
+            proper = 0
+            if same:
+                tlen = max(a[4], b[4]) - min(a[1], b[1])
+                if not a[2] and b[2] and a[1] <= b[1] and tlen < par['ins_mean'] + 4 * par['ins_sd']:
+                    proper = 2
+            for r, m, first in ((a, b, first_left[i]), (b, a, not first_left[i])):
+                flag = 1 + proper + 16 * r[2] + 32 * m[2] + (64 if first else 128)
+                t = 0
+                if same:
+                    t = tlen if (r[1], not first) <= (m[1], first) else -tlen
+                yield '{}.{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t*\n'.format(
+                    prefix, i, flag, r[0], r[1] + 1, mapq[i], r[3], '=' if same else m[0], m[1] + 1, t, seq)
+
+    # reference alignment of reads at haplotype positions starts, strand is the orientation on the haplotype
+    # reads crossing the end of a piece are aligned to the piece holding most of the read and soft clipped
+    # returns lists of chrom, pos (0 based), reverse, cigar and end
+    @staticmethod
+    def map_reads(pieces, offsets, starts, rl, strand):
+        k = np.searchsorted(offsets, starts, side='right') - 1
+        o = starts - offsets[k]
+        lens = offsets[k + 1] - offsets[k]
+        m = np.minimum(rl, lens - o)
+        # most of the read is in the next piece
+        nxt = (m < rl - m) & (k + 1 < len(pieces))
+        k = np.where(nxt, k + 1, k)
+        aligned = np.where(nxt, rl - m, m)
+        o = np.where(nxt, 0, o)
+        chroms, pos, rvs, cigars, ends = [], [], [], [], []
+        for i in range(len(starts)):
+            c, s, e, d = pieces[k[i]]
+            n = int(min(aligned[i], e - s))
+            clip = rl - n
+            # the clipped part is on the right of the read on the haplotype unless it was aligned to the next piece
+            clip_right = not nxt[i]
+            if d == 1:
+                p = s + o[i]
+            else:
+                p = e - o[i] - n
+                clip_right = not clip_right
+            if clip == 0:
+                cigars.append('{}M'.format(n))
+            elif clip_right:
+                cigars.append('{}M{}S'.format(n, clip))
+            else:
+                cigars.append('{}S{}M'.format(clip, n))
+            chroms.append(c)
+            pos.append(int(p))
+            rvs.append(int((strand * d) < 0))
+            ends.append(int(p) + n)
+        return chroms, pos, rvs, cigars, ends
+
+
+def run(cmd):
+    try:
+        subprocess.check_call(cmd)
+    except (OSError, subprocess.CalledProcessError):
+        print('Error: command failed: {}'.format(' '.join(cmd)))
+        exit(1)
+
+
+# parse -name value args into dataset parameters, typed as their defaults
+def parse_args(args):
+    par = {}
+    out_dir = None
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == '-o':
+            out_dir = os.path.expanduser(args[i + 1])
+        elif a[0] == '-' and a[1:] in defaults:
+            try:
+                par[a[1:]] = type(defaults[a[1:]])(args[i + 1])
+            except (ValueError, IndexError):
+                print('Error: invalid value for {}'.format(a))
+                exit(1)
+        else:
+            print(usage)
+            print('Error: unrecognised argument: {}'.format(a))
+            exit(1)
+        i += 2
+    return par, out_dir
+
+
+def main(argv=sys.argv):
+    par, out_dir = parse_args(argv[1:])
+    if out_dir is None:
+        print(usage)
+        print('Error: output directory required')
+        exit(1)
+    data = Dataset(par, out_dir).generate()
+    print('dataset: {}\n'.format(data.dir))
+
+
+if __name__ == '__main__':
+    main()
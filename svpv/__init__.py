@@ -0,0 +1,2 @@
+from .errors import SVPVError, UsageError
+from .session import Session
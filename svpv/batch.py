@@ -0,0 +1,374 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+from __future__ import print_function
+import os
+import subprocess
+import tempfile
+import shutil
+from hashlib import sha1
+from .plot import Plot, AnnotationJoin
+from .sam import AlignStats, SamStats
+from .timing import Timer
+from .errors import SVPVError
+
+
+# collects plot jobs for a batch run so that they can be rendered by a small number of Rscript processes
+class RenderBatch:
+    manifest_cols = ['samples', 'folder', 'outfile', 'title']
+    index_cols = ['svtype', 'chrom', 'pos', 'end', 'samples', 'file', 'page']
+    shard_keys = ('chrom', 'svtype')
+
+    def __init__(self, out_dir, r_args, shard=None, tag='', run=None, unit=None):
+        self.out_dir = out_dir
+        # plot args are shared by all jobs in a run
+        self.r_args = r_args
+        # None for one pdf per plot, otherwise 'chrom' or 'svtype' for multi-page pdfs
+        self.shard = shard
+        # added to the names of the files shared by the run, keeps the output of different nodes apart
+        self.tag = tag
+        # multi-page pdfs of a resumed run must not overwrite those of the previous runs, nor those of the other
+        # work queue units plotted by the same worker (each unit has its own journal so its own run numbers)
+        self.pdf_tag = tag
+        if unit is not None:
+            self.pdf_tag += '.unit{}'.format(unit)
+        if run is not None:
+            self.pdf_tag += '.run{}'.format(run)
+        # list of (samples, folder, outfile, title) tuples
+        self.jobs = []
+        # list of (svtype, chrom, pos, end) tuples, one per job
+        self.svs = []
+
+    def add(self, sv, samples, folder, outfile, title):
+        if self.shard:
+            outfile = os.path.join(self.out_dir, 'svpv.{}{}.pdf'.format(getattr(sv, self.shard), self.pdf_tag))
+        self.jobs.append((','.join(samples), folder, outfile, title))
+        self.svs.append((sv.svtype, sv.chrom, str(sv.pos), str(sv.end)))
+
+    def write_manifest(self, path, idxs):
+        manifest = open(path, 'wt')
+        manifest.write('\t'.join(RenderBatch.manifest_cols) + '\n')
+        for i in idxs:
+            manifest.write('\t'.join(self.jobs[i]) + '\n')
+        manifest.close()
+
+    # SV -> (file, page) lookup for multi-page output
+    # appended to by resumed runs, later entries for an SV supersede earlier ones
+    def write_index(self, path, groups):
+        new = not os.path.isfile(path)
+        index = open(path, 'at')
+        if new:
+            index.write('\t'.join(RenderBatch.index_cols) + '\n')
+        for idxs in groups:
+            page = {}
+            for i in idxs:
+                page[self.jobs[i][2]] = page.get(self.jobs[i][2], 0) + 1
+                index.write('\t'.join(self.svs[i] + (self.jobs[i][0], os.path.basename(self.jobs[i][2]),
+                                                     str(page[self.jobs[i][2]]))) + '\n')
+        index.close()
+
+    # assign jobs to procs, all pages of a multi-page pdf must be drawn by the same process
+    def split(self, procs):
+        if not self.shard:
+            return [list(range(len(self.jobs)))[i::procs] for i in range(procs)]
+        shards = {}
+        for i, job in enumerate(self.jobs):
+            if job[2] in shards:
+                shards[job[2]].append(i)
+            else:
+                shards[job[2]] = [i]
+        # largest shards first, each to the least loaded process
+        splits = [[] for i in range(min(procs, len(shards)))]
+        for outfile in sorted(shards, key=lambda x: (-len(shards[x]), x)):
+            min(splits, key=len).extend(shards[outfile])
+        return splits
+
+    # render the jobs, each split is rendered by a single R process
+    # returns the set of indices of jobs that failed
+    def render(self, procs=1):
+        failed = set()
+        if not self.jobs:
+            return failed
+        procs = max(1, min(procs, len(self.jobs)))
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        splits = self.split(procs)
+        if self.shard:
+            self.write_index(os.path.join(self.out_dir, 'svpv_index{}.tsv'.format(self.tag)), splits)
+        running = []
+        for i, idxs in enumerate(splits):
+            path = os.path.join(self.out_dir, 'svpv_batch{}.{}.tsv'.format(self.tag, i))
+            self.write_manifest(path, idxs)
+            cmd = ['Rscript', Plot.svpv_r, '-batch', path]
+            cmd.extend(self.r_args)
+            print(' '.join(cmd) + '\n')
+            Timer.count('subprocesses')
+            try:
+                running.append((subprocess.Popen(cmd), path, idxs))
+            except OSError:
+                raise SVPVError('Rscript failed. Are you sure it is installed?')
+        for p, path, idxs in running:
+            with Timer.stage('rscript'):
+                p.wait()
+            if p.returncode:
+                print('Error code {} from Rscript for batch manifest {}\n'.format(p.returncode, path))
+            # R lists the (1 based) manifest rows it could not render, if it did not get that far all failed
+            if os.path.isfile(path + '.failed'):
+                for line in open(path + '.failed'):
+                    if line.strip():
+                        failed.add(idxs[int(line) - 1])
+                os.remove(path + '.failed')
+            else:
+                failed.update(idxs)
+            os.remove(path)
+        print('rendered {} of {} plots\n'.format(len(self.jobs) - len(failed), len(self.jobs)))
+        self.jobs = []
+        self.svs = []
+        return failed
+
+
+# durable record of the SVs completed by batch runs in an output directory
+# an SV is skipped by later runs while the hash of its inputs and parameters is unchanged
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+        # dict by SV key of (inputs hash, status)
+        self.status = {}
+        # number of runs recorded
+        self.runs = 0
+        self.file = None
+        if os.path.isfile(path):
+            for line in open(path):
+                if line.startswith('#run'):
+                    self.runs += 1
+                    continue
+                try:
+                    key, inputs, status = line.rstrip('\n').split('\t')
+                except ValueError:
+                    # partially written last line of a run that was killed
+                    continue
+                self.status[key] = (inputs, status)
+
+    # open the journal for a new run, returns the run number
+    def start(self):
+        self.runs += 1
+        self.file = open(self.path, 'at')
+        self.file.write('#run\t{}\n'.format(self.runs))
+        self.sync()
+        return self.runs
+
+    def record(self, key, inputs, status):
+        self.status[key] = (inputs, status)
+        self.file.write('\t'.join((key, inputs, status)) + '\n')
+        self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def is_done(self, key, inputs):
+        return self.status.get(key) == (inputs, 'done')
+
+    @staticmethod
+    def sv_key(sv):
+        return '{}:{}:{}:{}'.format(sv.svtype, sv.chrom, sv.pos, sv.end)
+
+    # deterministic assignment of SVs to one of n shards, independent of the order and number of SVs
+    @staticmethod
+    def in_shard(key, i, n):
+        return int(sha1(key.encode('utf-8')).hexdigest(), 16) % n == i
+
+    # hash of everything that is shared by all SVs of a run and changes the output
+    @staticmethod
+    def run_inputs(par):
+        parts = [par.ver, ','.join(par.run.samples)]
+        files = par.run.bams + [vcf.vcf_file for vcf in [par.run.vcf, par.run.ref_vcf] + par.run.alt_vcfs if vcf]
+        if par.run.ref_genes is not None:
+            files.append(par.run.ref_genes.path)
+        # the panel of normals band is drawn behind every depth track
+        if par.run.pon is not None:
+            files.append(par.run.pon.data_path(par.run.pon.path))
+        for f in files:
+            if f and os.path.isfile(f):
+                st = os.stat(f)
+                parts.append('{}:{}:{}'.format(f, st.st_size, int(st.st_mtime)))
+        parts.extend(par.plot.get_R_args())
+        parts.extend(str(x) for x in (par.run.get_rd_len(), par.run.expansion, par.run.bkpt_win, par.run.num_bins,
+                                      par.run.fa, par.plot.grouping, par.plot.l_svs, par.run.pdf_shard,
+                                      par.plot.thumbs, par.plot.contact_sheet,
+                                      AlignStats.ins_edges, AlignStats.ins_bins, AlignStats.ins_sketch,
+                                      SamStats.subsample, SamStats.max_reads_per_bin))
+        return sha1('\t'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def sv_inputs(key, run_inputs):
+        return sha1((run_inputs + key).encode('utf-8')).hexdigest()[0:16]
+
+
+# plot a list of SVs, skipping those a previous run into the same output directory journaled as completed
+# tag is added to the names of the files written by the run, returns the numbers of SVs plotted and failed
+# unit is the id of the work queue unit of the SVs, the journal is then that of the unit rather than of the tag
+# progress is called after each SV is plotted and after the batch is rendered
+def run_batch(par, svs, tag=None, unit=None, progress=None):
+    if not os.path.exists(par.run.out_dir):
+        os.makedirs(par.run.out_dir)
+    if tag is None:
+        tag = ''
+        if par.run.shard:
+            tag = '.s{}of{}'.format(*par.run.shard)
+    if unit is not None:
+        path = os.path.join(par.run.out_dir, 'svpv_journal.unit{}.tsv'.format(unit))
+    else:
+        path = os.path.join(par.run.out_dir, 'svpv_journal{}.tsv'.format(tag))
+    # completed SVs are only recorded and skipped when resuming is asked for (-resume, -batch, -shard or a work
+    # queue worker) or the output directory already has a journal
+    journal = None
+    run = None
+    if par.run.resume or par.run.batch or par.run.shard or par.run.worker or os.path.isfile(path):
+        journal = RunJournal(path)
+        run = journal.start()
+    if par.run.batch:
+        par.run.render_batch = RenderBatch(par.run.out_dir, par.plot.get_R_args(), shard=par.run.pdf_shard, tag=tag,
+                                           run=run, unit=unit)
+        if par.run.pdf_shard:
+            par.run.data_dir = tempfile.mkdtemp(prefix='svpv_data.', dir=par.run.out_dir)
+    if par.plot.contact_sheet:
+        par.run.contact_sheet = ContactSheet(par.run.out_dir, tag=tag)
+
+    run_inputs = RunJournal.run_inputs(par)
+    # (key, inputs, first job, last job) of SVs waiting for the batch to be rendered
+    pending = []
+    skipped = 0
+    done = 0
+    failed = 0
+    todo = []
+    for sv in svs:
+        key = RunJournal.sv_key(sv)
+        if par.run.shard and not RunJournal.in_shard(key, *par.run.shard):
+            continue
+        inputs = RunJournal.sv_inputs(key, run_inputs)
+        if journal is not None and not par.run.force and journal.is_done(key, inputs):
+            skipped += 1
+            continue
+        todo.append((sv, key, inputs))
+    # annotation calls for all the SVs to plot, looked up by Plot.print_data
+    with Timer.stage('annotation_join'):
+        par.run.annotations = AnnotationJoin(par, [sv for sv, key, inputs in todo])
+
+    for sv, key, inputs in todo:
+        if par.run.render_batch:
+            first = len(par.run.render_batch.jobs)
+        prof = None
+        if par.run.profile_sv == (sv.chrom, sv.pos):
+            prof = os.path.join(par.run.out_dir, 'svpv_profile.{}_{}.prof'.format(sv.chrom, sv.pos))
+        Timer.start_sv(key, prof=prof)
+        try:
+            plot = Plot(sv, par.run.samples, par)
+            plot.plot_figure(group=par.plot.grouping)
+        except Exception as e:
+            print('Error: failed to plot {}: {}\n'.format(key, e))
+            if journal is not None:
+                journal.record(key, inputs, 'failed')
+            failed += 1
+            continue
+        finally:
+            Timer.end_sv()
+            if progress is not None:
+                progress()
+        if par.run.render_batch:
+            pending.append((key, inputs, first, len(par.run.render_batch.jobs)))
+        else:
+            if journal is not None:
+                journal.record(key, inputs, 'done')
+            done += 1
+    par.run.annotations = None
+    if skipped:
+        print('Notice: skipped {} SVs completed by a previous run according to {}, use -force to redo them\n'.format(
+            skipped, path))
+
+    if par.run.render_batch:
+        failed_jobs = par.run.render_batch.render(procs=par.run.procs)
+        if progress is not None:
+            progress()
+        for key, inputs, first, last in pending:
+            status = 'failed' if any(i in failed_jobs for i in range(first, last)) else 'done'
+            if journal is not None:
+                journal.record(key, inputs, status)
+            if status == 'failed':
+                failed += 1
+            else:
+                done += 1
+    if par.run.contact_sheet:
+        par.run.contact_sheet.write()
+    if par.run.data_dir and not par.run.keep_data:
+        shutil.rmtree(par.run.data_dir)
+        par.run.data_dir = None
+    if journal is not None:
+        journal.close()
+    Timer.write_report(par.run.out_dir, tag=tag)
+    return done, failed
+
+
+# html index of the thumbnails of a run, used to pick calls for full pdfs
+class ContactSheet:
+    header = ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>SVPV thumbnails</title>\n'
+              '<style>\nbody {{font-family: sans-serif;}}\n'
+              '.thumb {{display: inline-block; margin: 4px; padding: 4px; border: 1px solid #ccc; '
+              'vertical-align: top; font-size: 12px;}}\n'
+              '.thumb img {{display: block; width: {}px;}}\n</style>\n</head>\n<body>\n'
+              '<p>Select calls and re-run SVPV without -thumbs using the argument below to create full pdfs.</p>\n'
+              '<input id="sel" type="text" size="120" readonly value="">\n')
+    footer = ('<script>\nfunction update() {\n'
+              '  var ids = [];\n'
+              '  var boxes = document.getElementsByName("sv");\n'
+              '  for (var i = 0; i < boxes.length; i++) {\n'
+              '    if (boxes[i].checked && ids.indexOf(boxes[i].value) < 0) { ids.push(boxes[i].value); }\n'
+              '  }\n'
+              '  document.getElementById("sel").value = ids.length ? "-sv " + ids.join(",") : "";\n'
+              '}\n</script>\n</body>\n</html>\n')
+
+    def __init__(self, out_dir, width=400, tag=''):
+        self.out_dir = out_dir
+        self.width = width
+        self.tag = tag
+        # list of (svtype, chrom, pos, end, samples, thumbnail path) tuples
+        self.entries = []
+
+    def add(self, sv, samples, path):
+        self.entries.append((sv.svtype, sv.chrom, str(sv.pos), str(sv.end), ','.join(samples), path))
+
+    # thumbnails from previous runs into the same output directory are kept in the sheet
+    def write(self):
+        if not self.entries:
+            return None
+        table = os.path.join(self.out_dir, 'thumbnails{}.tsv'.format(self.tag))
+        entries = []
+        if os.path.isfile(table):
+            for line in open(table):
+                entries.append(tuple(line.rstrip('\n').split('\t')))
+        paths = set(e[5] for e in self.entries)
+        entries = [e for e in entries if len(e) == 6 and e[5] not in paths] + self.entries
+        out = open(table, 'wt')
+        for e in entries:
+            out.write('\t'.join(e) + '\n')
+        out.close()
+
+        path = os.path.join(self.out_dir, 'thumbnails{}.html'.format(self.tag))
+        html = open(path, 'wt')
+        html.write(ContactSheet.header.format(self.width))
+        for svtype, chrom, pos, end, samples, thumb in entries:
+            sv_id = '{}:{}'.format(chrom, pos)
+            src = os.path.relpath(thumb, self.out_dir)
+            html.write('<div class="thumb"><label><input type="checkbox" name="sv" value="{}" onchange="update()">'
+                       '{} {}:{}-{}</label><br>{}<a href="{}"><img src="{}" alt="{}"></a></div>\n'
+                       .format(sv_id, svtype, chrom, pos, end, samples.replace(',', ', '), src, src, sv_id))
+        html.write(ContactSheet.footer)
+        html.close()
+        print('created {}\n'.format(path))
+        return path
@@ -0,0 +1,15 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+
+
+# errors SVPV can not continue from, raised rather than exiting so that SVPV can be used as a library
+# the command line prints the message and exits
+class SVPVError(Exception):
+    pass
+
+
+# missing or inconsistent run arguments, the command line also prints its usage
+class UsageError(SVPVError):
+    pass
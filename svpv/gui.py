@@ -11,6 +11,7 @@ except ImportError:
     from tkinter import filedialog as tkFileDialog
 from . import gui_widgets as gw
 from .plot import Plot
+from .tiles import TileCache
 
 
 class SVPVGui(tk.Tk):
@@ -34,6 +35,8 @@ class SVPVGui(tk.Tk):
         self.set_sample_selector()
         self.genotype_selector = None
         self.set_genotype_selector()
+        # stats of the tiles of custom regions, kept while browsing
+        self.tiles = TileCache()
         self.plot_custom = None
         self.set_plot_custom()
         self.filters = None
@@ -217,7 +220,8 @@ class SVPVGui(tk.Tk):
         self.svs = self.par.run.vcf.filter_svs(self.par.filter)
         self.set_sv_chooser()
 
-    def plot_sv(self, sv=None):
+    # custom regions are plotted from the tile cache when tiles is given
+    def plot_sv(self, sv=None, tiles=None):
         self.set_info_box()
         if not self.current_samples:
             self.info_box.message.config(text="Error: No Samples Selected")
@@ -226,7 +230,7 @@ class SVPVGui(tk.Tk):
         else:
             if not sv:
                 sv = self.svs[self.sv_chooser.sv_fl.sel_idxs[0]]
-            plot = Plot(sv, self.current_samples, self.par)
+            plot = Plot(sv, self.current_samples, self.par, tiles=tiles)
             if self.display_var.get():
                 self.filename = plot.plot_figure(group=self.par.plot.grouping, display=self.par.run.display)
             else:
@@ -164,6 +164,7 @@ class GenotypeSelector(tk.LabelFrame):
                 gts.append(self.gts[i])
         return gts
 
+# custom regions are plotted from the tile cache of the parent, so panning and zooming only reads new tiles
 class PlotCustom(tk.LabelFrame):
     def __init__(self, parent):
         tk.LabelFrame.__init__(self, parent, text="Plot Custom Range")
@@ -172,18 +173,71 @@ class PlotCustom(tk.LabelFrame):
         self.rangeVar = tk.StringVar(value='chrX:YYYYYY-ZZZZZZ')
         self.entry = tk.Entry(self, textvariable=self.rangeVar, width=25)
         self.setter = tk.Button(self, text="Plot Custom", command=self.do_plot)
+        self.from_sv = tk.Button(self, text="From SV", command=self.set_from_sv)
+        self.left = tk.Button(self, text="<", command=lambda: self.pan(-1))
+        self.right = tk.Button(self, text=">", command=lambda: self.pan(1))
+        self.zoom_in = tk.Button(self, text="+", command=lambda: self.zoom(0.5))
+        self.zoom_out = tk.Button(self, text="-", command=lambda: self.zoom(2))
         self.lab.grid(row=0, column=0, sticky=tk.NSEW)
         self.entry.grid(row=0, column=1, sticky=tk.NSEW)
         self.setter.grid(row=0, column=2, sticky=tk.NSEW)
+        self.from_sv.grid(row=0, column=3, sticky=tk.NSEW)
+        self.left.grid(row=0, column=4, sticky=tk.NSEW)
+        self.right.grid(row=0, column=5, sticky=tk.NSEW)
+        self.zoom_in.grid(row=0, column=6, sticky=tk.NSEW)
+        self.zoom_out.grid(row=0, column=7, sticky=tk.NSEW)
 
-    def do_plot(self):
+    def get_range(self):
         try:
             chrom, pos, end = re.split('[:-]', self.rangeVar.get())[0:3]
-            custom = SV(chrom, pos, end, 'CUSTOM', '.', '.', '.')
+            pos, end = int(pos), int(end)
         except ValueError:
             print("invalid region")
             return None
-        self.parent.plot_sv(sv=custom)
+        if end < pos:
+            print("invalid region")
+            return None
+        return chrom, pos, end
+
+    def set_range(self, chrom, pos, end):
+        self.rangeVar.set('{}:{}-{}'.format(chrom, max(1, pos), max(1, end)))
+
+    # the range of the selected SV, to browse around it
+    def set_from_sv(self):
+        if not self.parent.sv_chooser.sv_fl.sel_idxs:
+            self.parent.info_box.message.config(text="Error: No SV Selected")
+            return None
+        sv = self.parent.svs[self.parent.sv_chooser.sv_fl.sel_idxs[0]]
+        self.set_range(sv.chrom, sv.pos, sv.end)
+        self.do_plot()
+
+    # move by half the width of the range
+    def pan(self, direction):
+        r = self.get_range()
+        if r is None:
+            return None
+        chrom, pos, end = r
+        shift = direction * max(1, (end - pos + 1) // 2)
+        self.set_range(chrom, pos + shift, end + shift)
+        self.do_plot()
+
+    # scale the width of the range about its centre
+    def zoom(self, factor):
+        r = self.get_range()
+        if r is None:
+            return None
+        chrom, pos, end = r
+        mid = (pos + end) // 2
+        half = max(1, int((end - pos + 1) * factor) // 2)
+        self.set_range(chrom, mid - half, mid + half)
+        self.do_plot()
+
+    def do_plot(self):
+        r = self.get_range()
+        if r is None:
+            return None
+        custom = SV(r[0], r[1], r[2], 'CUSTOM', '.', '.', '.')
+        self.parent.plot_sv(sv=custom, tiles=self.parent.tiles)
 
 class Filters(tk.LabelFrame):
     def __init__(self, parent):
@@ -0,0 +1,296 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+from __future__ import print_function
+import os
+from os.path import expanduser as expu
+from .vcf import VCFManager
+from .pedigree import Pedigree
+from .errors import SVPVError, UsageError
+
+version = "1.02"
+
+
+# run, filter and plot parameters, as set from the command line or a Session
+class ParamSet:
+    def __init__(self):
+        self.run = RunParams()
+        self.filter = FilterParams(self)
+        self.plot = PlotParams()
+        self.ver = version
+
+
+def check_file_exists(path, message = None):
+    if not os.path.isfile(path):
+        if message:
+            raise SVPVError('{} file does not exist!\n"{}"\n'.format(message, path))
+        else:
+            raise SVPVError('file does not exist!\n"{}"\n'.format(path))
+
+
+# class to store run parameters
+class RunParams:
+    valid = ('-vcf','-aln', '-samples', '-manifest', '-o', '-gui', '-ref_gene', '-ref_vcf', '-fa', '-rd_len',
+             '-exp', '-bkpt_win', '-n_bins', '-disp', '-ped', '-fam', '-batch', '-procs',
+             '-pdf_shard', '-keep_data', '-shard', '-resume', '-force', '-coordinator', '-worker', '-local_workers', '-queue',
+             '-unit_size', '-ins_bins', '-ins_edges', '-ins_sketch',
+             '-max_reads_per_bin', '-subsample', '-profile', '-profile_sv', '-pon',
+             '-shm_cache')
+
+    def __init__(self):
+        # path to vcf
+        self.vcf = None
+        # set of alternate sv callsets to visualise against
+        self.alt_vcfs = []
+        # list of bams
+        self.bams = []
+        # list of samples
+        self.samples = []
+        # directory to write data to
+        self.out_dir = None
+        # switch for gui mode
+        self.gui = False
+        # refgene manager
+        self.ref_genes = None
+        # vcf for including population frequencies
+        self.ref_vcf = None
+        # include calls that are not present in samples
+        self.all = False
+        # reference genome fasta file
+        self.fa = None
+        # pedigree
+        self.ped = None
+        # restrict to family in pedigree
+        self.family = None
+        # register plots and render them together at the end of the run
+        self.batch = False
+        self.render_batch = None
+        # number of R processes for batch rendering
+        self.procs = 1
+        # multi-page pdf output sharded by 'chrom' or 'svtype'
+        self.pdf_shard = None
+        # directory for per SV plot data if not the output directory
+        self.data_dir = None
+        self.keep_data = False
+        # html index of thumbnails
+        self.contact_sheet = None
+        # annotation calls of the SVs of a batch run, see AnnotationJoin
+        self.annotations = None
+        # (i, N) to plot only shard i of N
+        self.shard = None
+        # keep a run journal and skip the SVs it has as completed
+        self.resume = False
+        # redo SVs already completed according to the run journal
+        self.force = False
+        # distributed runs through a work queue
+        self.coordinator = False
+        self.worker = False
+        self.local_workers = 0
+        self.queue_dir = None
+        self.unit_size = 50
+        # (chrom, pos) of an SV to run under cProfile
+        self.profile_sv = None
+        # PanelOfNormals drawn behind the depth tracks
+        self.pon = None
+        # MB of shared memory for the reads of regions shared by the processes of the run, 0 for none
+        self.shm_cache = 0
+
+        # get configurations
+        # include defaults in case they are accidentally deleted
+        self.display = 'display'
+        # detected from the alignments unless given, see get_rd_len
+        self.rd_len = None
+        self.expansion = 1
+        self.bkpt_win = 5
+        self.num_bins = 100
+
+    # longest read length of the libraries, from their baselines
+    # without sample, only set if every alignment already has a baseline sidecar so that starting up never reads
+    # the alignments, get_rd_len then samples those without one when the read length is first needed
+    def set_rd_len(self, sample=True):
+        from .sam import LibraryStats
+        libs = []
+        for bam in self.bams:
+            if sample:
+                libs.append(LibraryStats.get(bam))
+            else:
+                if bam not in LibraryStats.loaded:
+                    lib = LibraryStats.read(bam)
+                    if lib is None:
+                        return
+                    LibraryStats.loaded[bam] = lib
+                libs.append(LibraryStats.loaded[bam])
+        lens = [int(lib.read_len) for lib in libs if lib.read_len]
+        if lens:
+            self.rd_len = max(lens)
+        else:
+            print('Warning: could not detect read length, using 100bp\n')
+            self.rd_len = 100
+
+    def get_rd_len(self):
+        if self.rd_len is None:
+            self.set_rd_len()
+        return self.rd_len
+
+    def get_bams(self, samples):
+        bams = []
+        for s in samples:
+            bams.append(self.bams[self.samples.index(s)])
+        return bams
+
+    def read_samples_file(self, filepath):
+        check_file_exists(filepath, message='manifest')
+        for line in open(filepath):
+            if len(line.split()) > 2:
+                raise SVPVError("%d fields detected in manifest, expected 2.\n" % len(line.split()))
+            elif len(line.split()) < 2:
+                continue
+            self.samples.append(line.split()[0].strip())
+            self.bams.append(line.split()[1].strip())
+            check_file_exists(self.bams[-1], message='bam')
+
+    # set up the input vcfs (comma separated list, names included with colons name:file or file)
+    def set_vcfs(self, vcfs_arg):
+        for sv_vcf in vcfs_arg.split(','):
+            if ':' in sv_vcf:
+                check_file_exists(expu(sv_vcf.split(':')[1]), message='vcf')
+                vcf = VCFManager(expu(sv_vcf.split(':')[1]), name=sv_vcf.split(':')[0])
+            else:
+                check_file_exists(sv_vcf, message='vcf')
+                vcf = VCFManager(sv_vcf)
+            if self.vcf is None:
+                self.vcf = vcf
+            else:
+                self.alt_vcfs.append(vcf)
+
+    def check(self):
+        if not self.vcf:
+            if self.gui:
+                print('No VCF specified\n')
+                self.vcf = VCFManager(None, name='None', samples=self.samples)
+            else:
+                raise UsageError("please specify a VCF file")
+        if not self.out_dir:
+            raise UsageError("please specify out directory")
+
+        if not self.samples:
+            raise UsageError("please specify samples to visualise")
+        if not self.bams:
+            raise UsageError("please specify BAM/SAM files")
+        if not len(self.bams) == len(self.samples):
+            raise UsageError("requires same number of samples and alignments")
+        for b in self.bams:
+            check_file_exists(b, message='bam')
+        delete = []
+        for i, s in enumerate(self.samples):
+            if s not in self.vcf.samples:
+                print("Sample ID not found in primary VCF: %s - removing from list" % s)
+                delete.append(i)
+        for i in sorted(delete, reverse=True):
+            del self.samples[i]
+            del self.bams[i]
+        if self.ped:
+            self.ped = Pedigree(open(self.ped, 'rt'), self.samples)
+            if self.family:
+                if self.family in self.ped.samples_by_family:
+                    samples = self.ped.samples_by_family[self.family]
+                    for i in range(len(self.samples)-1, -1, -1):
+                        if self.samples[i] not in samples:
+                            del self.samples[i]
+                            del self.bams[i]
+                else:
+                    raise SVPVError('family "{}" not in supplied pedigree.\n'.format(self.family))
+
+
+# class to store parameters for filtering SVs from VCF
+class FilterParams:
+    valid = ('-max_len', '-min_len', '-af', '-rgi', '-gene_list', '-gts', '-chrom', '-exonic', '-svtype', '-sv')
+
+    def __init__(self, parent):
+        self.parent = parent
+        # threshold for for filtering AF
+        self.AF_thresh = None
+        # Allele Frequency threshold is less than
+        self.AF_thresh_is_LT = True
+        # specific chromosome/molecule/contig
+        self.chrom = None
+        # Dict of list of accepted gentypes for each sample for filtering
+        # if sample is not in dict it is not filtered
+        self.sample_GTs = {}
+        # DEL/DUP/CNV/INV
+        self.svtype = None
+        # path to genes list file
+        self.gene_list = []
+        # switch for filtering by gene list
+        self.gene_list_intersection = False
+        # intersection with refgenes
+        self.RG_intersection = False
+        # filter SVs by length
+        self.min_len = None
+        self.max_len = None
+        # pointer to refgenes
+        self.ref_genes = None
+        # filter for SVs that intersect exons only
+        self.exonic = False
+        # set of chrom:pos ids of specific calls
+        self.sv_ids = None
+
+
+# class to store parameters for what to show in R plots
+class PlotParams:
+    valid = ('-d', '-or', '-v', '-ss', '-se', '-su', '-cl', '-i', '-r', '-af', '-l', '-gc', '-dm', '-separate_plots',
+             '-l_svs', '-thumbs', '-contact_sheet')
+
+    def __init__(self):
+        self.gc = False
+        self.depth = True
+        self.orphaned = True
+        self.inverted = True
+        self.samestrand = True
+        self.secondary = False
+        self.supplementary = False
+        self.clipped = True
+        self.ins = True
+        self.refgene = True
+        self.sv_af = True
+        self.legend = True
+        self.diff_mol = True
+        self.grouping = 8
+        self.l_svs = False
+        # png thumbnails instead of pdfs
+        self.thumbs = False
+        self.contact_sheet = False
+
+    # command line arguments for calling Rscipt
+    def get_R_args(self):
+        args = []
+        if self.depth:
+            args.append("-d")
+        if self.orphaned:
+            args.append("-or")
+        if self.inverted:
+            args.append("-v")
+        if self.samestrand:
+            args.append("-ss")
+        if self.secondary:
+            args.append("-se")
+        if self.supplementary:
+            args.append("-su")
+        if self.clipped:
+            args.append("-cl")
+        if self.ins:
+            args.append("-i")
+        if self.refgene:
+            args.append("-r")
+        if self.sv_af:
+            args.append("-af")
+        if self.legend:
+            args.append("-l")
+        if self.gc:
+            args.append("-gc")
+        if self.diff_mol:
+            args.append("-dm")
+        if self.thumbs:
+            args.append("-thumb")
+        return args
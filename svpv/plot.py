@@ -8,49 +8,66 @@ import os
 import subprocess
 from hashlib import sha1
 import copy
+import numpy as np
 from .sam import SamStats, SAMtools
 from .vcf import SV
 from .refgene import RefGeneEntry
+from .timing import Timer
+from .errors import SVPVError
 
 
 class Plot:
     svpv_r = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'svpv.r')
 
-    def __init__(self, sv, samples, par):
+    # tiles is a TileCache for browsing, the plot windows are then aligned to its grid
+    def __init__(self, sv, samples, par, tiles=None):
         self.par = par
         self.samples = samples
         self.sv = sv
-        self.region_bins = None
-        self.bkpt_bins = None
+        self.region_bins, self.bkpt_bins = Plot.get_bins(sv, par)
+        if tiles is not None:
+            if self.region_bins:
+                self.region_bins = tiles.snap(self.region_bins)
+            if self.bkpt_bins:
+                self.bkpt_bins = tuple(tiles.snap(b) for b in self.bkpt_bins)
+        if self.region_bins and self.bkpt_bins:
+            self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), self.bkpt_bins,
+                                                    depth_bins=self.region_bins, tiles=tiles)
+        elif self.bkpt_bins:
+            self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), self.bkpt_bins, tiles=tiles)
+        else:
+            self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins], tiles=tiles)
+        self.print_data()
+
+    # the region and breakpoint windows of a plot of sv
+    @staticmethod
+    def get_bins(sv, par):
+        region_bins = None
+        bkpt_bins = None
 
+        rd_len = par.run.get_rd_len()
         # half breakpoint window
-        h_bkpt_wind = (par.run.bkpt_win * par.run.rd_len) // 2
+        h_bkpt_wind = (par.run.bkpt_win * rd_len) // 2
 
         # show depth over whole region but zoom in on breakpoints if necessary
         if sv.svtype in ('DEL', 'DUP', 'CNV', 'INV', 'CUSTOM'):
             start = sv.pos - par.run.expansion * (sv.end - sv.pos + 1)
             end = sv.end + par.run.expansion * (sv.end - sv.pos + 1)
-            self.region_bins = Bins(sv.chrom, start, end, ideal_num_bins=par.run.num_bins)
-            if (end - start) > par.run.bkpt_win * par.run.rd_len:
+            region_bins = Bins(sv.chrom, start, end, ideal_num_bins=par.run.num_bins)
+            if (end - start) > par.run.bkpt_win * rd_len:
                 mid = (sv.pos + sv.end) // 2
-                self.bkpt_bins = (Bins(sv.chrom, sv.pos - h_bkpt_wind, min(sv.pos + h_bkpt_wind, mid),
-                                       ideal_num_bins=par.run.num_bins//2),
-                                  Bins(sv.chrom, max(sv.end - h_bkpt_wind, mid), sv.end + h_bkpt_wind,
-                                       ideal_num_bins=par.run.num_bins//2))
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), self.bkpt_bins,
-                                                   depth_bins=self.region_bins)
-            elif self.region_bins.length() < par.run.bkpt_win * par.run.rd_len:
+                bkpt_bins = (Bins(sv.chrom, sv.pos - h_bkpt_wind, min(sv.pos + h_bkpt_wind, mid),
+                                  ideal_num_bins=par.run.num_bins//2),
+                             Bins(sv.chrom, max(sv.end - h_bkpt_wind, mid), sv.end + h_bkpt_wind,
+                                  ideal_num_bins=par.run.num_bins//2))
+            elif region_bins.length() < par.run.bkpt_win * rd_len:
                 mid = (sv.pos + sv.end) // 2
-                self.region_bins = Bins(sv.chrom, mid - h_bkpt_wind, mid + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins])
-            else:
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins])
+                region_bins = Bins(sv.chrom, mid - h_bkpt_wind, mid + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
 
         # single breakpoint
         elif sv.svtype == 'INS':
-            self.region_bins = Bins(sv.chrom, sv.pos - h_bkpt_wind, sv.pos + h_bkpt_wind,
-                                    ideal_num_bins=par.run.num_bins)
-            self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins])
+            region_bins = Bins(sv.chrom, sv.pos - h_bkpt_wind, sv.pos + h_bkpt_wind,
+                               ideal_num_bins=par.run.num_bins)
 
         # do not show depth region, just stats at pair of breakpoints
         elif sv.svtype in ('BND', 'TRA'):
@@ -64,36 +81,60 @@ class Plot:
             elif sv.svtype == 'TRA':
                 chr1, pos1 = sv.chrom, sv.pos
                 chr2, pos2 = sv.chr2, sv.chr2_pos
-            if chr1 == chr2 and abs(pos2-pos1) < 2*par.run.rd_len:
-                self.region_bins = Bins(chr1, pos1 - h_bkpt_wind, pos2 + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins])
+            if chr1 == chr2 and abs(pos2-pos1) < 2*rd_len:
+                region_bins = Bins(chr1, pos1 - h_bkpt_wind, pos2 + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
             elif chr2 is not None:
-                self.bkpt_bins = (Bins(chr1, pos1 - h_bkpt_wind, pos1 + h_bkpt_wind, ideal_num_bins=par.run.num_bins//2),
-                                  Bins(chr2, pos2 - h_bkpt_wind, pos2 + h_bkpt_wind, ideal_num_bins=par.run.num_bins//2))
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), self.bkpt_bins)
+                bkpt_bins = (Bins(chr1, pos1 - h_bkpt_wind, pos1 + h_bkpt_wind, ideal_num_bins=par.run.num_bins//2),
+                             Bins(chr2, pos2 - h_bkpt_wind, pos2 + h_bkpt_wind, ideal_num_bins=par.run.num_bins//2))
             else:
-                self.region_bins = Bins(chr1, pos1 - h_bkpt_wind, pos1 + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
-                self.sam_stats = SamStats.get_sam_stats(par.run.get_bams(samples), [self.region_bins])
+                region_bins = Bins(chr1, pos1 - h_bkpt_wind, pos1 + h_bkpt_wind, ideal_num_bins=par.run.num_bins)
 
         else:
-            raise ValueError('unsupported svtype: {}'.format(self.sv.svtype))
-        self.print_data()
+            raise ValueError('unsupported svtype: {}'.format(sv.svtype))
+        return region_bins, bkpt_bins
+
+    # query regions for annotating the plot windows
+    @staticmethod
+    def get_queries(region_bins, bkpt_bins):
+        if region_bins:
+            return [region_bins.get_region_tuple()]
+        return [bin.get_region_tuple() for bin in bkpt_bins]
 
     def print_data(self):
         # create directories
-        self.dirs = self.create_dirs(self.par.run.out_dir)
+        # multi-page batch runs keep the per SV data out of the output directory
+        if self.par.run.data_dir:
+            self.dirs = self.create_dirs(self.par.run.data_dir)
+        else:
+            self.dirs = self.create_dirs(self.par.run.out_dir)
 
         # print sample data to file
-        for i, s in enumerate(self.samples):
-            self.sam_stats[i].print_stats(self.dirs[s])
+        with Timer.stage('print_stats'):
+            for i, s in enumerate(self.samples):
+                self.sam_stats[i].print_stats(self.dirs[s])
+
+        # expected depth range from the panel of normals, for each depth window as written by print_stats
+        if self.par.run.pon is not None:
+            with Timer.stage('pon'):
+                for i, s in enumerate(self.samples):
+                    ss = self.sam_stats[i]
+                    if ss.depth:
+                        self.par.run.pon.write_band(ss.depth.bins, ss.depth.depths,
+                                                    os.path.join(self.dirs[s], 'region_pon.tsv'))
+                    else:
+                        for aln in ss.align:
+                            self.par.run.pon.write_band(aln.depth_stats.bins, aln.depth_stats.depths, os.path.join(
+                                self.dirs[s], '{}.{}.pon.tsv'.format(aln.bins.chrom, aln.bins.start)))
 
         if self.par.run.fa:
-            if self.region_bins:
-                self.region_bins.print_gc(self.par.run.fa, open(os.path.join(self.dirs['pos'], 'region_gc.tsv'), 'wt'))
-            else:
-                for bin in self.bkpt_bins:
-                    bin.print_gc(self.par.run.fa, open(os.path.join(self.dirs['pos'],
-                                                                    '{}.{}.gc.tsv'.format(bin.chrom, bin.start)), 'wt'))
+            with Timer.stage('gc'):
+                if self.region_bins:
+                    self.region_bins.print_gc(self.par.run.fa, open(os.path.join(self.dirs['pos'], 'region_gc.tsv'),
+                                                                    'wt'))
+                else:
+                    for bin in self.bkpt_bins:
+                        bin.print_gc(self.par.run.fa, open(os.path.join(self.dirs['pos'], '{}.{}.gc.tsv'.format(
+                            bin.chrom, bin.start)), 'wt'))
 
         # plot attributes for use in R
         plot_attr = open(os.path.join(self.dirs['pos'], 'plot_attr.tsv'), 'wt')
@@ -112,12 +153,7 @@ class Plot:
         plot_attr.close()
 
         # extract query regions
-        if self.region_bins:
-            queries = [self.region_bins.get_region_tuple()]
-        else:
-            queries = []
-            for bin in self.bkpt_bins:
-                queries.append(bin.get_region_tuple())
+        queries = Plot.get_queries(self.region_bins, self.bkpt_bins)
 
         # gene annotation
         if self.par.run.ref_genes:
@@ -131,63 +167,59 @@ class Plot:
                 RefGeneEntry.print_entries(genes, open(os.path.join(self.dirs['pos'], 'refgene.tsv'), 'w'))
 
         # sample-wise SV annotation
-        for i, s in enumerate(self.samples):
+        # calls are found once per vcf and split between the samples by genotype, the fields shared by all
+        # samples are formatted once
+        vcfs = [self.par.run.vcf] + self.par.run.alt_vcfs
+        calls = [self.get_calls(vcf, queries) for vcf in vcfs]
+        rows = [['\t'.join((vcf.name, sv.chrom, str(sv.pos), str(sv.end), sv.svtype)) + '\t' for sv in svs]
+                for vcf, svs in zip(vcfs, calls)]
+        for s in self.samples:
             sv_file = open(os.path.join(self.dirs[s], 'svs.tsv'), 'w')
-            svs = []
-            for region in queries:
-                _svs_ = self.par.run.vcf.get_svs_in_range(*region, sample=s, lrg_svs=self.par.plot.l_svs)
-                for sv in _svs_:
-                    if sv not in svs:
-                        svs.append(sv)
             SV.print_SVs_header(sv_file, sample_index=self.par.run.vcf.get_sample_index(s))
-            SV.print_SVs(svs, sv_file, self.par.run.vcf.name, sample_index=self.par.run.vcf.get_sample_index(s))
-            for vcf in self.par.run.alt_vcfs:
-                svs = []
-                for region in queries:
-                    _svs_ = vcf.get_svs_in_range(*region, sample=s, lrg_svs=self.par.plot.l_svs)
-                    for sv in _svs_:
-                        if sv not in svs:
-                            svs.append(sv)
-                if svs:
-                    SV.print_SVs(svs, sv_file, vcf.name, sample_index=vcf.get_sample_index(s))
+            for i, vcf in enumerate(vcfs):
+                idx = vcf.get_sample_index(s)
+                if idx is None:
+                    lines = [row + str(sv.AF) + '\n' for sv, row in zip(calls[i], rows[i])]
+                else:
+                    lines = [row + sv.GTs[idx] + '\n' for sv, row in zip(calls[i], rows[i]) if '1' in sv.GTs[idx]]
+                sv_file.writelines(lines)
             sv_file.close()
 
         # batch-wise SV annotation
         svs_file = open(os.path.join(self.dirs['pos'], 'SV_AF.tsv'), 'w')
         SV.print_SVs_header(svs_file)
         # primary vcf
-        svs = []
-        for region in queries:
-            _svs_ = self.par.run.vcf.get_svs_in_range(*region, lrg_svs=self.par.plot.l_svs)
-            for sv in _svs_:
-                if sv not in svs:
-                    svs.append(sv)
-        if svs:
-            SV.print_SVs(svs, svs_file, self.par.run.vcf.name)
+        if calls[0]:
+            SV.print_SVs(calls[0], svs_file, self.par.run.vcf.name)
         if self.sv.svtype == 'CUSTOM':
             SV.print_SVs([self.sv], svs_file, 'CUSTOM')
         # ref vcf
         if self.par.run.ref_vcf:
-            svs = []
-            for region in queries:
-                _svs_ = self.par.run.ref_vcf.get_svs_in_range(*region, lrg_svs=self.par.plot.l_svs)
-                for sv in _svs_:
-                    if sv not in svs:
-                        svs.append(sv)
+            svs = self.get_calls(self.par.run.ref_vcf, queries)
             if svs:
                 SV.print_SVs(svs, svs_file, self.par.run.ref_vcf.name)
         # alt vcfs
-        for vcf in self.par.run.alt_vcfs:
-            svs = []
-            for region in queries:
-                _svs_ = vcf.get_svs_in_range(*region, lrg_svs=self.par.plot.l_svs)
-                for sv in _svs_:
-                    if sv not in svs:
-                        svs.append(sv)
+        for vcf, svs in zip(vcfs[1:], calls[1:]):
             if svs:
                 SV.print_SVs(svs, svs_file, vcf.name)
         svs_file.close()
 
+    # calls of vcf overlapping the query regions, looked up in the annotation join of a batch run if there is one
+    def get_calls(self, vcf, queries, sample=None):
+        if self.par.run.annotations is not None:
+            svs = self.par.run.annotations.get(vcf, self.sv, sample)
+            if svs is not None:
+                return svs
+        svs = []
+        seen = set()
+        with Timer.stage('annotations'):
+            for region in queries:
+                for sv in vcf.get_svs_in_range(*region, sample=sample, lrg_svs=self.par.plot.l_svs):
+                    if sv not in seen:
+                        seen.add(sv)
+                        svs.append(sv)
+        return svs
+
     def plot_figure(self, group=8, display=False):
         # split into groups of 8 or less so don't go over R layout limit
         out = ''
@@ -198,34 +230,55 @@ class Plot:
                 id = current_samples[0]
             else:
                 id = sha1(''.join(current_samples).encode('utf-8')).hexdigest()[0:10]
-            out = os.path.join(self.dirs['pos'], '{}.{}.{}.{}.pdf'.format(self.sv.chrom, self.sv.pos, self.sv.svtype,id))
-            cmd = ['Rscript', Plot.svpv_r, ','.join(current_samples), os.path.join(self.dirs['pos'], ''), out]
-            cmd.append('"{} at {}:{}"'.format(self.sv.svtype, self.sv.chrom, self.sv.pos))
-            cmd.extend(self.par.plot.get_R_args())
-            print(' '.join(cmd) + '\n')
-            try:
-                subprocess.check_call(cmd)
-            except OSError:
-                print('Rscript failed. Are you sure it is installed?')
-                exit(1)
-
-            if display:
-                cmd = [display]
-                cmd.append(out)
-                print(' '.join(cmd) + '\n')
-                try:
-                    subprocess.check_call(cmd)
-                except OSError:
-                    print('Error: could not run %s. Are you sure it is installed?' % ' '.join(display))
-                    exit(1)
+            if self.par.plot.thumbs:
+                ext = 'png'
+            else:
+                ext = 'pdf'
+            out = os.path.join(self.dirs['pos'], '{}.{}.{}.{}.{}'.format(self.sv.chrom, self.pos_tag(), self.sv.svtype,
+                                                                        id, ext))
+            if self.par.run.contact_sheet is not None:
+                self.par.run.contact_sheet.add(self.sv, current_samples, out)
+            title = '"{} at {}:{}"'.format(self.sv.svtype, self.sv.chrom, self.sv.pos)
+            # in batch mode the job is only registered, it is rendered with the rest of the batch
+            if self.par.run.render_batch is not None:
+                self.par.run.render_batch.add(self.sv, current_samples, os.path.join(self.dirs['pos'], ''), out, title)
             else:
-                print("created %s\n" % out)
+                self.render(current_samples, out, title, display)
             current_samples = next_samples[0:group]
             next_samples = next_samples[group:]
             if not current_samples:
                 break
         return out
 
+    def render(self, samples, out, title, display=False):
+        cmd = ['Rscript', Plot.svpv_r, ','.join(samples), os.path.join(self.dirs['pos'], ''), out]
+        cmd.append(title)
+        cmd.extend(self.par.plot.get_R_args())
+        print(' '.join(cmd) + '\n')
+        Timer.count('subprocesses')
+        try:
+            with Timer.stage('rscript'):
+                subprocess.check_call(cmd)
+        except OSError:
+            raise SVPVError('Rscript failed. Are you sure it is installed?')
+
+        if display:
+            cmd = [display]
+            cmd.append(out)
+            print(' '.join(cmd) + '\n')
+            try:
+                subprocess.check_call(cmd)
+            except OSError:
+                raise SVPVError('could not run %s. Are you sure it is installed?' % display)
+        else:
+            print("created %s\n" % out)
+
+    # position in the paths of the plot, custom regions starting at the same position differ by their end
+    def pos_tag(self):
+        if self.sv.svtype == 'CUSTOM':
+            return '{}-{}'.format(self.sv.pos, self.sv.end)
+        return str(self.sv.pos)
+
     def create_dirs(self, outdir):
         dirs = {}
         dirs['root'] = outdir
@@ -234,7 +287,7 @@ class Plot:
         dirs['svtype'] = os.path.join(dirs['root'], self.sv.svtype)
         if not os.path.exists(dirs['svtype']):
             os.mkdir(dirs['svtype'])
-        dirs['pos'] = os.path.join(dirs['svtype'], '%s_%d' % (self.sv.chrom, self.sv.pos))
+        dirs['pos'] = os.path.join(dirs['svtype'], '{}_{}'.format(self.sv.chrom, self.pos_tag()))
         if not os.path.exists(dirs['pos']):
             os.mkdir(dirs['pos'])
         for s in self.samples:
@@ -243,6 +296,45 @@ class Plot:
                 os.mkdir(dirs[s])
         return dirs
 
+# calls of every annotation vcf overlapping the plot windows of each SV of a batch run
+# computed up front by one sweep per vcf and chromosome over the windows of all the SVs
+class AnnotationJoin:
+    def __init__(self, par, svs):
+        keys = []
+        queries = []
+        for sv in svs:
+            try:
+                region_bins, bkpt_bins = Plot.get_bins(sv, par)
+            except ValueError:
+                continue
+            for query in Plot.get_queries(region_bins, bkpt_bins):
+                keys.append(sv)
+                queries.append(query)
+        # dict by vcf of dict by SV of calls overlapping its windows
+        self.calls = {}
+        for vcf in [par.run.vcf, par.run.ref_vcf] + par.run.alt_vcfs:
+            if vcf is None or vcf in self.calls:
+                continue
+            calls = {}
+            seen = {}
+            for sv, found in zip(keys, vcf.join_ranges(queries, lrg_svs=par.plot.l_svs)):
+                if sv in calls:
+                    for c in found:
+                        if c not in seen[sv]:
+                            seen[sv].add(c)
+                            calls[sv].append(c)
+                else:
+                    calls[sv] = found
+                    seen[sv] = set(found)
+            self.calls[vcf] = calls
+
+    # calls of vcf overlapping the windows of sv, None if they were not joined
+    def get(self, vcf, sv, sample=None):
+        if vcf not in self.calls or sv not in self.calls[vcf]:
+            return None
+        return vcf.sample_filter(self.calls[vcf][sv], sample)
+
+
 class Bins:
     def __init__(self, chrom, start, end, ideal_num_bins=100):
 
@@ -300,3 +392,24 @@ class Bins:
         if first == last:
             last_bp = 0
         return (first, first_bp), (last, last_bp)
+
+    # vectorised equivalent of get_bin_coverage for arrays of starts and ends
+    # returns a mask of the covered ranges and arrays of first, first_bp, last, last_bp
+    def get_bins_coverage(self, starts, ends):
+        valid = ~((starts > self.end) | (ends < self.start))
+
+        before = starts <= self.start
+        first = np.where(before, 0, (starts - self.start) // self.size)
+        first_bp = np.where(before, np.where(ends >= self.start + self.size, self.size, ends - self.start + 1),
+                            self.size - ((starts - self.start + 1) % self.size))
+
+        after = ends >= self.end
+        last = np.where(after, self.num - 1, (ends - self.start) // self.size)
+        last_bp = np.where(after, np.where(starts <= self.end - self.size, self.size, starts - (self.end - self.size)),
+                           (ends - self.start + 1) % self.size)
+
+        valid &= (first >= 0) & (first < self.num) & (last >= 0) & (last < self.num)
+        last_bp = np.where(first == last, 0, last_bp)
+        first = np.where(valid, first, 0)
+        last = np.where(valid, last, 0)
+        return valid, first, first_bp, last, last_bp
@@ -0,0 +1,153 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# panel of normals, the median and MAD of normalised depth in each coverage index tile across a reference set of
+# alignments, built once by 'SVPV panel' and drawn behind the depth track of each sample as the expected range
+from __future__ import print_function
+from __future__ import division
+import os
+import numpy as np
+from .sam import CoverageIndex
+from .errors import SVPVError
+
+
+class PanelOfNormals:
+    # depth of each alignment is normalised by its median depth over tiles of this size with any coverage
+    norm_tile_size = 10000
+    # tiles of a chromosome processed at a time while building
+    chunk = 500000
+    # the band drawn is the median +- band_sds robust standard deviations (1.4826 MAD)
+    band_sds = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.num_samples = None
+        # dict by (chrom, tile size) of (offset, number of tiles) in the data file
+        self.blocks = {}
+        self.data = None
+
+    @staticmethod
+    def data_path(path):
+        return path + '.svpv_pon'
+
+    @staticmethod
+    def idx_path(path):
+        return path + '.svpv_pon.idx'
+
+    @staticmethod
+    def load(path):
+        if path.endswith('.svpv_pon'):
+            path = path[:-len('.svpv_pon')]
+        if not (os.path.isfile(PanelOfNormals.idx_path(path)) and os.path.isfile(PanelOfNormals.data_path(path))):
+            raise SVPVError('panel of normals not found: {}\n'.format(PanelOfNormals.data_path(path)))
+        pon = PanelOfNormals(path)
+        for line in open(PanelOfNormals.idx_path(path)):
+            fields = line.rstrip('\n').split('\t')
+            if line[0] == '#':
+                if fields[0] == '#samples':
+                    pon.num_samples = int(fields[1])
+            else:
+                chrom, tile_size, offset, num = fields
+                pon.blocks[(chrom, int(tile_size))] = (int(offset), int(num))
+        pon.data = np.memmap(PanelOfNormals.data_path(path), dtype=np.float32, mode='r')
+        return pon
+
+    # returns the (num bins x 2) median and MAD of normalised depth of bins, averaged over the largest tiles no
+    # larger than the bins, or None if the panel does not cover the chromosome
+    def get_band(self, bins):
+        tile_size = None
+        for size in CoverageIndex.tile_sizes:
+            if size <= max(bins.size, CoverageIndex.tile_sizes[0]) and (bins.chrom, size) in self.blocks:
+                tile_size = size
+        if tile_size is None:
+            return None
+        offset, num = self.blocks[(bins.chrom, tile_size)]
+        tiles = np.asarray(self.data[offset:offset + 2 * num], dtype=np.float64).reshape((num, 2))
+        cum = np.zeros((num + 1, 2))
+        cum[1:] = np.cumsum(tiles, axis=0)
+        edges = bins.start + np.arange(bins.num + 1) * bins.size
+        band = np.zeros((bins.num, 2))
+        for j in range(2):
+            at_edges = np.interp(edges, np.arange(num + 1) * tile_size, cum[:, j] * tile_size)
+            band[:, j] = np.diff(at_edges) / bins.size
+        return band
+
+    # write the band of bins for a sample with depths (num bins x DepthStats.depth_cols, in reads/bp)
+    # the panel is scaled to the sample by the median ratio of its depth to the panel median over the bins
+    def write_band(self, bins, depths, path):
+        band = self.get_band(bins)
+        if band is None:
+            return
+        total = depths[:, 0]
+        covered = band[:, 0] > 0
+        if not covered.any():
+            return
+        scale = np.median(total[covered] / band[covered, 0])
+        median = band[:, 0] * scale
+        spread = PanelOfNormals.band_sds * 1.4826 * band[:, 1] * scale
+        out = open(path, 'wt')
+        out.write('bin\tmedian\tlower\tupper\n')
+        for i in range(bins.num):
+            out.write('{}\t{:.4f}\t{:.4f}\t{:.4f}\n'.format(bins.start + i * bins.size, median[i],
+                                                         max(0, median[i] - spread[i]), median[i] + spread[i]))
+        out.close()
+
+    # build the panel from the coverage indexes of bams, indexing those without one
+    @staticmethod
+    def build(bams, path, mapq_thresh=30, procs=1):
+        if len(bams) < 2:
+            raise SVPVError('a panel of normals needs at least 2 alignments\n')
+        indexes = []
+        for bam in bams:
+            index = CoverageIndex.load(bam)
+            if index is None:
+                CoverageIndex.build(bam, mapq_thresh=mapq_thresh, procs=procs)
+                index = CoverageIndex.load(bam)
+            indexes.append(index)
+        norms = [PanelOfNormals.get_norm(index) for index in indexes]
+
+        # chromosomes covered by every index, in the order of the first
+        chroms = []
+        for chrom, size in sorted(indexes[0].blocks, key=lambda x: indexes[0].blocks[x][0]):
+            if size == CoverageIndex.tile_sizes[0] and all((chrom, size) in ci.blocks for ci in indexes):
+                chroms.append(chrom)
+        data = open(PanelOfNormals.data_path(path), 'wb')
+        idx = open(PanelOfNormals.idx_path(path), 'wt')
+        idx.write('#samples\t{}\n'.format(len(bams)))
+        offset = 0
+        for chrom in chroms:
+            for size in CoverageIndex.tile_sizes:
+                num = min(ci.blocks[(chrom, size)][1] for ci in indexes)
+                idx.write('{}\t{}\t{}\t{}\n'.format(chrom, size, offset, num))
+                for start in range(0, num, PanelOfNormals.chunk):
+                    end = min(num, start + PanelOfNormals.chunk)
+                    depths = np.vstack([PanelOfNormals.get_depths(index, chrom, size, start, end) / norm
+                                        for index, norm in zip(indexes, norms)])
+                    median = np.median(depths, axis=0)
+                    mad = np.median(np.abs(depths - median), axis=0)
+                    data.write(np.column_stack((median, mad)).astype(np.float32).tobytes())
+                offset += 2 * num
+        data.close()
+        idx.close()
+        print('panel of normals of {} alignments written to {}\n'.format(len(bams), PanelOfNormals.data_path(path)))
+
+    # depth of tiles start to end of chrom from all reads
+    @staticmethod
+    def get_depths(index, chrom, size, start, end):
+        offset, num = index.blocks[(chrom, size)]
+        tiles = np.asarray(index.data[offset + 3 * start:offset + 3 * end], dtype=np.float64).reshape((-1, 3))
+        return tiles[:, 0] / size
+
+    # median depth of the tiles with any coverage
+    @staticmethod
+    def get_norm(index):
+        depths = []
+        for chrom, size in index.blocks:
+            if size == PanelOfNormals.norm_tile_size:
+                d = PanelOfNormals.get_depths(index, chrom, size, 0, index.blocks[(chrom, size)][1])
+                depths.append(d[d > 0])
+        depths = np.concatenate(depths) if depths else np.array([])
+        if not len(depths):
+            raise SVPVError('no coverage in the index of {}\n'.format(index.bam))
+        return np.median(depths)
@@ -6,6 +6,7 @@ from __future__ import print_function
 
 class RefgeneManager:
     def __init__(self, ref_genes, keep_all=False):
+        self.path = ref_genes
         # dict by chrom (as with SVs in VCF_Manager)
         self.entries = {}
         count = 0
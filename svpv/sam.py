@@ -10,6 +10,23 @@ import os
 from subprocess import PIPE
 import numpy as np
 import tempfile
+from .timing import Timer
+from .errors import SVPVError
+from .tools import Tools
+
+
+# raised when samtools output does not match the bins it was requested for
+# found is None when the output could not be split into bins at all
+class BinCountError(SVPVError, ValueError):
+    def __init__(self, message, expected, found, bam):
+        if found is None:
+            text = '{}: expected {} bins for {}'.format(message, expected, bam)
+        else:
+            text = '{}: {} of {} bins for {}'.format(message, found, expected, bam)
+        SVPVError.__init__(self, text)
+        self.expected = expected
+        self.found = found
+        self.bam = bam
 
 
 class SamEntry():
@@ -118,12 +135,104 @@ class SamEntry():
         return clipped
 
 
+# columns needed for alignment stats of a block of reads, parsed from samtools view output
+class SamReads:
+    # cigar -> (left soft clipped bases, reference bases, clipped bases) or None, shared by all reads
+    cigars = {}
+    # bytes read from the pipe at a time
+    chunk_size = 1 << 22
+
+    def __init__(self, flag, pos, mapq, cigar, rnext, tlen):
+        self.flag = np.array(flag).astype(np.uint16)
+        self.mapq = np.array(mapq).astype(np.int64)
+        self.tlen = np.array(tlen).astype(np.int64)
+        self.diffmol = np.array([b'=' not in r for r in rnext], dtype=bool)
+        parsed = [SamReads.parse_cigar(c) for c in cigar]
+        # reads with cigars SamEntry can not process are dropped
+        keep = np.array([c is not None for c in parsed], dtype=bool)
+        cig = np.array([c for c in parsed if c is not None], dtype=np.int64).reshape((-1, 3))
+        self.flag, self.mapq, self.tlen, self.diffmol = self.flag[keep], self.mapq[keep], self.tlen[keep], \
+            self.diffmol[keep]
+        # alignment start, kept to select the reads of a region inside a cached one
+        self.start = np.array(pos).astype(np.int64)[keep]
+        # as SamEntry.get_aligned_pos
+        self.left = self.start + cig[:, 0]
+        self.right = self.left + cig[:, 1]
+        self.clipped = cig[:, 2]
+
+    def __len__(self):
+        return len(self.flag)
+
+    @staticmethod
+    def parse_cigar(cigar):
+        if cigar in SamReads.cigars:
+            return SamReads.cigars[cigar]
+        text = cigar.decode() if isinstance(cigar, bytes) else cigar
+        m = re.search(SamEntry.cigar_clip, text)
+        if m is None:
+            parsed = None
+        else:
+            clipped = m.groupdict()
+            ref_len = sum(int(n) for n, op in re.findall('([0-9]+)([^0-9])', text) if re.match(SamEntry.cigar_ref_chars, op))
+            parsed = (int(clipped['LS'] or 0), ref_len, sum(int(v) for v in clipped.values() if v))
+        SamReads.cigars[cigar] = parsed
+        return parsed
+
+    # yield blocks of reads from a binary samtools view pipe, reading it in large chunks
+    @staticmethod
+    def read(stream):
+        rest = b''
+        while True:
+            with Timer.stage('samtools_view'):
+                chunk = stream.read(SamReads.chunk_size)
+            if not chunk:
+                break
+            Timer.count('bytes_read', len(chunk))
+            with Timer.stage('sam_parse'):
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                reads = SamReads.parse(lines)
+            if reads is not None:
+                yield reads
+        if rest:
+            reads = SamReads.parse([rest])
+            if reads is not None:
+                yield reads
+
+    @staticmethod
+    def parse(lines):
+        cols = ([], [], [], [], [], [])
+        for line in lines:
+            fields = line.split(b'\t', 9)
+            if len(fields) < 9:
+                continue
+            cols[0].append(fields[1])
+            cols[1].append(fields[3])
+            cols[2].append(fields[4])
+            cols[3].append(fields[5])
+            cols[4].append(fields[6])
+            cols[5].append(fields[8].split()[0])
+        if not cols[0]:
+            return None
+        return SamReads(*cols)
+
+
 class SamStats:
+    # read downsampling, by a hash of the read name so that mates are kept or dropped together
+    # fixed fraction of reads to keep
+    subsample = None
+    # cap on the average number of reads per bin
+    max_reads_per_bin = None
+    # ReadCache shared by the processes of the run, or None to read every region from the alignment
+    read_cache = None
+
     def __init__(self):
         # list of alignment stats
         self.align = []
         # single depth stats or none
         self.depth = None
+        # baseline of the library the stats were collected from
+        self.library = None
 
     # Print the collected stats to text files
     def print_stats(self, dir):
@@ -140,35 +249,17 @@ class SamStats:
 
         for aln in self.align:
             aln_stats_file = open(os.path.join(dir, '{}.{}.aln_stats.tsv'.format(aln.bins.chrom, aln.bins.start)), 'wt')
-            fwd_ins_file = open(os.path.join(dir, '{}.{}.fwd_ins.csv'.format(aln.bins.chrom, aln.bins.start)), 'wt')
-            rvs_ins_file = open(os.path.join(dir, '{}.{}.rvs_ins.csv'.format(aln.bins.chrom, aln.bins.start)),'wt')
             if not self.depth:
                 depth_file = open(os.path.join(dir, '{}.{}.depths.tsv'.format(aln.bins.chrom, aln.bins.start)), 'wt')
                 depth_file.write('bin\t' + '\t'.join(DepthStats.depth_cols) + '\n')
             aln_stats_file.write('bin\t' + '\t'.join(AlignStats.aln_stats_cols) + '\n')
-            # print alignmet stats, insert sizes and depths
+            # print alignmet stats and depths
             for i, row in enumerate(aln.aln_stats):
                 # aln_stats
                 aln_stats_file.write(str(aln.bins.start + i*aln.bins.size) + '\t')
                 for k in range(0,len(row)-1):
                     aln_stats_file.write(str(row[k]) + '\t')
                 aln_stats_file.write(str(row[-1]) + '\n')
-                # fwd inserts
-                if aln.fwd_inserts[i]:
-                    for k in range(0, len(aln.fwd_inserts[i])-1):
-                         fwd_ins_file.write(str(aln.fwd_inserts[i][k]) + ',')
-                    fwd_ins_file.write(str(aln.fwd_inserts[i][-1]))
-                else:
-                    fwd_ins_file.write('NA')
-                fwd_ins_file.write('\n')
-                # rvs inserts
-                if aln.rvs_inserts[i]:
-                    for k in range(0, len(aln.rvs_inserts[i])-1):
-                        rvs_ins_file.write(str(aln.rvs_inserts[i][k]) + ',')
-                    rvs_ins_file.write(str(aln.rvs_inserts[i][-1]))
-                else:
-                    rvs_ins_file.write('NA')
-                rvs_ins_file.write('\n')
                 # depths
                 if not self.depth:
                     depth_file.write(str(aln.depth_stats.bins.start + i * aln.depth_stats.bins.size) + '\t')
@@ -178,39 +269,92 @@ class SamStats:
 
             if not self.depth:
                 depth_file.close()
-            fwd_ins_file.close()
-            rvs_ins_file.close()
             aln_stats_file.close()
+            aln.print_inserts(dir)
 
 
     # returns a list of sam_stats corresponding to the list of bams given for this position
+    # tiles is a TileCache to take the stats from, for bins aligned to its grid
     @staticmethod
-    def get_sam_stats(bams, bkpt_bins_list, depth_bins=None):
+    def get_sam_stats(bams, bkpt_bins_list, depth_bins=None, tiles=None):
         sam_stats = []
         for bam in bams:
             sam_stats.append(SamStats())
+            with Timer.stage('library_stats'):
+                sam_stats[-1].library = LibraryStats.get(bam)
             if depth_bins is not None:
-                sam_stats[-1].depth = DepthStats(depth_bins)
-                sam_stats[-1].depth.set_depths(bam)
+                # the coverage index is quicker than reading the reads of the tiles of large regions
+                if tiles is not None and CoverageIndex.load(bam) is None:
+                    sam_stats[-1].depth = tiles.get_align_stats(bam, sam_stats[-1].library, depth_bins).depth_stats
+                else:
+                    sam_stats[-1].depth = DepthStats(depth_bins)
+                    with Timer.stage('depths'):
+                        sam_stats[-1].depth.set_depths(bam)
 
+            ins_edges = AlignStats.get_ins_edges(sam_stats[-1].library)
             for bins in bkpt_bins_list:
-                sam_stats[-1].align.append(AlignStats(bins))
+                if tiles is not None:
+                    sam_stats[-1].align.append(tiles.get_align_stats(bam, sam_stats[-1].library, bins))
+                else:
+                    sam_stats[-1].align.append(SamStats.get_align_stats(bam, bins, ins_edges))
                 if (len(bkpt_bins_list) == 1):
                     sam_stats[-1].depth = sam_stats[-1].align[-1].depth_stats
-                p = SAMtools.view(bam, bins.region)
-                line = p.stdout.readline()
-                while line:
-                    try:
-                        FLAG, RNAME, POS, MAPQ, CIGAR, RNEXT, PNEXT, TLEN = line.split()[1:9]
-                    except ValueError:
-                        line = p.stdout.readline()
-                        continue
-                    else:
-                        sam_stats[-1].align[-1].process(SamEntry(FLAG, POS, MAPQ, CIGAR, RNEXT, TLEN))
-                        line = p.stdout.readline()
-                sam_stats[-1].align[-1].depth_stats.convert_depths()
         return sam_stats
 
+    # alignment stats of the reads of bam in bins
+    @staticmethod
+    def get_align_stats(bam, bins, ins_edges):
+        aln = AlignStats(bins, ins_edges=ins_edges)
+        fraction = SamStats.get_fraction(bam, bins)
+        for reads in SamStats.get_reads(bam, bins, fraction):
+            Timer.count('reads', len(reads))
+            with Timer.stage('aln_stats'):
+                aln.process_reads(reads)
+        if fraction is not None:
+            aln.scale(1 / fraction)
+        aln.depth_stats.convert_depths()
+        return aln
+
+    # yield blocks of the reads of bam in bins, from the read cache if it has them
+    @staticmethod
+    def get_reads(bam, bins, fraction):
+        cache = SamStats.read_cache
+        if cache is not None:
+            with Timer.stage('read_cache'):
+                reads = cache.get(bam, bins.chrom, bins.start, bins.end, fraction)
+            if reads is not None:
+                Timer.count('read_cache_hits')
+                try:
+                    yield reads
+                finally:
+                    reads.release()
+                return
+        blocks = []
+        p = SAMtools.view(bam, bins.region, subsample=fraction, binary=True)
+        for reads in SamReads.read(p.stdout):
+            if cache is not None:
+                blocks.append(reads)
+            yield reads
+        p.stdout.close()
+        p.wait()
+        if cache is not None:
+            with Timer.stage('read_cache'):
+                cache.put(bam, bins.chrom, bins.start, bins.end, fraction, blocks)
+
+    # fraction of the reads in the region of bins to process, None for all of them
+    @staticmethod
+    def get_fraction(bam, bins):
+        fraction = 1
+        if SamStats.subsample is not None:
+            fraction = SamStats.subsample
+        if SamStats.max_reads_per_bin:
+            count = SAMtools.count(bam, bins.region)
+            if count:
+                fraction = min(fraction, SamStats.max_reads_per_bin * bins.num / count)
+        if fraction >= 1:
+            return None
+        return fraction
+
 
 class DepthStats:
     depth_cols = ['total', 'mapQltT', 'mapQ0']
@@ -218,13 +362,24 @@ class DepthStats:
     MAPQLTT = 1
     MAPQ0 = 2
 
-    def __init__(self, bins, mapq_thresh=30, dtype=np.float):
+    def __init__(self, bins, mapq_thresh=30, dtype=np.float64):
         self.bins = bins
         self.depths = np.zeros((self.bins.num, len(DepthStats.depth_cols)), dtype=dtype)
         self.mapq_thresh = mapq_thresh
 
 
     def set_depths(self, bam):
+        # use the coverage index of the bam if it has one at a resolution suitable for the bins
+        index = CoverageIndex.load(bam)
+        if index is not None:
+            counts = index.get_counts(self.bins, self.mapq_thresh)
+            if counts is not None:
+                # scaled as by SAMtools.bedcov so plots match those drawn without the index
+                counts /= (self.bins.size + 1)
+                self.depths[:, DepthStats.TOTAL] = counts[:, 0]
+                self.depths[:, DepthStats.MAPQ0] = counts[:, 0] - counts[:, 1]
+                self.depths[:, DepthStats.MAPQLTT] = counts[:, 0] - counts[:, 2] - self.depths[:, DepthStats.MAPQ0]
+                return
         # get depths using samtools bedcov
         bed = tempfile.NamedTemporaryFile(mode='wt', delete=False)
         for i in range(self.bins.num):
@@ -232,19 +387,21 @@ class DepthStats:
                                             self.bins.start + (i+1)*self.bins.size))
         bed_name = bed.name
         bed.close()
-        depths_gt_1 = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=1)
-        depths_gt_T = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=self.mapq_thresh)
-        self.depths[:, DepthStats.TOTAL] = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=0)
+        try:
+            depths_gt_1 = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=1)
+            depths_gt_T = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=self.mapq_thresh)
+            self.depths[:, DepthStats.TOTAL] = SAMtools.bedcov(self.bins.num, self.bins.size, bed_name, bam, min_Q=0)
+        finally:
+            os.remove(bed_name)
         self.depths[:, DepthStats.MAPQ0] = self.depths[:, DepthStats.TOTAL] - depths_gt_1
         self.depths[:, DepthStats.MAPQLTT] = self.depths[:, DepthStats.TOTAL] - depths_gt_T - self.depths[:, DepthStats.MAPQ0]
-        os.remove(bed_name)
 
     # convert depths from bp/bin count to depth/bp
     def convert_depths(self):
         # should only be done on integer count depths
-        if self.depths.dtype is np.float:
+        if self.depths.dtype.kind == 'f':
             raise ValueError
-        self.depths = self.depths.astype(np.float) / self.bins.size
+        self.depths = self.depths.astype(np.float64) / self.bins.size
 
 
 class AlignStats:
@@ -257,8 +414,16 @@ class AlignStats:
     SUPPLEMENTARY = 5
     CLIPPED = 6
     DIFFMOL = 7
-
-    def __init__(self, bins, mapq_thresh=30, clip_thresh=1):
+    # insert size histogram settings, set from the run parameters
+    # explicit edges, or the number of equal size bins up to the upper insert size of the library
+    ins_edges = None
+    ins_bins = 10
+    # size of the per bin quantile sketches of insert sizes, 0 for none
+    ins_sketch = 0
+    # upper insert size used when a library has no baseline
+    default_ins_max = 1000
+
+    def __init__(self, bins, mapq_thresh=30, clip_thresh=1, ins_edges=None):
         # set parameters
         self.bins = bins
         self.mapQT = mapq_thresh
@@ -267,90 +432,170 @@ class AlignStats:
         # initialise data structures
         self.depth_stats = DepthStats(bins, mapq_thresh=mapq_thresh, dtype=np.intc)
         self.aln_stats = np.zeros((bins.num, len(AlignStats.aln_stats_cols)), dtype=np.intc)
-        self.fwd_inserts = np.empty(bins.num, dtype=list)
-        self.rvs_inserts = np.empty(bins.num, dtype=list)
-        for j in range(0, bins.num):
-            self.fwd_inserts[j] = []
-            self.rvs_inserts[j] = []
-
-
-    def add_to_depth(self, coverage, cols):
-        # add start and end covered bins, partial coverage
-        for j in cols:
-            self.depth_stats.depths[coverage[0][0]][j] += coverage[0][1]
-            self.depth_stats.depths[coverage[1][0]][j] += coverage[1][1]
-
-        # add in all bins that have full coverage
-        for i in range(coverage[0][0]+1, coverage[1][0]):
-            for j in cols:
-                self.depth_stats.depths[i][j] += self.depth_stats.bins.size
-
-    def add_to_aln_stats(self, coverage, cols):
-        for i in range(coverage[0][0], coverage[1][0]+1):
-            for j in cols:
-                self.aln_stats[i][j] += 1
-
-    def process(self, sam_entry):
-        cov = self.bins.get_bin_coverage(sam_entry.left, sam_entry.right)
-        if cov is None:
-            return
-
-        depth_cols = [DepthStats.TOTAL]
-        if sam_entry.mapQ <= self.mapQT:
-            if sam_entry.mapQ == 0:
-                depth_cols.append(DepthStats.MAPQ0)
+        # insert size histograms, a row per bin and a column per edge
+        # the last column counts the inserts at least as large as the last edge
+        if ins_edges is None:
+            ins_edges = AlignStats.get_ins_edges(None)
+        self.ins_edges = np.asarray(ins_edges)
+        self.fwd_ins_hist = np.zeros((bins.num, len(self.ins_edges)), dtype=np.int32)
+        self.rvs_ins_hist = np.zeros((bins.num, len(self.ins_edges)), dtype=np.int32)
+        if AlignStats.ins_sketch:
+            self.fwd_ins_sketch = QuantileSketch(bins.num, AlignStats.ins_sketch)
+            self.rvs_ins_sketch = QuantileSketch(bins.num, AlignStats.ins_sketch)
+        else:
+            self.fwd_ins_sketch = None
+            self.rvs_ins_sketch = None
+
+    # histogram edges for a library, equal size bins up to ~ the 98.5th percentile of its insert sizes
+    @staticmethod
+    def get_ins_edges(library):
+        if AlignStats.ins_edges is not None:
+            return AlignStats.ins_edges
+        if library is not None and library.ins_median is not None and library.ins_mad is not None:
+            ins_max = 1.1 * (library.ins_median + 2.17 * 1.4826 * library.ins_mad)
+        else:
+            ins_max = AlignStats.default_ins_max
+        return np.round(np.linspace(0, ins_max, AlignStats.ins_bins + 1)).astype(np.int64)
+
+    def print_inserts(self, dir):
+        prefix = os.path.join(dir, '{}.{}.'.format(self.bins.chrom, self.bins.start))
+        for name, hist, sketch in (('fwd', self.fwd_ins_hist, self.fwd_ins_sketch),
+                                   ('rvs', self.rvs_ins_hist, self.rvs_ins_sketch)):
+            hist_file = open(prefix + name + '_ins_hist.tsv', 'wt')
+            hist_file.write('bin\t' + '\t'.join(str(e) for e in self.ins_edges) + '\n')
+            for i, row in enumerate(hist):
+                hist_file.write(str(self.bins.start + i * self.bins.size) + '\t' + '\t'.join(str(c) for c in row) + '\n')
+            hist_file.close()
+            if sketch is not None:
+                sketch.print_quantiles(open(prefix + name + '_ins_q.tsv', 'wt'), self.bins)
+
+
+    # scale counts from downsampled reads back up, insert size histograms are plotted as proportions so are left
+    def scale(self, factor):
+        self.aln_stats = np.rint(self.aln_stats * factor).astype(np.intc)
+        self.depth_stats.depths = np.rint(self.depth_stats.depths * factor).astype(np.intc)
+
+    # add a block of reads (SamReads) to the depths, insert size histograms and alignment stats
+    def process_reads(self, reads):
+        valid, first, first_bp, last, last_bp = self.bins.get_bins_coverage(reads.left, reads.right)
+        rvs = (reads.flag & SamEntry.read_reverse) != 0
+        mate_rvs = (reads.flag & SamEntry.mate_reverse) != 0
+        orphaned = (reads.flag & SamEntry.mate_unmapped) != 0
+        diffmol = ~orphaned & reads.diffmol
+        samestrand = ~orphaned & ~diffmol & (rvs == mate_rvs)
+        inverted = ~orphaned & ~diffmol & ~samestrand & np.where(rvs, reads.tlen > 0, reads.tlen < 0)
+        proper = ~orphaned & ~diffmol & ~samestrand & ~inverted
+
+        # depths
+        low_q = reads.mapq <= self.mapQT
+        for j, sel in ((DepthStats.TOTAL, valid), (DepthStats.MAPQ0, valid & low_q & (reads.mapq == 0)),
+                       (DepthStats.MAPQLTT, valid & low_q & (reads.mapq != 0))):
+            self.add_to_depths(first[sel], first_bp[sel], last[sel], last_bp[sel], j)
+
+        # insert sizes of correctly oriented pairs, reads whose insert falls outside the bins are not counted further
+        ins = valid & proper & (reads.tlen != 0) & (reads.mapq > self.mapQT)
+        counted = valid.copy()
+        for is_rvs, hist, sketch in ((False, self.fwd_ins_hist, self.fwd_ins_sketch),
+                                     (True, self.rvs_ins_hist, self.rvs_ins_sketch)):
+            sel = ins & (rvs == is_rvs)
+            if is_rvs:
+                pos = reads.right
+                size = -1 * reads.tlen
             else:
-                depth_cols.append(DepthStats.MAPQLTT)
-        self.add_to_depth(cov, depth_cols)
-
-        aln_cols = [AlignStats.READS]
-        if (sam_entry.flag & SamEntry.secondary):
-            aln_cols.append(AlignStats.SECONDARY)
-        if (sam_entry.flag & SamEntry.supplementary):
-            aln_cols.append(AlignStats.SUPPLEMENTARY)
-        if sam_entry.get_num_clipped() >= self.clip_thresh:
-            aln_cols.append(AlignStats.CLIPPED)
-        if sam_entry.has_unmapped_mate():
-            aln_cols.append(AlignStats.ORPHANED)
+                pos = reads.left
+                size = reads.tlen
+            ins_valid, ins_first, x, ins_last, y = self.bins.get_bins_coverage(pos, pos)
+            counted &= ~(sel & ~ins_valid)
+            sel &= ins_valid
+            if is_rvs:
+                ins_bin = ins_last[sel]
+            else:
+                ins_bin = ins_first[sel]
+            cols = np.maximum(np.searchsorted(self.ins_edges, size[sel], side='right') - 1, 0)
+            np.add.at(hist, (ins_bin, cols), 1)
+            if sketch is not None:
+                for b, v in zip(ins_bin, size[sel]):
+                    sketch.add(b, v)
+
+        # alignment stats
+        for j, sel in ((AlignStats.READS, counted),
+                       (AlignStats.SECONDARY, counted & ((reads.flag & SamEntry.secondary) != 0)),
+                       (AlignStats.SUPPLEMENTARY, counted & ((reads.flag & SamEntry.supplementary) != 0)),
+                       (AlignStats.CLIPPED, counted & (reads.clipped >= self.clip_thresh)),
+                       (AlignStats.ORPHANED, counted & orphaned),
+                       (AlignStats.DIFFMOL, counted & diffmol),
+                       (AlignStats.SAMESTRAND, counted & samestrand),
+                       (AlignStats.INVERTED, counted & inverted)):
+            change = np.bincount(first[sel], minlength=self.bins.num + 1) - \
+                np.bincount(last[sel] + 1, minlength=self.bins.num + 1)
+            self.aln_stats[:, j] += np.cumsum(change)[:self.bins.num].astype(np.intc)
+
+    # add the coverage of reads to one column of the depths, partial coverage of their first and last bins
+    def add_to_depths(self, first, first_bp, last, last_bp, col):
+        num = self.bins.num
+        depths = np.bincount(first, weights=first_bp, minlength=num) + np.bincount(last, weights=last_bp, minlength=num)
+        # bins fully covered between the first and last
+        span = last > first
+        change = np.bincount(first[span] + 1, minlength=num + 1) - np.bincount(last[span], minlength=num + 1)
+        depths += np.cumsum(change)[:num] * self.depth_stats.bins.size
+        self.depth_stats.depths[:, col] += depths.astype(self.depth_stats.depths.dtype)
+
+
+# fixed size uniform sample of the values of each bin, from which quantiles are estimated
+# deterministic for a given sequence of values
+class QuantileSketch:
+    quantiles = [5, 25, 50, 75, 95]
+
+    def __init__(self, num_bins, size):
+        self.size = size
+        self.values = np.zeros((num_bins, size), dtype=np.int32)
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.rand = np.random.RandomState(0)
+
+    def add(self, bin, value):
+        n = self.counts[bin]
+        if n < self.size:
+            self.values[bin, n] = value
         else:
-            if sam_entry.mate_diff_molecule:
-                aln_cols.append(AlignStats.DIFFMOL)
-            elif sam_entry.mate_same_strand():
-                aln_cols.append(AlignStats.SAMESTRAND)
-            elif sam_entry.is_inverted():
-                aln_cols.append(AlignStats.INVERTED)
+            j = self.rand.randint(0, n + 1)
+            if j < self.size:
+                self.values[bin, j] = value
+        self.counts[bin] += 1
+
+    def get_quantiles(self, bin):
+        n = min(self.counts[bin], self.size)
+        if n == 0:
+            return None
+        return np.percentile(self.values[bin, :n], QuantileSketch.quantiles)
+
+    def print_quantiles(self, file, bins):
+        file.write('bin\t' + '\t'.join('q{}'.format(q) for q in QuantileSketch.quantiles) + '\n')
+        for i in range(bins.num):
+            q = self.get_quantiles(i)
+            if q is None:
+                values = ['NA'] * len(QuantileSketch.quantiles)
             else:
-                # correctly oriented pair reads
-                # filter low mapQ reads as these give spurious mapping distances
-                if not sam_entry.tlen == 0 and sam_entry.mapQ > self.mapQT:
-                    # pairs are mapped correctly, so add to insert sizes
-                    if sam_entry.is_rvs():
-                        ins_cov = self.bins.get_bin_coverage(sam_entry.right, sam_entry.right)
-                        if ins_cov is None:
-                            return
-                        self.rvs_inserts[ins_cov[1][0]].append(-1 * sam_entry.tlen)
-                    else:
-                        ins_cov = self.bins.get_bin_coverage(sam_entry.left, sam_entry.left)
-                        if ins_cov is None:
-                            return
-                        self.fwd_inserts[ins_cov[0][0]].append(sam_entry.tlen)
-        self.add_to_aln_stats(cov, aln_cols)
+                values = [str(v) for v in q]
+            file.write(str(bins.start + i * bins.size) + '\t' + '\t'.join(values) + '\n')
+        file.close()
 
 
 class SAMtools:
+    # checked on first use, the version is cached between runs
     @staticmethod
-    def check_installation():
-        cmd = ['samtools', '--version-only']
-        try:
-            subprocess.check_output(cmd, universal_newlines=True)
-        except OSError:
-            print('Error: could not run samtools. Are you sure it is installed?')
-            exit(1)
+    def check_installation(samtools='samtools'):
+        return Tools.check(samtools)
 
     @staticmethod
     def view(sam, region, include_flag=None, exclude_flag=
-            (SamEntry.duplicate + SamEntry.fails_QC + SamEntry.read_unmapped), samtools='samtools', verbose=True):
+            (SamEntry.duplicate + SamEntry.fails_QC + SamEntry.read_unmapped), samtools='samtools', verbose=True,
+             subsample=None, binary=False):
+        SAMtools.check_installation(samtools)
         cmd = [samtools, 'view']
+        if subsample is not None:
+            # samtools keeps reads by a hash of their name, seed 0
+            cmd.append('-s')
+            cmd.append('{:.6f}'.format(max(subsample, 0.000001)))
         if include_flag:
             cmd.append('-f')
             cmd.append(str(include_flag))
@@ -361,61 +606,84 @@ class SAMtools:
         cmd.append(region)
         if verbose:
             print(' '.join(cmd) + '\n')
-        p = subprocess.Popen(cmd, bufsize=1024, stdout=PIPE, universal_newlines=True)
+        Timer.count('subprocesses')
+        if binary:
+            # raw bytes for SamReads to parse in bulk
+            p = subprocess.Popen(cmd, bufsize=-1, stdout=PIPE)
+        else:
+            p = subprocess.Popen(cmd, bufsize=1024, stdout=PIPE, universal_newlines=True)
         if p.poll():
-            print("Error code %d from command:\n%s\n" % (' '.join(cmd) + '\n'))
-            exit(1)
+            raise SVPVError("exit code %d from command:\n%s\n" % (p.returncode, ' '.join(cmd)))
         return p
 
+    # number of reads in region that would be returned by view
+    @staticmethod
+    def count(sam, region, exclude_flag=(SamEntry.duplicate + SamEntry.fails_QC + SamEntry.read_unmapped),
+              samtools='samtools'):
+        SAMtools.check_installation(samtools)
+        cmd = [samtools, 'view', '-c', '-F', str(exclude_flag), sam, region]
+        Timer.count('subprocesses')
+        try:
+            return int(subprocess.check_output(cmd, universal_newlines=True).strip())
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            raise SVPVError("could not count reads with command:\n%s\n" % ' '.join(cmd))
+
     @staticmethod
     def faidx(fasta, region, samtools='samtools', verbose=False):
+        SAMtools.check_installation(samtools)
         cmd = [samtools, 'faidx', fasta, region]
         if verbose:
             print(' '.join(cmd) + '\n')
+        Timer.count('subprocesses')
         p = subprocess.Popen(cmd, bufsize=1024, stdout=PIPE, universal_newlines=True)
         if p.poll():
-            print("Error code %d from command:\n%s\n" % (' '.join(cmd) + '\n'))
-            exit(1)
+            raise SVPVError("exit code %d from command:\n%s\n" % (p.returncode, ' '.join(cmd)))
         return p
 
     @staticmethod
     def bedcov(num_bins, bin_size, bed, bam, min_Q=30, verbose=True):
+        SAMtools.check_installation()
         cmd = ['samtools', 'bedcov', '-Q', str(min_Q), bed, bam]
         if verbose:
             print(' '.join(cmd) + '\n')
-        p = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE, universal_newlines=True)
-        data = np.zeros((num_bins,))
-        bin = 0
-        bin_start = None
-        line = p.stdout.readline()
-        values = []
-
-        while line:
-            try:
-                chrom, start, end, cov = line.split()
-            except ValueError:
-                print('unexpected number of fields in samtools bedcov output\n')
-                break
-            line = p.stdout.readline()
-            if bin_start is None:
-                bin_start = int(start)
-                values = [int(cov) / (int(end) - int(start) + 1)]
-            else:
-                if int(start) - bin_start < bin_size:
-                    values.append(int(cov) / (int(end) - int(start) + 1))
-                else:
-                    data[bin] = np.mean(values)
-                    bin_start = int(start)
-                    values = [int(cov) / (int(end) - int(start) + 1)]
-                    bin += 1
-                    if bin >= num_bins:
-                        print('Error: exceeded allocation for this region')
-                        break
-        data[bin] = np.mean(values)
-        if bin + 1 != num_bins:
-            print('Error: allocation for this region not filled')
-            print('{} of {} bins'.format(bin + 1, num_bins))
-        return data
+        Timer.count('subprocesses')
+        p = subprocess.Popen(cmd, bufsize=-1, stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode:
+            raise SVPVError("exit code %d from command:\n%s\n" % (p.returncode, ' '.join(cmd)))
+        fields = out.split()
+        num_rows = out.count(b'\n')
+        if len(fields) != 4 * num_rows:
+            raise BinCountError('unexpected number of fields in samtools bedcov output', num_bins, None, bam)
+        if not num_rows:
+            raise BinCountError('no samtools bedcov output', num_bins, 0, bam)
+        rows = np.array(fields).reshape((num_rows, 4))
+        start = rows[:, 1].astype(np.int64)
+        cov = rows[:, 3].astype(np.float64)
+        values = cov / (rows[:, 2].astype(np.int64) - start + 1)
+        # rows starting within bin_size of the first row of a bin are averaged into that bin
+        group = (start - start[0]) // bin_size
+        firsts = np.concatenate(([0], np.flatnonzero(np.diff(group)) + 1))
+        if len(firsts) != num_bins:
+            raise BinCountError('samtools bedcov rows do not fill the bins', num_bins, len(firsts), bam)
+        counts = np.diff(np.append(firsts, num_rows))
+        return np.add.reduceat(values, firsts) / counts
+
+    # returns list of (chrom, length) from the header of sam
+    @staticmethod
+    def get_chrom_lengths(sam, samtools='samtools'):
+        SAMtools.check_installation(samtools)
+        cmd = [samtools, 'view', '-H', sam]
+        try:
+            header = subprocess.check_output(cmd, universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            raise SVPVError("could not read header of {}\n".format(sam))
+        chroms = []
+        for line in header.split('\n'):
+            if line.startswith('@SQ'):
+                tags = dict(f.split(':', 1) for f in line.split('\t')[1:] if ':' in f)
+                chroms.append((tags['SN'], int(tags['LN'])))
+        return chroms
 
     @staticmethod
     def get_GC(fasta, region, verbose=False):
@@ -434,3 +702,283 @@ class SAMtools:
         if AT + GC == 0:
             return 0
         return GC / (AT + GC)
+
+
+# baseline of a sequencing library, estimated from reads sampled across the genome and cached next to the alignment file
+# insert sizes are from correctly oriented pairs
+class LibraryStats:
+    cols = ['reads', 'read_len', 'ins_median', 'ins_mad']
+    num_regions = 50
+    region_size = 20000
+    max_reads = 2000
+    # primary, mapped, non duplicate, passing QC
+    exclude_flag = SamEntry.read_unmapped + SamEntry.secondary + SamEntry.fails_QC + SamEntry.duplicate + \
+                   SamEntry.supplementary
+    # loaded baselines by bam path
+    loaded = {}
+
+    def __init__(self):
+        self.reads = 0
+        self.read_len = None
+        self.ins_median = None
+        self.ins_mad = None
+
+    @staticmethod
+    def sidecar_path(bam):
+        return bam + '.svpv_lib.tsv'
+
+    # returns the baseline of bam, from its sidecar if that is newer than bam, otherwise sampled and cached
+    @staticmethod
+    def get(bam, mapq_thresh=30):
+        if bam in LibraryStats.loaded:
+            return LibraryStats.loaded[bam]
+        lib = LibraryStats.read(bam)
+        if lib is None:
+            lib = LibraryStats.sample(bam, mapq_thresh=mapq_thresh)
+            try:
+                lib.write(LibraryStats.sidecar_path(bam), bam)
+            except (IOError, OSError):
+                print('Warning: could not write library baseline for {}\n'.format(bam))
+        LibraryStats.loaded[bam] = lib
+        return lib
+
+    @staticmethod
+    def read(bam):
+        path = LibraryStats.sidecar_path(bam)
+        if not os.path.isfile(path):
+            return None
+        lines = open(path).read().split('\n')
+        try:
+            values = dict(zip(lines[0].split('\t'), lines[1].split('\t')))
+            st = os.stat(bam)
+            if values['bam_size'] != str(st.st_size) or values['bam_mtime'] != str(int(st.st_mtime)):
+                return None
+            lib = LibraryStats()
+            for c in LibraryStats.cols:
+                if values[c] != 'NA':
+                    setattr(lib, c, float(values[c]))
+        except (IndexError, KeyError, ValueError):
+            return None
+        return lib
+
+    def write(self, path, bam=None):
+        cols = list(LibraryStats.cols)
+        values = ['NA' if getattr(self, c) is None else str(getattr(self, c)) for c in cols]
+        if bam:
+            st = os.stat(bam)
+            cols.extend(['bam_size', 'bam_mtime'])
+            values.extend([str(st.st_size), str(int(st.st_mtime))])
+        out = open(path, 'wt')
+        out.write('\t'.join(cols) + '\n')
+        out.write('\t'.join(values) + '\n')
+        out.close()
+
+    # sample reads from regions evenly spaced across the chromosomes of bam
+    @staticmethod
+    def sample(bam, mapq_thresh=30):
+        chroms = [c for c in SAMtools.get_chrom_lengths(bam) if c[1] > LibraryStats.region_size]
+        lib = LibraryStats()
+        genome = sum(c[1] for c in chroms)
+        if not genome:
+            return lib
+        step = genome // LibraryStats.num_regions
+        read_lens = []
+        inserts = []
+        reads = 0
+        chrom_idx = 0
+        chrom_start = 0
+        for k in range(LibraryStats.num_regions):
+            pos = k * step + step // 2
+            while pos >= chrom_start + chroms[chrom_idx][1]:
+                chrom_start += chroms[chrom_idx][1]
+                chrom_idx += 1
+            chrom, length = chroms[chrom_idx]
+            start = min(pos - chrom_start, length - LibraryStats.region_size)
+            region = '{}:{}-{}'.format(chrom, start + 1, start + LibraryStats.region_size)
+            p = SAMtools.view(bam, region, exclude_flag=LibraryStats.exclude_flag, verbose=False)
+            n = 0
+            for line in p.stdout:
+                fields = line.split('\t')
+                if len(fields) < 10:
+                    continue
+                entry = SamEntry(fields[1], fields[3], fields[4], fields[5], fields[6], fields[8])
+                if fields[9] != '*':
+                    read_lens.append(len(fields[9]))
+                reads += 1
+                proper = not (entry.has_unmapped_mate() or entry.mate_diff_molecule or entry.mate_same_strand() or
+                              entry.is_inverted())
+                if proper and entry.tlen > 0 and entry.mapQ > mapq_thresh:
+                    inserts.append(entry.tlen)
+                n += 1
+                if n >= LibraryStats.max_reads:
+                    break
+            p.stdout.close()
+            p.wait()
+        lib.reads = reads
+        if read_lens:
+            lib.read_len = int(np.median(read_lens))
+        if inserts:
+            lib.ins_median = float(np.median(inserts))
+            lib.ins_mad = float(np.median(np.abs(np.array(inserts) - lib.ins_median)))
+        return lib
+
+
+# multi-resolution coverage index of an alignment file, written next to it by 'SVPV index'
+# for each chromosome and tile size, the number of aligned bases in each tile from all reads,
+# reads with mapQ >= 1 and reads with mapQ >= T, counted the same way as samtools bedcov
+class CoverageIndex:
+    tile_sizes = (100, 1000, 10000)
+    # bedcov default excluded flags: unmapped, secondary, QC fail, duplicate
+    exclude_flag = SamEntry.read_unmapped + SamEntry.secondary + SamEntry.fails_QC + SamEntry.duplicate
+    cigar_ref_len = re.compile('([0-9]+)[MDN=X]')
+    # loaded indexes by bam path, None if a bam has no usable index
+    loaded = {}
+
+    def __init__(self, bam):
+        self.bam = bam
+        self.mapq_thresh = None
+        # dict by (chrom, tile size) of (offset, number of tiles) in the data file
+        self.blocks = {}
+        self.data = None
+
+    @staticmethod
+    def data_path(bam):
+        return bam + '.svpv_cov'
+
+    @staticmethod
+    def idx_path(bam):
+        return bam + '.svpv_cov.idx'
+
+    # returns the index of bam, or None if it has not been built or is older than the bam
+    @staticmethod
+    def load(bam):
+        if bam in CoverageIndex.loaded:
+            return CoverageIndex.loaded[bam]
+        CoverageIndex.loaded[bam] = None
+        if not (os.path.isfile(CoverageIndex.idx_path(bam)) and os.path.isfile(CoverageIndex.data_path(bam))):
+            return None
+        index = CoverageIndex(bam)
+        st = os.stat(bam)
+        for line in open(CoverageIndex.idx_path(bam)):
+            fields = line.rstrip('\n').split('\t')
+            if line[0] == '#':
+                if fields[0] == '#bam' and fields[1:] != [str(st.st_size), str(int(st.st_mtime))]:
+                    print('Warning: coverage index of {} is out of date, not using it\n'.format(bam))
+                    return None
+                elif fields[0] == '#mapq_thresh':
+                    index.mapq_thresh = int(fields[1])
+            else:
+                chrom, tile_size, offset, num = fields
+                index.blocks[(chrom, int(tile_size))] = (int(offset), int(num))
+        index.data = np.memmap(CoverageIndex.data_path(bam), dtype=np.uint32, mode='r')
+        CoverageIndex.loaded[bam] = index
+        return index
+
+    # returns the (num bins x 3) aligned base counts of bins (total, mapQ >= 1, mapQ >= T), interpolated from
+    # the largest tiles no larger than the bins, or None if the index can not answer the query
+    def get_counts(self, bins, mapq_thresh):
+        if mapq_thresh != self.mapq_thresh:
+            return None
+        tile_size = None
+        for size in CoverageIndex.tile_sizes:
+            if size <= bins.size and (bins.chrom, size) in self.blocks:
+                tile_size = size
+        if tile_size is None:
+            return None
+        offset, num = self.blocks[(bins.chrom, tile_size)]
+        tiles = np.asarray(self.data[offset:offset + 3 * num], dtype=np.float64).reshape((num, 3))
+        # cumulative count at tile boundaries, linear within tiles
+        cum = np.zeros((num + 1, 3))
+        cum[1:] = np.cumsum(tiles, axis=0)
+        edges = bins.start + np.arange(bins.num + 1) * bins.size
+        counts = np.zeros((bins.num, 3))
+        for j in range(3):
+            at_edges = np.interp(edges, np.arange(num + 1) * tile_size, cum[:, j])
+            counts[:, j] = np.diff(at_edges)
+        return counts
+
+    # scan each chromosome of bam once and write its index
+    @staticmethod
+    def build(bam, mapq_thresh=30, procs=1):
+        chroms = SAMtools.get_chrom_lengths(bam)
+        jobs = [(bam, chrom, length, mapq_thresh) for chrom, length in chroms]
+        if procs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(procs)
+            results = pool.imap(index_chrom, jobs)
+        else:
+            pool = None
+            results = map(index_chrom, jobs)
+        data = open(CoverageIndex.data_path(bam), 'wb')
+        idx = open(CoverageIndex.idx_path(bam), 'wt')
+        st = os.stat(bam)
+        idx.write('#bam\t{}\t{}\n'.format(st.st_size, int(st.st_mtime)))
+        idx.write('#mapq_thresh\t{}\n'.format(mapq_thresh))
+        offset = 0
+        for job, levels in zip(jobs, results):
+            chrom = job[1]
+            for tile_size, tiles in zip(CoverageIndex.tile_sizes, levels):
+                idx.write('{}\t{}\t{}\t{}\n'.format(chrom, tile_size, offset, tiles.shape[0]))
+                data.write(tiles.astype(np.uint32).tobytes())
+                offset += tiles.size
+        data.close()
+        idx.close()
+        if pool is not None:
+            pool.close()
+        CoverageIndex.loaded.pop(bam, None)
+        print('indexed coverage of {}\n'.format(bam))
+
+
+# count aligned bases per smallest tile of one chromosome and sum them into the larger tiles
+# module level so that it can be run by a process pool
+def index_chrom(job):
+    bam, chrom, length, mapq_thresh = job
+    size = CoverageIndex.tile_sizes[0]
+    num = length // size + 1
+    counts = np.zeros((num, 3), dtype=np.float64)
+    # count of tiles fully covered by reads, as a difference array
+    full = np.zeros((num + 1, 3), dtype=np.float64)
+
+    def add(starts, ends, mapqs):
+        s = np.array(starts, dtype=np.int64)
+        e = np.minimum(np.array(ends, dtype=np.int64), length)
+        q = np.array(mapqs, dtype=np.int64)
+        keep = e > s
+        s, e, q = s[keep], e[keep], q[keep]
+        first = s // size
+        last = (e - 1) // size
+        same = first == last
+        for j, sel in enumerate((np.ones(len(q), dtype=bool), q >= 1, q >= mapq_thresh)):
+            one = sel & same
+            counts[:, j] += np.bincount(first[one], weights=(e - s)[one], minlength=num)
+            span = sel & ~same
+            counts[:, j] += np.bincount(first[span], weights=((first + 1) * size - s)[span], minlength=num)
+            counts[:, j] += np.bincount(last[span], weights=(e - last * size)[span], minlength=num)
+            full[:, j] += np.bincount(first[span] + 1, minlength=num + 1)
+            full[:, j] -= np.bincount(last[span], minlength=num + 1)
+
+    p = SAMtools.view(bam, chrom, exclude_flag=CoverageIndex.exclude_flag, verbose=False)
+    starts, ends, mapqs = [], [], []
+    for line in p.stdout:
+        fields = line.split('\t', 6)
+        if len(fields) < 7:
+            continue
+        start = int(fields[3]) - 1
+        starts.append(start)
+        ends.append(start + sum(int(n) for n in CoverageIndex.cigar_ref_len.findall(fields[5])))
+        mapqs.append(int(fields[4]))
+        if len(starts) >= 1000000:
+            add(starts, ends, mapqs)
+            starts, ends, mapqs = [], [], []
+    if starts:
+        add(starts, ends, mapqs)
+    p.wait()
+    counts += np.cumsum(full, axis=0)[:num] * size
+
+    levels = [counts]
+    for tile_size in CoverageIndex.tile_sizes[1:]:
+        factor = tile_size // size
+        padded = np.zeros((-(-num // factor) * factor, 3))
+        padded[:num] = counts
+        levels.append(padded.reshape((-1, factor, 3)).sum(axis=1))
+    return levels
@@ -0,0 +1,306 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# long running plot service, holding the loaded call sets and gene annotations of a Session in memory
+# GET requests, answered with json unless noted:
+#   /status                 samples, vcfs and cache sizes
+#   /svs?filters            SVs of the primary vcf, filters as for Session.filter:
+#                           chrom, svtype, min_len, max_len, af, af_gt=1, gts=s1:0/1|1/1;s2:0/0, sv=chrom:pos,...,
+#                           rgi=1, exonic=1, genes=A,B and offset/limit to page through them
+#   /plot?sv=chrom:pos      plot of an SV (or region=chrom:start-end) for samples=s1,s2 (default all),
+#                           format=pdf|png, returns the path of the figure or with bytes=1 the figure itself
+#   /stats?sv=chrom:pos     binned statistics of an SV (or region) for samples, as returned by Session.stats
+from __future__ import print_function
+import os
+import copy
+import json
+import threading
+from collections import OrderedDict
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+    from queue import Queue
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import UnixStreamServer
+    from urlparse import urlparse, parse_qs
+    from Queue import Queue
+from .plot import Plot
+from .sam import LibraryStats
+from .errors import SVPVError, UsageError
+
+
+# an SV asked for that is not in the session
+class NotFound(SVPVError):
+    pass
+
+
+# least recently used cache, safe to share between the worker threads
+class LRUCache:
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# answers the requests from the session, figures and stats of recent requests are cached
+class PlotService:
+    def __init__(self, session, cache_size=256):
+        self.session = session
+        self.figures = LRUCache(cache_size)
+        self.stats_cache = LRUCache(cache_size)
+        # requests for the same SV or region write to the same plot data directory so are made one at a time
+        self.lock = threading.Lock()
+        self.sv_locks = {}
+
+    def status(self):
+        run = self.session.par.run
+        return {'version': self.session.par.ver, 'samples': run.samples,
+                'vcfs': [v.name for v in [run.vcf] + run.alt_vcfs], 'svs': run.vcf.count,
+                'out_dir': run.out_dir, 'figures': len(self.figures), 'stats': len(self.stats_cache)}
+
+    def list_svs(self, query):
+        gts = None
+        if 'gts' in query:
+            gts = {}
+            for entry in query['gts'].split(';'):
+                sample, accepted = entry.split(':')
+                gts[sample] = accepted.split('|')
+        svs = self.session.filter(chrom=query.get('chrom'), svtype=query.get('svtype'),
+                                  min_len=get_int(query, 'min_len'), max_len=get_int(query, 'max_len'),
+                                  af=query.get('af'), af_lt=not get_bool(query, 'af_gt'), gts=gts,
+                                  sv_ids=query['sv'].split(',') if 'sv' in query else None,
+                                  ref_gene=get_bool(query, 'rgi'), exonic=get_bool(query, 'exonic'),
+                                  genes=query['genes'].split(',') if 'genes' in query else None)
+        offset = get_int(query, 'offset') or 0
+        limit = get_int(query, 'limit')
+        page = svs[offset:] if limit is None else svs[offset:offset + limit]
+        samples = self.session.par.run.vcf.samples
+        return {'total': len(svs), 'offset': offset,
+                'svs': [{'id': '{}:{}'.format(sv.chrom, sv.pos), 'chrom': sv.chrom, 'pos': sv.pos, 'end': sv.end,
+                         'svtype': sv.svtype, 'len': sv.len, 'AF': sv.AF,
+                         'GTs': dict(zip(samples, sv.GTs)) if sv.GTs else {}} for sv in page]}
+
+    # the SV of an sv=chrom:pos (and optional svtype) or region=chrom:start-end query
+    def get_sv(self, query):
+        try:
+            if 'sv' in query:
+                chrom, pos = query['sv'].rsplit(':', 1)
+                pos = int(pos)
+            elif 'region' in query:
+                chrom, region = query['region'].rsplit(':', 1)
+                start, end = region.split('-')
+                return self.session.get_sv(chrom, int(start), int(end))
+            else:
+                raise ValueError
+        except ValueError:
+            raise UsageError('expected sv=chrom:pos or region=chrom:start-end')
+        try:
+            return self.session.get_sv(chrom, pos, svtype=query.get('svtype'))
+        except SVPVError as e:
+            raise NotFound(str(e))
+
+    def get_samples(self, query):
+        if 'samples' in query:
+            return self.session.check_samples(query['samples'].split(','))
+        return self.session.samples
+
+    def sv_lock(self, sv):
+        key = (sv.chrom, sv.pos, sv.end, sv.svtype)
+        with self.lock:
+            if key not in self.sv_locks:
+                self.sv_locks[key] = threading.Lock()
+            return self.sv_locks[key]
+
+    # path of the figure of an SV for the samples
+    def plot(self, query):
+        sv = self.get_sv(query)
+        samples = self.get_samples(query)
+        fmt = query.get('format', 'pdf')
+        if fmt not in ('pdf', 'png'):
+            raise UsageError('invalid format {}, expected pdf or png'.format(fmt))
+        # plot parameters are copied so that requests for different formats do not interfere
+        par = copy.copy(self.session.par)
+        par.plot = copy.copy(par.plot)
+        par.plot.thumbs = fmt == 'png'
+        if len(samples) > par.plot.grouping:
+            raise UsageError('at most {} samples per plot'.format(par.plot.grouping))
+        key = (sv.chrom, sv.pos, sv.end, sv.svtype, tuple(samples), tuple(par.plot.get_R_args()))
+        path = self.figures.get(key)
+        if path is not None and os.path.isfile(path):
+            return path
+        with self.sv_lock(sv):
+            path = Plot(sv, samples, par).plot_figure(group=len(samples))
+        if not os.path.isfile(path):
+            raise SVPVError('no figure created for {}:{}'.format(sv.chrom, sv.pos))
+        self.figures.put(key, path)
+        return path
+
+    def stats(self, query):
+        sv = self.get_sv(query)
+        samples = self.get_samples(query)
+        key = (sv.chrom, sv.pos, sv.end, sv.svtype, tuple(samples))
+        stats = self.stats_cache.get(key)
+        if stats is None:
+            stats = self.session.stats(sv, samples)
+            for s in stats:
+                lib = stats[s]['library']
+                stats[s]['library'] = dict((c, getattr(lib, c)) for c in LibraryStats.cols)
+                if stats[s]['depths'] is not None:
+                    starts, depths = stats[s]['depths']
+                    stats[s]['depths'] = {'starts': starts, 'depths': depths.tolist()}
+                for w in stats[s]['windows']:
+                    for k in ('depths', 'aln_stats', 'ins_edges', 'fwd_ins_hist', 'rvs_ins_hist'):
+                        w[k] = w[k].tolist()
+            self.stats_cache.put(key, stats)
+        return stats
+
+
+def get_int(query, name):
+    if name not in query:
+        return None
+    try:
+        return int(query[name])
+    except ValueError:
+        raise UsageError('invalid {}: {}'.format(name, query[name]))
+
+
+def get_bool(query, name):
+    return query.get(name, '0').lower() in ('1', 'true', 'yes')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        service = self.server.service
+        try:
+            if url.path == '/status':
+                self.send_json(service.status())
+            elif url.path == '/svs':
+                self.send_json(service.list_svs(query))
+            elif url.path == '/stats':
+                self.send_json(service.stats(query))
+            elif url.path == '/plot':
+                path = service.plot(query)
+                if get_bool(query, 'bytes'):
+                    self.send_file(path)
+                else:
+                    self.send_json({'path': path})
+            else:
+                self.send_json({'error': 'unknown request {}'.format(url.path)}, code=404)
+        except UsageError as e:
+            self.send_json({'error': str(e)}, code=400)
+        except NotFound as e:
+            self.send_json({'error': str(e)}, code=404)
+        except SVPVError as e:
+            self.send_json({'error': str(e)}, code=500)
+        except Exception as e:
+            # anything else failing a request (Rscript, samtools, bad values or the client going away) is answered
+            # rather than dropping the connection
+            self.log_error('%s failed: %r', url.path, e)
+            try:
+                self.send_json({'error': '{}: {}'.format(type(e).__name__, e)}, code=500)
+            except Exception:
+                pass
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path):
+        body = open(path, 'rb').read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png' if path.endswith('.png') else 'application/pdf')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Disposition', 'inline; filename="{}"'.format(os.path.basename(path)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # unix socket clients have no address
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+# requests are queued for a fixed number of worker threads rather than a thread each
+class WorkerPoolMixIn:
+    workers = 4
+
+    def start_workers(self):
+        self.requests = Queue(self.workers * 4)
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class PlotServer(WorkerPoolMixIn, HTTPServer):
+    pass
+
+
+class UnixPlotServer(WorkerPoolMixIn, UnixStreamServer):
+    pass
+
+
+# serve the session on host:port, or on a unix socket if socket_path is given, until interrupted
+def serve(session, host='127.0.0.1', port=8080, socket_path=None, workers=4, cache_size=256):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixPlotServer(socket_path, RequestHandler)
+        address = 'unix socket {}'.format(socket_path)
+    else:
+        server = PlotServer((host, port), RequestHandler)
+        address = 'http://{}:{}/'.format(host, server.server_address[1])
+    server.service = PlotService(session, cache_size=cache_size)
+    server.workers = workers
+    server.start_workers()
+    print('serving {} SVs of {} samples on {} with {} workers\n'.format(session.par.run.vcf.count,
+                                                                       len(session.samples), address, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,193 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# SVPV as a library, for use from scripts and notebooks rather than the command line
+# errors are raised as SVPVError (UsageError for missing or inconsistent arguments) instead of exiting
+from __future__ import print_function
+import tempfile
+from os.path import expanduser as expu
+from .params import ParamSet, FilterParams, check_file_exists
+from .vcf import VCFManager, SV
+from .refgene import RefgeneManager
+from .errors import SVPVError, UsageError
+
+
+# a set of SV calls and the alignments of their samples, with the VCFs and gene annotations loaded once
+# eg.
+#   s = Session('calls.vcf', {'NA12877': 'NA12877.bam', 'NA12878': 'NA12878.bam'}, ref_genes='refgene.txt')
+#   for sv in s.filter(svtype='DEL', min_len=1000):
+#       depths = s.stats(sv)['NA12877']['depths']
+#       s.render(sv)
+class Session:
+    # vcfs is a path, a list of paths or a {name: path} dict, the first is the primary vcf
+    # alignments is a {sample: alignment file} dict or a list of (sample, alignment file) pairs
+    # ref_vcf is a path or a (name, path) pair
+    # out_dir is where plot data and figures are written, a temporary directory if not given
+    # all=True keeps calls that are not present in any of the samples
+    # par is a ParamSet already set up from the command line, in which case the other arguments are not used
+    def __init__(self, vcfs=None, alignments=None, ref_vcf=None, ref_genes=None, fa=None, out_dir=None, rd_len=None,
+                 expansion=1, bkpt_win=5, num_bins=100, all=False, par=None):
+        if par is not None:
+            self.par = par
+            return
+        if vcfs is None or alignments is None:
+            raise UsageError('a session requires vcfs and alignments')
+        self.par = ParamSet()
+        run = self.par.run
+        if isinstance(vcfs, dict):
+            vcfs = sorted(vcfs.items())
+        elif not isinstance(vcfs, (list, tuple)):
+            vcfs = [vcfs]
+        for v in vcfs:
+            if isinstance(v, tuple):
+                name, path = v
+                check_file_exists(expu(path), message='vcf')
+                vcf = VCFManager(expu(path), name=name)
+            else:
+                check_file_exists(expu(v), message='vcf')
+                vcf = VCFManager(expu(v))
+            if run.vcf is None:
+                run.vcf = vcf
+            else:
+                run.alt_vcfs.append(vcf)
+
+        if isinstance(alignments, dict):
+            alignments = list(alignments.items())
+        for sample, bam in alignments:
+            run.samples.append(sample)
+            run.bams.append(expu(bam))
+
+        if ref_vcf is not None:
+            if isinstance(ref_vcf, tuple):
+                name, path = ref_vcf
+            else:
+                name, path = 'reference', ref_vcf
+            check_file_exists(expu(path), message='vcf')
+            run.ref_vcf = VCFManager(expu(path), name=name, db_mode=True)
+        if ref_genes is not None:
+            check_file_exists(expu(ref_genes), message='refgene')
+            run.ref_genes = RefgeneManager(expu(ref_genes))
+            self.par.filter.ref_genes = run.ref_genes
+        if fa is not None:
+            check_file_exists(expu(fa), message='fasta')
+            run.fa = expu(fa)
+        if out_dir is None:
+            out_dir = tempfile.mkdtemp(prefix='svpv.')
+        run.out_dir = expu(out_dir)
+        run.expansion = expansion
+        run.bkpt_win = bkpt_win
+        run.num_bins = num_bins
+        run.all = all
+
+        run.check()
+        if rd_len is None:
+            run.set_rd_len(sample=False)
+        else:
+            run.rd_len = rd_len
+        if not run.all:
+            run.vcf.remove_absent_svs(run.samples)
+
+    @property
+    def samples(self):
+        return list(self.par.run.samples)
+
+    # SVs of the primary vcf passing the given filters, sorted by chrom and pos
+    # af is a threshold on allele frequency, af_lt chooses whether frequencies must be less or greater than it
+    # gts is a {sample: [accepted genotypes]} dict, sv_ids a list of 'chrom:pos' strings
+    # genes is a list of gene names to intersect with, it and ref_gene/exonic require ref_genes
+    def filter(self, chrom=None, svtype=None, min_len=None, max_len=None, af=None, af_lt=True, gts=None,
+               sv_ids=None, ref_gene=False, exonic=False, genes=None):
+        filter_par = FilterParams(self.par)
+        filter_par.ref_genes = self.par.run.ref_genes
+        if (ref_gene or exonic or genes) and filter_par.ref_genes is None:
+            raise UsageError('filtering by genes requires ref_genes')
+        filter_par.chrom = chrom
+        if svtype is not None:
+            if svtype.upper() not in SV.valid_SVs:
+                raise UsageError('invalid svtype {}'.format(svtype))
+            filter_par.svtype = svtype.upper()
+        filter_par.min_len = min_len
+        filter_par.max_len = max_len
+        if af is not None:
+            filter_par.AF_thresh = float(af)
+            filter_par.AF_thresh_is_LT = af_lt
+        if gts:
+            for sample in gts:
+                if self.par.run.vcf.get_sample_index(sample) is None:
+                    raise UsageError('sample {} not in {}'.format(sample, self.par.run.vcf.name))
+            filter_par.sample_GTs = dict(gts)
+        if sv_ids is not None:
+            filter_par.sv_ids = set(sv_ids)
+        filter_par.RG_intersection = ref_gene
+        filter_par.exonic = exonic
+        if genes:
+            filter_par.gene_list = [g.strip().upper() for g in genes]
+            filter_par.gene_list_intersection = True
+        return self.par.run.vcf.filter_svs(filter_par)
+
+    # the SV of the primary vcf at chrom:pos, or a region to show without a call if end is given
+    def get_sv(self, chrom, pos, end=None, svtype=None):
+        if end is not None:
+            return SV(chrom, pos, end, 'CUSTOM', '.', '.', '.')
+        svs = self.par.run.vcf.SVs.get(chrom, {}).get(int(pos), [])
+        if svtype is not None:
+            svs = [sv for sv in svs if sv.svtype == svtype]
+        if not svs:
+            raise SVPVError('no SV at {}:{} in {}'.format(chrom, pos, self.par.run.vcf.name))
+        return svs[0]
+
+    def check_samples(self, samples):
+        if samples is None:
+            return self.samples
+        for s in samples:
+            if s not in self.par.run.samples:
+                raise UsageError('sample {} not in session'.format(s))
+        return list(samples)
+
+    # the binned statistics SVPV plots for an SV, as a dict by sample of:
+    #   'library': LibraryStats baseline of the alignment
+    #   'depths': (start of each bin, depth by bin and DepthStats.depth_cols) over the region, if there is one
+    #   'windows': list of dicts of the read statistics of each region or breakpoint window with:
+    #       'region', 'starts', 'depths', 'aln_stats' (by bin and AlignStats.aln_stats_cols), 'ins_edges',
+    #       'fwd_ins_hist' and 'rvs_ins_hist' (by bin and insert size edge)
+    def stats(self, sv, samples=None):
+        # numpy and the plotting modules are imported on first use, importing svpv stays fast
+        from .sam import SamStats
+        from .plot import Plot
+        samples = self.check_samples(samples)
+        bams = self.par.run.get_bams(samples)
+        region_bins, bkpt_bins = Plot.get_bins(sv, self.par)
+        if region_bins and bkpt_bins:
+            sam_stats = SamStats.get_sam_stats(bams, bkpt_bins, depth_bins=region_bins)
+        elif bkpt_bins:
+            sam_stats = SamStats.get_sam_stats(bams, bkpt_bins)
+        else:
+            sam_stats = SamStats.get_sam_stats(bams, [region_bins])
+        stats = {}
+        for s, ss in zip(samples, sam_stats):
+            stats[s] = {'library': ss.library, 'depths': None, 'windows': []}
+            if region_bins:
+                depth = ss.depth
+                stats[s]['depths'] = (Session.bin_starts(depth.bins), depth.depths)
+            for aln in ss.align:
+                stats[s]['windows'].append({'region': aln.bins.region, 'starts': Session.bin_starts(aln.bins),
+                                            'depths': aln.depth_stats.depths, 'aln_stats': aln.aln_stats,
+                                            'ins_edges': aln.ins_edges, 'fwd_ins_hist': aln.fwd_ins_hist,
+                                            'rvs_ins_hist': aln.rvs_ins_hist})
+        return stats
+
+    @staticmethod
+    def bin_starts(bins):
+        return [bins.start + i * bins.size for i in range(bins.num)]
+
+    # plot an SV for the samples (all of them by default) with Rscript, returns the path of the figure
+    # samples are split over several figures as set by par.plot.grouping, the last of them is returned
+    # plot options are the attributes of self.par.plot
+    def render(self, sv, samples=None, display=False):
+        from .plot import Plot
+        samples = self.check_samples(samples)
+        plot = Plot(sv, samples, self.par)
+        if display:
+            return plot.plot_figure(group=self.par.plot.grouping, display=self.par.run.display)
+        return plot.plot_figure(group=self.par.plot.grouping)
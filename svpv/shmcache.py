@@ -0,0 +1,210 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# shared memory cache of the decoded reads of (alignment, region), for the processes of a run on one machine
+# the columns SamReads keeps are stored in a segment per region, processes needing the reads of a region already
+# cached (or of a region inside one) attach to the segment instead of running samtools view again
+# the segments are listed in an sqlite index next to the work queue, with the number of processes attached to each
+# so that only segments no longer in use are evicted, the last process of the run to close the cache removes them
+from __future__ import print_function
+from __future__ import division
+import os
+import time
+import socket
+import sqlite3
+from hashlib import sha1
+import numpy as np
+from .errors import SVPVError
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+
+class ReadCache:
+    # columns of SamReads stored, widest first so that every column is aligned
+    cols = (('left', np.int64), ('right', np.int64), ('start', np.int64), ('tlen', np.int64), ('mapq', np.int64),
+            ('clipped', np.int64), ('flag', np.uint16), ('diffmol', np.bool_))
+    # seconds after which a segment still marked as attached is assumed to belong to a process that died
+    lease = 3600
+
+    def __init__(self, cache_dir, capacity):
+        if shared_memory is None:
+            raise SVPVError('the shared memory read cache requires python 3.8+')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # segments are only visible to processes on the same machine
+        self.path = os.path.join(cache_dir, 'svpv_shm.{}.db'.format(socket.gethostname()))
+        self.capacity = capacity
+        self.db = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, bam TEXT, chrom TEXT, '
+                        'start INTEGER, end INTEGER, fraction TEXT, name TEXT, rows INTEGER, nbytes INTEGER, '
+                        'refs INTEGER, used REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS procs (pid INTEGER PRIMARY KEY)')
+        self.db.execute('INSERT OR REPLACE INTO procs (pid) VALUES (?)', (os.getpid(),))
+        self.hits = 0
+        self.misses = 0
+
+    # byte offsets of the columns of a segment of rows reads, and its total size
+    @staticmethod
+    def layout(rows):
+        offsets = []
+        nbytes = 0
+        for name, dtype in ReadCache.cols:
+            offsets.append(nbytes)
+            nbytes += rows * np.dtype(dtype).itemsize
+        return offsets, max(nbytes, 1)
+
+    # shared memory segments are removed by the cache, not by the resource tracker when a process exits
+    @staticmethod
+    def open_segment(name, create=False, size=0):
+        try:
+            return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            return shm
+
+    # opened tracked as unlink stops the tracking
+    @staticmethod
+    def unlink_segment(name):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.close()
+            shm.unlink()
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def fraction_key(fraction):
+        return 'all' if fraction is None else '{:.6f}'.format(fraction)
+
+    # SharedReads of the reads of bam overlapping chrom:start-end, or None if no cached region contains it
+    def get(self, bam, chrom, start, end, fraction=None):
+        self.db.execute('BEGIN IMMEDIATE')
+        row = self.db.execute('SELECT key, name, rows, start, end FROM segments WHERE bam = ? AND chrom = ? AND '
+                              'fraction = ? AND start <= ? AND end >= ? ORDER BY end - start LIMIT 1',
+                              (bam, chrom, ReadCache.fraction_key(fraction), start, end)).fetchone()
+        if row is not None:
+            self.db.execute('UPDATE segments SET refs = refs + 1, used = ? WHERE key = ?', (time.time(), row[0]))
+        self.db.execute('COMMIT')
+        if row is None:
+            self.misses += 1
+            return None
+        key, name, rows, seg_start, seg_end = row
+        try:
+            shm = ReadCache.open_segment(name)
+        except (OSError, ValueError):
+            # removed outside of the cache
+            self.db.execute('DELETE FROM segments WHERE key = ?', (key,))
+            self.misses += 1
+            return None
+        self.hits += 1
+        reads = SharedReads(self, key, shm, rows)
+        if seg_start < start or seg_end > end:
+            reads.select(start, end)
+        return reads
+
+    def release(self, key):
+        self.db.execute('UPDATE segments SET refs = MAX(refs - 1, 0) WHERE key = ?', (key,))
+
+    # store the blocks of SamReads of bam overlapping chrom:start-end
+    # regions too large for the cache, or when every segment is in use, are not stored
+    def put(self, bam, chrom, start, end, fraction, blocks):
+        rows = sum(len(b) for b in blocks)
+        offsets, nbytes = ReadCache.layout(rows)
+        if nbytes > self.capacity:
+            return
+        fraction = ReadCache.fraction_key(fraction)
+        key = '\t'.join([bam, chrom, str(start), str(end), fraction])
+        name = 'svpv_{}_{}'.format(sha1(key.encode('utf-8')).hexdigest()[:12], os.getpid())
+        shm = ReadCache.open_segment(name, create=True, size=nbytes)
+        for (col, dtype), offset in zip(ReadCache.cols, offsets):
+            data = np.concatenate([np.asarray(getattr(b, col), dtype=dtype) for b in blocks]) if blocks \
+                else np.zeros(0, dtype=dtype)
+            shm.buf[offset:offset + data.nbytes] = data.tobytes()
+        shm.close()
+
+        self.db.execute('BEGIN IMMEDIATE')
+        stored = False
+        if self.evict(nbytes):
+            cur = self.db.execute('INSERT OR IGNORE INTO segments (key, bam, chrom, start, end, fraction, name, rows, '
+                                  'nbytes, refs, used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)',
+                                  (key, bam, chrom, start, end, fraction, name, rows, nbytes, time.time()))
+            # another process may have stored the same region first
+            stored = cur.rowcount > 0
+        self.db.execute('COMMIT')
+        if not stored:
+            ReadCache.unlink_segment(name)
+
+    # make room for nbytes by removing the least recently used segments not in use, within a transaction
+    # returns False if there is not enough room
+    def evict(self, nbytes):
+        used = self.db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM segments').fetchone()[0]
+        stale = time.time() - ReadCache.lease
+        for key, name, size in self.db.execute('SELECT key, name, nbytes FROM segments WHERE refs = 0 OR used < ? '
+                                               'ORDER BY used', (stale,)).fetchall():
+            if used + nbytes <= self.capacity:
+                break
+            ReadCache.unlink_segment(name)
+            self.db.execute('DELETE FROM segments WHERE key = ?', (key,))
+            used -= size
+        return used + nbytes <= self.capacity
+
+    # detach this process from the cache, the last process of the run removes all segments
+    def close(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.execute('DELETE FROM procs WHERE pid = ?', (os.getpid(),))
+        for (pid,) in self.db.execute('SELECT pid FROM procs').fetchall():
+            if not ReadCache.is_running(pid):
+                self.db.execute('DELETE FROM procs WHERE pid = ?', (pid,))
+        if self.db.execute('SELECT COUNT(*) FROM procs').fetchone()[0] == 0:
+            for (name,) in self.db.execute('SELECT name FROM segments').fetchall():
+                ReadCache.unlink_segment(name)
+            self.db.execute('DELETE FROM segments')
+        self.db.execute('COMMIT')
+        self.db.close()
+
+    @staticmethod
+    def is_running(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == 1
+        return True
+
+
+# reads of a cached region, with the same columns as SamReads as views of the shared segment
+class SharedReads:
+    def __init__(self, cache, key, shm, rows):
+        self.cache = cache
+        self.key = key
+        self.shm = shm
+        offsets, nbytes = ReadCache.layout(rows)
+        for (col, dtype), offset in zip(ReadCache.cols, offsets):
+            setattr(self, col, np.ndarray((rows,), dtype=dtype, buffer=shm.buf, offset=offset))
+
+    def __len__(self):
+        return len(self.flag)
+
+    # keep only the reads overlapping start-end as samtools view would, copying them out of the segment
+    def select(self, start, end):
+        # reference end of the alignment, from its left and right ends without soft clipping
+        aln_end = np.maximum(self.right - (self.left - self.start) - 1, self.start)
+        keep = (self.start <= end) & (aln_end >= start)
+        cols = dict((col, getattr(self, col)[keep]) for col, dtype in ReadCache.cols)
+        del aln_end, keep
+        self.release()
+        for col in cols:
+            setattr(self, col, cols[col])
+
+    # views of the segment are dropped before it is closed
+    def release(self):
+        if self.shm is None:
+            return
+        for col, dtype in ReadCache.cols:
+            setattr(self, col, None)
+        self.shm.close()
+        self.shm = None
+        self.cache.release(self.key)
@@ -41,6 +41,11 @@ PlotParams <- function(folder, args) {
     svAF = ('-af' %in% args),
     legend = ('-l' %in% args)
   )
+  # thumbnails only show the depth and key alignment stats tracks
+  thumb <- ('-thumb' %in% args)
+  if (thumb) {
+    for (t in c('ins', 'secondary', 'supplementary', 'diffmol', 'refgene', 'svAF', 'legend')) tracks[[t]] <- FALSE
+  }
   attr <- PlotAttr(folder)
   if (!is.na(attr$r_bin_size)){
       if (is.na(attr$l_bin_size)) {
@@ -53,7 +58,7 @@ PlotParams <- function(folder, args) {
   }
   gc <- GC(folder)
   if (is.na(attr$l_bin_num)) { num_loci = 0 } else { num_loci = length(attr$loci) }
-  return(list(tracks=tracks, type=type, num_loci=num_loci, Attr=attr, GC=gc))
+  return(list(tracks=tracks, type=type, num_loci=num_loci, Attr=attr, GC=gc, thumb=thumb))
 }
 # split a region string (eg 'chr1:100-200')
 Region <- function(region){
@@ -66,35 +71,53 @@ Region <- function(region){
     xlims = c(start, end)
     ))
 }
-# parse insert size files
+# parse insert size histograms, columns are named by their lower edge, the last counts everything larger
 Inserts <- function(folder){
   fwd_ins <- list()
   rvs_ins <- list()
+  fwd_q <- list()
+  rvs_q <- list()
+  edges <- NULL
   for (f in list.files(folder)){
-    if (grepl('fwd_ins.csv', f)){
-      pos <- sub('.fwd_ins.csv', '', basename(f))
-      fwd_ins[[pos]] <- scan(paste0(folder, f), sep='\n', what='character', quiet=TRUE)
-      fwd_ins[[pos]] <- lapply(fwd_ins[[pos]], function(x) as.numeric(unlist(strsplit(x, ','))))
-      rvs_ins[[pos]] <- scan(sub('fwd', 'rvs', paste0(folder, f)), sep='\n', what='character', quiet=TRUE)
-      rvs_ins[[pos]] <- lapply(rvs_ins[[pos]], function(x) as.numeric(unlist(strsplit(x, ','))))
+    if (grepl('fwd_ins_hist.tsv', f)){
+      pos <- sub('.fwd_ins_hist.tsv', '', basename(f))
+      fwd <- read.delim(paste0(folder, f), header=TRUE, sep='\t', check.names=FALSE)
+      rvs <- read.delim(sub('fwd', 'rvs', paste0(folder, f)), header=TRUE, sep='\t', check.names=FALSE)
+      edges <- as.numeric(colnames(fwd)[-1])
+      fwd_ins[[pos]] <- as.matrix(fwd[, -1])
+      rvs_ins[[pos]] <- as.matrix(rvs[, -1])
+      # optional quantiles of the inserts of each bin
+      q_file <- sub('fwd_ins_hist', 'fwd_ins_q', paste0(folder, f))
+      if (file.exists(q_file)) {
+        fwd_q[[pos]] <- read.delim(q_file, header=TRUE, sep='\t')
+        rvs_q[[pos]] <- read.delim(sub('fwd', 'rvs', q_file), header=TRUE, sep='\t')
+      }
     }
   }
-  ylim <- estimate_ylim(c(unlist(fwd_ins, use.names=FALSE), unlist(rvs_ins, use.names=FALSE)))
-  return(list(fwd=fwd_ins, rvs=rvs_ins, ylim=ylim))
+  if (is.null(edges)) { ylim <- NA } else { ylim <- edges[length(edges)] }
+  return(list(fwd=fwd_ins, rvs=rvs_ins, fwd_q=fwd_q, rvs_q=rvs_q, edges=edges, ylim=ylim))
 }
 # parse depth files
 Depths <- function(folder){
   region <- NULL
   loci <- list()
+  # expected depth range from a panel of normals, if used
+  region_pon <- NULL
+  loci_pon <- list()
   for (f in list.files(folder)){
     if (grepl('region_depths.tsv', f)){
       region <- read.delim(paste0(folder, f), header = TRUE,  sep = '\t')
     } else if (grepl('.depths.tsv', f)){
       pos <- sub('.depths.tsv', '', basename(f))
       loci[[pos]] <- read.delim(paste0(folder, f), header = TRUE,  sep = '\t')
+    } else if (grepl('region_pon.tsv', f)){
+      region_pon <- read.delim(paste0(folder, f), header = TRUE,  sep = '\t')
+    } else if (grepl('.pon.tsv', f)){
+      pos <- sub('.pon.tsv', '', basename(f))
+      loci_pon[[pos]] <- read.delim(paste0(folder, f), header = TRUE,  sep = '\t')
     }
   }
-  return(list(region=region, loci=loci))
+  return(list(region=region, loci=loci, region_pon=region_pon, loci_pon=loci_pon))
 }
 # parse alignment stats files
 AlnStats <- function(folder){
@@ -202,19 +225,23 @@ add_position_axis <- function(params, side) {
 plot_depth <- function(params, depths) {
   if (params$type != 'split'){
     ylims = c(0, 1.2 * max(depths$region$total - depths$region$mapQ0 - depths$region$mapQltT, na.rm=TRUE))
+    if (!is.null(depths$region_pon)) { ylims[2] <- max(ylims[2], max(depths$region_pon$upper, na.rm=TRUE)) }
     empty_plot(params$Attr$region$xlims, ylim=ylims)
     add_border(params$Attr$region$xlims, ylims)
     depth_plotter(depths$region, params$Attr$r_bin_size)
+    pon_plotter(depths$region_pon, params$Attr$r_bin_size)
     par(las=3)
     mtext('Depth\n(reads/ bp)', side=2, line=3, cex=0.75)
     par(las=1)
     axis(2, tick=TRUE, labels=TRUE, line=0.5)
   } else {
     ylims = c(0, 1.2 * max(sapply(depths$loci, function(x) max(x$total - x$mapQ0 - x$mapQltT, na.rm=TRUE))))
+    if (length(depths$loci_pon) > 0) { ylims[2] <- max(ylims[2], max(sapply(depths$loci_pon, function(x) max(x$upper, na.rm=TRUE)))) }
     for (i in 1:2){
       empty_plot(params$Attr$loci[[i]]$xlims, ylim=ylims)
       add_border(params$Attr$loci[[i]]$xlims, ylims)
       depth_plotter(depths$loci[[i]], params$Attr$l_bin_size)
+      pon_plotter(depths$loci_pon[[names(depths$loci)[i]]], params$Attr$l_bin_size)
       if (i == 1){ title(ylab='Depth\n(reads/ bp)', line=2); axis(2, tick=TRUE, labels=TRUE, line=0.5) }
     }
   }
@@ -228,6 +255,16 @@ depth_plotter <- function(depth, bin_size){
   rect(depth$bin, (depth$total - depth$mapQ0), (depth$bin + bin_size), depth$total - (depth$mapQ0 + depth$mapQltT), col='wheat2')
 }
 
+# translucent band of the expected depth range from the panel of normals, with its median
+pon_plotter <- function(pon, bin_size){
+  if (is.null(pon)) { return() }
+  x <- c(pon$bin, pon$bin[nrow(pon)] + bin_size)
+  lower <- c(pon$lower, pon$lower[nrow(pon)])
+  upper <- c(pon$upper, pon$upper[nrow(pon)])
+  polygon(c(x, rev(x)), c(lower, rev(upper)), col=rgb(0.25, 0.25, 0.6, 0.3), border=NA)
+  lines(x, c(pon$median, pon$median[nrow(pon)]), type='s', col=rgb(0.25, 0.25, 0.6, 0.8), lwd=1)
+}
+
 # add the legend
 add_legend <- function() {
   # create a plot with room for four legends: depth, inserts, mapping stats, svtype/freq
@@ -330,32 +367,18 @@ get_units <- function(num_bp) {
     return(list(val=1000000000, sym='Gbp'))
   }
 }
-# heuristic for avoiding errors when determing insert size upper
-estimate_ylim <- function(ins) {
-  sorted <- sort(ins)
-  ylim <- 1.1 * sorted[floor(length(sorted) * 0.985)]
-  if (length(ylim) < 1) { ylim <- 500}
-  return(ylim)
-}
-plot_insert_sizes <- function(params, ins, ylim, num_y_bins=10){
+plot_insert_sizes <- function(params, ins, ylim){
   # organise sensible units for ticks on plot
-  bin_plot_inserts(ins$fwd[[1]], ins$ylim, add_axis=TRUE, ylab='forward\nmapping\ndistance\n')
-  if (params$type != 'contiguous'){ bin_plot_inserts(ins$fwd[[2]], ins$ylim) }
-  bin_plot_inserts(ins$rvs[[1]], ins$ylim, add_axis=TRUE, ylab='reverse\nmapping\ndistance\n')
-  if (params$type != 'contiguous'){ bin_plot_inserts(ins$rvs[[2]], ins$ylim) }
-}
-# bin inserts by size and create plots
-bin_plot_inserts <- function(ins, ylim, num_y_bins=10, add_axis=FALSE, ylab=''){
-  # bin inserts
-  ybin_size <- ylim / num_y_bins
-  # create an extra bin to store anything larger than ylim
-  bins <- matrix(nrow=length(ins), ncol=(num_y_bins + 1))
-  # get counts for each bin
-  for (i in 1:num_y_bins) {
-    bins[, i]=sapply(ins, function(x) sum((((i - 1) * ybin_size)  <= x) & (x < ((i) * ybin_size))))
-  }
-  bins[, (num_y_bins + 1)]=sapply(ins, function(x) sum(ylim <= x))
-  bins=bins / rowSums(bins) # convert to proportions
+  bin_plot_inserts(ins$fwd[[1]], ins$edges, ins$fwd_q[1][[1]], add_axis=TRUE, ylab='forward\nmapping\ndistance\n')
+  if (params$type != 'contiguous'){ bin_plot_inserts(ins$fwd[[2]], ins$edges, ins$fwd_q[2][[1]]) }
+  bin_plot_inserts(ins$rvs[[1]], ins$edges, ins$rvs_q[1][[1]], add_axis=TRUE, ylab='reverse\nmapping\ndistance\n')
+  if (params$type != 'contiguous'){ bin_plot_inserts(ins$rvs[[2]], ins$edges, ins$rvs_q[2][[1]]) }
+}
+# plot binned inserts, counts has a row per bin and a column per insert size bin with the last for overflow
+bin_plot_inserts <- function(counts, edges, quantiles=NULL, add_axis=FALSE, ylab=''){
+  num_y_bins <- length(edges) - 1
+  ylim <- edges[length(edges)]
+  bins <- counts / rowSums(counts) # convert to proportions
   # plot binned inserts
   empty_plot(c(0,nrow(bins)), ylab='' ,ylim=c(0, num_y_bins + 1))
   for (i in 1:(num_y_bins + 1)) {
@@ -363,14 +386,19 @@ bin_plot_inserts <- function(ins, ylim, num_y_bins=10, add_axis=FALSE, ylab=''){
   }
   add_border(c(0, nrow(bins)), c(0, num_y_bins))
   add_border(c(0, nrow(bins)), c(num_y_bins, num_y_bins+1))
+  # median insert size of each bin, inserts beyond the last edge are drawn in the overflow bin
+  if (!is.null(quantiles)) {
+    y <- approx(edges, 0:num_y_bins, quantiles$q50, rule=2)$y
+    y[!is.na(quantiles$q50) & quantiles$q50 >= ylim] <- num_y_bins + 0.5
+    lines((1:nrow(bins)) - 0.5, y, col='black', lwd=0.75)
+  }
   if (add_axis){
     units <- get_units(ylim / 2)
-    ylim <- ylim / units$val
-    mid <- round(ylim / 2)
+    mid <- round(ylim / units$val / 2)
     interval <- round(mid * 2 / 3)
-    ticks_at <- c((mid - interval), mid, (mid + interval))
+    ticks <- c((mid - interval), mid, (mid + interval))
     text(0, num_y_bins + 0.5, labels =">", cex=0.85, pos=2)
-    axis(2, at=10 * ticks_at / ylim,  labels=as.character(ticks_at),  line=0.5)
+    axis(2, at=approx(edges, 0:num_y_bins, ticks * units$val)$y,  labels=as.character(ticks),  line=0.5)
     par(las=1)
     mtext(paste0(ylab,'(', units$sym, ')'), side=2, line=3.5, cex=0.6)
   }
@@ -735,24 +763,47 @@ get_plot_layout <- function(params, annotations, num_samples, vcfs_per_sample, m
   widths <- c(1, rep(8/n_col, times=n_col))
   return(list(mat=mat, heights=h, widths=widths))
 }
-# main method
-visualise <- function(folder, sample_names, plot_args, outfile, title='') {
+# load all the data required for a plot
+load_plot <- function(folder, sample_names, plot_args) {
   params <- PlotParams(folder, plot_args)
-  num_samples <- length(sample_names)
   samples <-  lapply(sample_names, function(x) Sample(params, folder, x))
   vcfs_per_sample <- lapply(samples, function(x) sapply(x$vcfs, function(y) y$n_tracks))
   ins_ylim <- max(sapply(samples, function(x) x$Ins$ylim))
   annotations <- Annotations(params, folder)
-  lay_out <- get_plot_layout(params, annotations, num_samples, vcfs_per_sample)
-  pdf(outfile, title='SVPV Graphics Output', width = 8, height = 0.15* sum(lay_out$heights), bg = 'white')
+  lay_out <- get_plot_layout(params, annotations, length(sample_names), vcfs_per_sample)
+  return(list(params=params, samples=samples, ins_ylim=ins_ylim, annotations=annotations, lay_out=lay_out))
+}
+# page height of a plot, only reads the files that determine the layout
+plot_height <- function(folder, sample_names, plot_args) {
+  params <- PlotParams(folder, plot_args)
+  vcfs_per_sample <- lapply(sample_names, function(x) sapply(VCFs(params, paste0(folder, x, '/svs.tsv')), function(y) y$n_tracks))
+  annotations <- Annotations(params, folder)
+  lay_out <- get_plot_layout(params, annotations, length(sample_names), vcfs_per_sample)
+  return(0.15 * sum(lay_out$heights))
+}
+# add an empty row to the bottom of a layout so that it fills a page of the given height
+pad_layout <- function(lay_out, page_height) {
+  extra <- page_height / 0.15 - sum(lay_out$heights)
+  if (extra > 0) {
+    lay_out$mat <- rbind(lay_out$mat, rep(max(lay_out$mat) + 1, times=ncol(lay_out$mat)))
+    lay_out$heights <- c(lay_out$heights, extra)
+  }
+  return(lay_out)
+}
+# draw a loaded plot on the current device
+draw_plot <- function(plot, title='', page_height=NA) {
+  params <- plot$params
+  annotations <- plot$annotations
+  lay_out <- plot$lay_out
+  if (!is.na(page_height)) { lay_out <- pad_layout(lay_out, page_height) }
   par(mai = c(0, 0, 0, 0), omi = c(0.2, 0, 0.1, 0))
   layout(lay_out$mat, heights=lay_out$heights, widths=lay_out$widths)
   add_position_axis(params, 3) # top x axis
   add_title(title)
   separator()
   # plot samples
-  for (i in 1:num_samples) {
-    plot_sample(samples[[i]], params, ins_ylim)
+  for (i in 1:length(plot$samples)) {
+    plot_sample(plot$samples[[i]], params, plot$ins_ylim)
   }
   # add in heights for SVAF tracks
   if (params$tracks$svAF) {
@@ -768,14 +819,94 @@ visualise <- function(folder, sample_names, plot_args, outfile, title='') {
   if (params$tracks$legend) { add_legend() }
   # add details
   plot_details(params)
+}
+# placeholder page for a plot that could not be drawn, keeps the page numbers of a multi-page pdf intact
+failed_page <- function(title) {
+  layout(matrix(1))
+  empty_plot(c(0, 1))
+  text(0.5, 0.5, paste('Failed to render', title))
+}
+# main method
+visualise <- function(folder, sample_names, plot_args, outfile, title='') {
+  plot <- load_plot(folder, sample_names, plot_args)
+  if (plot$params$thumb) {
+    # low resolution raster, 400 pixels wide
+    png(outfile, width = 8, height = 0.15* sum(plot$lay_out$heights), units = 'in', res = 50, bg = 'white')
+  } else {
+    pdf(outfile, title='SVPV Graphics Output', width = 8, height = 0.15* sum(plot$lay_out$heights), bg = 'white')
+  }
+  draw_plot(plot, title)
+  graphics.off()
+}
+# draw several plots as the pages of a single pdf
+visualise_pages <- function(jobs, plot_args) {
+  heights <- sapply(seq_len(nrow(jobs)), function(i) {
+    tryCatch(plot_height(jobs$folder[i], strsplit(as.character(jobs$samples[i]), ',')[[1]], plot_args),
+             error=function(e) 1)
+  })
+  pdf(jobs$outfile[1], title='SVPV Graphics Output', width = 8, height = max(heights), bg = 'white')
+  failed <- c()
+  for (i in seq_len(nrow(jobs))) {
+    sample_names <- strsplit(as.character(jobs$samples[i]), ',')[[1]]
+    plot <- tryCatch(load_plot(jobs$folder[i], sample_names, plot_args), error=function(e) {
+      message(paste0('failed to load ', jobs$folder[i], ': ', conditionMessage(e)))
+      NULL
+    })
+    if (is.null(plot)) {
+      failed_page(jobs$title[i])
+      failed <- c(failed, i)
+    } else {
+      ok <- tryCatch({ draw_plot(plot, jobs$title[i], page_height=max(heights)); TRUE }, error=function(e) {
+        message(paste0('failed to draw ', jobs$folder[i], ': ', conditionMessage(e)))
+        FALSE
+      })
+      if (!ok) failed <- c(failed, i)
+    }
+  }
   graphics.off()
+  return(failed)
+}
+# render every job listed in a batch manifest with a single R process
+# jobs sharing an outfile are drawn as consecutive pages of that file
+# the manifest rows of jobs that could not be rendered are listed in <manifest>.failed
+visualise_batch <- function(manifest, plot_args) {
+  jobs <- read.delim(manifest, header=TRUE, sep='\t', as.is=TRUE, quote='')
+  failed <- c()
+  for (idxs in split(seq_len(nrow(jobs)), factor(jobs$outfile, levels=unique(jobs$outfile)))) {
+    if (length(idxs) > 1) {
+      failed <- c(failed, tryCatch(idxs[visualise_pages(jobs[idxs,], plot_args)], error=function(e) {
+        graphics.off()
+        message(paste0('failed to render ', jobs$outfile[idxs[1]], ': ', conditionMessage(e)))
+        idxs
+      }))
+      next
+    }
+    i <- idxs[1]
+    sample_names <- strsplit(as.character(jobs$samples[i]), ',')[[1]]
+    ok <- tryCatch({
+      visualise(jobs$folder[i], sample_names, plot_args, jobs$outfile[i], jobs$title[i])
+      TRUE
+    }, error=function(e) {
+      graphics.off()
+      message(paste0('failed to render ', jobs$outfile[i], ': ', conditionMessage(e)))
+      FALSE
+    })
+    if (!ok) failed <- c(failed, i)
+  }
+  writeLines(as.character(failed), paste0(manifest, '.failed'))
+  return(length(failed))
 }
 
 # read command-line arguments
 args <- commandArgs(trailingOnly = TRUE)
-sample_names <- strsplit(as.character(args[1]), ',')[[1]]
-folder <- args[2]
-outfile <- args[3]
-title <- args[4]
-plot_args <- args[5:length(args)]
-visualise(folder, sample_names, plot_args, outfile, title)
+if (args[1] == '-batch') {
+  plot_args <- args[3:length(args)]
+  if (visualise_batch(args[2], plot_args) > 0) quit(status=1)
+} else {
+  sample_names <- strsplit(as.character(args[1]), ',')[[1]]
+  folder <- args[2]
+  outfile <- args[3]
+  title <- args[4]
+  plot_args <- args[5:length(args)]
+  visualise(folder, sample_names, plot_args, outfile, title)
+}
@@ -0,0 +1,69 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# alignment stats of fixed genomic tiles at several zoom levels, cached per alignment for browsing custom regions
+# panning or zooming only reads the tiles not yet seen, the plot windows are stitched together from the tiles
+from __future__ import print_function
+from __future__ import division
+from collections import OrderedDict
+import numpy as np
+from .sam import AlignStats, SamStats
+from .plot import Bins
+
+
+class TileCache:
+    # bin sizes of the zoom levels, doubling so that zooming in or out by 2 moves to the next level
+    bin_sizes = tuple(10 * 2 ** i for i in range(14))
+    # number of bins in a tile, tiles start at multiples of their length
+    tile_bins = 100
+
+    def __init__(self, max_tiles=2000):
+        self.max_tiles = max_tiles
+        # AlignStats by (bam, chrom, bin size, tile number), least recently used first
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # bins covering bins aligned to the tile grid, with the bin size of the zoom level nearest to that of bins
+    @staticmethod
+    def snap(bins):
+        size = min(TileCache.bin_sizes, key=lambda x: abs(np.log(x / bins.size)))
+        start = (bins.start // size) * size
+        end = (bins.end // size + 1) * size - 1
+        return Bins(bins.chrom, start, end, ideal_num_bins=(end - start + 1) // size)
+
+    def get_tile(self, bam, library, chrom, size, n):
+        key = (bam, chrom, size, n)
+        if key in self.tiles:
+            self.hits += 1
+            tile = self.tiles.pop(key)
+            self.tiles[key] = tile
+            return tile
+        self.misses += 1
+        length = size * TileCache.tile_bins
+        bins = Bins(chrom, n * length, (n + 1) * length - 1, ideal_num_bins=TileCache.tile_bins)
+        tile = SamStats.get_align_stats(bam, bins, AlignStats.get_ins_edges(library))
+        self.tiles[key] = tile
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    # AlignStats of bins stitched from the tiles covering them, bins must be aligned to the grid (see snap)
+    # reads crossing a tile edge are counted in each tile as they are at the edges of any plot window, and
+    # quantile sketches of insert sizes are not kept
+    def get_align_stats(self, bam, library, bins):
+        if bins.size not in TileCache.bin_sizes or bins.start % bins.size:
+            raise ValueError('bins {} are not aligned to the tile grid'.format(bins.region))
+        length = bins.size * TileCache.tile_bins
+        tiles = [self.get_tile(bam, library, bins.chrom, bins.size, n)
+                 for n in range(bins.start // length, bins.end // length + 1)]
+        offset = (bins.start % length) // bins.size
+        aln = AlignStats(bins, ins_edges=tiles[0].ins_edges)
+        aln.aln_stats = np.concatenate([t.aln_stats for t in tiles])[offset:offset + bins.num]
+        aln.depth_stats.depths = np.concatenate([t.depth_stats.depths for t in tiles])[offset:offset + bins.num]
+        aln.fwd_ins_hist = np.concatenate([t.fwd_ins_hist for t in tiles])[offset:offset + bins.num]
+        aln.rvs_ins_hist = np.concatenate([t.rvs_ins_hist for t in tiles])[offset:offset + bins.num]
+        aln.fwd_ins_sketch = None
+        aln.rvs_ins_sketch = None
+        return aln
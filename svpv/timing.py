@@ -0,0 +1,99 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+from __future__ import print_function
+import os
+import json
+import time
+from contextlib import contextmanager
+
+
+# stage timers and counters for the -profile report, they do nothing unless enabled
+class Timer:
+    enabled = False
+    # dict by stage of total seconds and number of times timed
+    seconds = {}
+    calls = {}
+    # dict by name of counts, eg reads processed, bytes read, subprocesses started
+    counters = {}
+    # per SV (key, seconds by stage, counts by name) records and the totals when the current SV started
+    records = []
+    current = None
+    # cProfile of the current SV and the file its stats are written to
+    profiler = None
+    profile_out = None
+
+    @staticmethod
+    @contextmanager
+    def stage(name):
+        if not Timer.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            Timer.seconds[name] = Timer.seconds.get(name, 0) + time.time() - start
+            Timer.calls[name] = Timer.calls.get(name, 0) + 1
+
+    @staticmethod
+    def count(name, n=1):
+        if Timer.enabled:
+            Timer.counters[name] = Timer.counters.get(name, 0) + n
+
+    # prof is the file to write cProfile stats of this SV to, if it is to be profiled
+    @staticmethod
+    def start_sv(key, prof=None):
+        if not Timer.enabled:
+            return
+        Timer.current = (key, time.time(), dict(Timer.seconds), dict(Timer.counters))
+        if prof is not None:
+            import cProfile
+            Timer.profile_out = prof
+            Timer.profiler = cProfile.Profile()
+            Timer.profiler.enable()
+
+    @staticmethod
+    def end_sv():
+        if not Timer.enabled or Timer.current is None:
+            return
+        if Timer.profiler is not None:
+            import pstats
+            Timer.profiler.disable()
+            Timer.profiler.dump_stats(Timer.profile_out)
+            print('cProfile stats of {} written to {}\n'.format(Timer.current[0], Timer.profile_out))
+            pstats.Stats(Timer.profile_out).sort_stats('cumulative').print_stats(20)
+            Timer.profiler = None
+        key, start, seconds, counters = Timer.current
+        stages = dict((s, Timer.seconds[s] - seconds.get(s, 0)) for s in Timer.seconds)
+        stages['total'] = time.time() - start
+        counts = dict((c, Timer.counters[c] - counters.get(c, 0)) for c in Timer.counters)
+        Timer.records.append((key, stages, counts))
+        Timer.current = None
+
+    # per SV stage times and counts as TSV, run totals as JSON
+    @staticmethod
+    def write_report(out_dir, tag=''):
+        if not Timer.enabled:
+            return
+        stages = sorted(Timer.seconds)
+        counters = sorted(Timer.counters)
+        path = os.path.join(out_dir, 'svpv_profile{}.tsv'.format(tag))
+        tsv = open(path, 'wt')
+        tsv.write('\t'.join(['sv', 'total'] + stages + counters) + '\n')
+        for key, seconds, counts in Timer.records:
+            tsv.write('\t'.join([key, '{:.4f}'.format(seconds['total'])] +
+                                ['{:.4f}'.format(seconds.get(s, 0)) for s in stages] +
+                                [str(counts.get(c, 0)) for c in counters]) + '\n')
+        tsv.close()
+        report = {'svs': len(Timer.records),
+                  'stages': dict((s, {'seconds': round(Timer.seconds[s], 4), 'calls': Timer.calls[s]}) for s in stages),
+                  'counters': Timer.counters}
+        out = open(os.path.join(out_dir, 'svpv_profile{}.json'.format(tag)), 'wt')
+        json.dump(report, out, indent=1, sort_keys=True)
+        out.close()
+        print('profile written to {}\n'.format(path))
+        for s in sorted(stages, key=lambda x: -Timer.seconds[x]):
+            print('{:<20}{:>10.2f}s{:>10}'.format(s, Timer.seconds[s], Timer.calls[s]))
+        print('')
@@ -0,0 +1,87 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# versions of the external tools, found on first use rather than at startup
+# versions are cached between runs by the path, size and modification time of each executable so that
+# '--version-only' is only run again when a tool is installed, upgraded or moved
+from __future__ import print_function
+import os
+import subprocess
+from .errors import SVPVError
+
+
+class Tools:
+    cache_path = os.path.join(os.path.expanduser('~'), '.svpv', 'tools.tsv')
+    cols = ['tool', 'path', 'size', 'mtime', 'version']
+    # dict by tool of versions already checked in this process
+    checked = {}
+
+    # returns the version of tool, raises SVPVError if it is not installed
+    @staticmethod
+    def check(tool):
+        if tool in Tools.checked:
+            return Tools.checked[tool]
+        path = Tools.which(tool)
+        if path is None:
+            raise SVPVError('could not run {}. Are you sure it is installed?'.format(tool))
+        st = os.stat(path)
+        stamp = [path, str(st.st_size), str(int(st.st_mtime))]
+        cache = Tools.read_cache()
+        if tool in cache and cache[tool][0:3] == stamp:
+            version = cache[tool][3]
+        else:
+            try:
+                version = subprocess.check_output([path, '--version-only'], universal_newlines=True).strip()
+            except (OSError, subprocess.CalledProcessError):
+                raise SVPVError('could not run {}. Are you sure it is installed?'.format(tool))
+            cache[tool] = stamp + [version]
+            Tools.write_cache(cache)
+        Tools.checked[tool] = version
+        return version
+
+    # full path of an executable on the PATH, or of tool itself if it is a path
+    @staticmethod
+    def which(tool):
+        if os.path.dirname(tool):
+            paths = [tool]
+        else:
+            paths = [os.path.join(d, tool) for d in os.environ.get('PATH', '').split(os.pathsep) if d]
+        for path in paths:
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.abspath(path)
+        return None
+
+    # dict by tool of [path, size, mtime, version]
+    @staticmethod
+    def read_cache():
+        cache = {}
+        if not os.path.isfile(Tools.cache_path):
+            return cache
+        try:
+            lines = open(Tools.cache_path).read().split('\n')
+            if lines[0].split('\t') != Tools.cols:
+                return cache
+            for line in lines[1:]:
+                fields = line.split('\t')
+                if len(fields) == len(Tools.cols):
+                    cache[fields[0]] = fields[1:]
+        except (IOError, OSError):
+            pass
+        return cache
+
+    @staticmethod
+    def write_cache(cache):
+        try:
+            if not os.path.isdir(os.path.dirname(Tools.cache_path)):
+                os.makedirs(os.path.dirname(Tools.cache_path))
+            # written to a temporary file and moved so that concurrent runs never see a partial cache
+            tmp = '{}.{}'.format(Tools.cache_path, os.getpid())
+            out = open(tmp, 'wt')
+            out.write('\t'.join(Tools.cols) + '\n')
+            for tool in sorted(cache):
+                out.write('\t'.join([tool] + cache[tool]) + '\n')
+            out.close()
+            os.rename(tmp, Tools.cache_path)
+        except (IOError, OSError):
+            pass
@@ -7,6 +7,9 @@ from __future__ import division
 import subprocess
 from subprocess import PIPE
 import copy, re
+from .timing import Timer
+from .errors import SVPVError
+from .tools import Tools
 
 
 class VCFManager:
@@ -15,6 +18,7 @@ class VCFManager:
     def __init__(self, vcf_file, name='VCF ' + str(vcf_count), db_mode=False, samples=None):
         VCFManager.vcf_count += 1
         self.name = name
+        self.vcf_file = vcf_file
         if not samples:
             self.samples = BCFtools.get_samples(vcf_file)
         else:
@@ -26,7 +30,9 @@ class VCFManager:
         # dict of chr, sorted lists of positions
         self.positions = {}
         if vcf_file is not None:
-            self.set_svs(vcf_file, db_mode)
+            with Timer.stage('vcf_load'):
+                self.set_svs(vcf_file, db_mode)
+            Timer.count('vcf_records', self.count)
 
     # read in all SV sites
     def set_svs(self, vcf, db_mode):
@@ -117,15 +123,49 @@ class VCFManager:
                     ret.append(sv)
 
         if sample is not None:
-            delete = []
-            for i, sv in enumerate(ret):
-                if sample in self.samples:
-                    if '1' not in sv.GTs[self.samples.index(sample)]:
-                        delete.append(i)
-            for i in sorted(delete, reverse=True):
-                del ret[i]
+            ret = self.sample_filter(ret, sample)
         return ret
 
+    # calls of svs in which sample has a non reference genotype, all calls if sample is not in this vcf
+    def sample_filter(self, svs, sample):
+        if sample is None or sample not in self.samples:
+            return list(svs)
+        idx = self.samples.index(sample)
+        return [sv for sv in svs if '1' in sv.GTs[idx]]
+
+    # return the calls overlapping each of a list of (chrom, start, end) queries, as get_svs_in_range
+    # one sweep per chromosome over the calls in position order and the queries in order of end
+    def join_ranges(self, queries, lrg_svs=True):
+        results = [[] for q in queries]
+        by_chrom = {}
+        for i, q in enumerate(queries):
+            if q[0] in self.positions:
+                by_chrom.setdefault(q[0], []).append(i)
+        for chrom, idxs in by_chrom.items():
+            svs = []
+            for pos in self.positions[chrom]:
+                svs.extend(self.SVs[chrom][pos])
+            idxs.sort(key=lambda i: queries[i][2])
+            # smallest start of the queries still to come, calls ending before it can not overlap them
+            min_start = [queries[i][1] for i in idxs]
+            for n in range(len(min_start) - 2, -1, -1):
+                min_start[n] = min(min_start[n], min_start[n + 1])
+            active = []
+            k = 0
+            for n, i in enumerate(idxs):
+                chrom, start, end = queries[i]
+                while k < len(svs) and svs[k].pos <= end:
+                    active.append(svs[k])
+                    k += 1
+                active = [sv for sv in active if sv.end >= min_start[n]]
+                for sv in active:
+                    if sv.end < start:
+                        continue
+                    if not lrg_svs and sv.pos < start and sv.end > end:
+                        continue
+                    results[i].append(sv)
+        return results
+
     def get_sample_index(self, sample):
         if sample in self.samples:
             return self.samples.index(sample)
@@ -151,6 +191,10 @@ class VCFManager:
             if filter_par.svtype and sv.svtype != filter_par.svtype:
                 delete.append(i)
                 continue
+            # filter by specific calls
+            if filter_par.sv_ids and '{}:{}'.format(sv.chrom, sv.pos) not in filter_par.sv_ids:
+                delete.append(i)
+                continue
             # filter by sample GT
             if filter_par.sample_GTs:
                 for sample in filter_par.sample_GTs:
@@ -491,18 +535,15 @@ class BND_Event():
             bnd.BND_Event = self
 
 class BCFtools:
+    # checked on first use, the version is cached between runs
     @staticmethod
-    def check_installation():
-        cmd = ['bcftools', '--version-only']
-        try:
-            subprocess.check_output(cmd, universal_newlines=True)
-        except OSError:
-            print('Error: could not run bcftools. Are you sure it is installed?')
-            exit(1)
+    def check_installation(bcftools='bcftools'):
+        return Tools.check(bcftools)
 
     # return a pipe to the set of sv sites
     @staticmethod
     def get_SV_sites(vcf, db_mode=False):
+        BCFtools.check_installation()
         cmd = ["bcftools", "query", "-u", "-f"]
         if db_mode:
             cmd.append("%CHROM\\t%POS\\t%ID\\t%ALT{0}\\t%INFO/END\\t%INFO/SVTYPE\\t%INFO/SVLEN\\t%INFO/EVENTID"
@@ -512,15 +553,17 @@ class BCFtools:
                        "\\t%INFO/PAIRID\\t%INFO/MATEID\\t%INFO/INSLEN\\t%INFO/CHR2[\\t%GT]\\n")
         cmd.append(vcf)
         print(' '.join(cmd) + '\n')
+        Timer.count('subprocesses')
         p = subprocess.Popen(cmd, bufsize=1024, stdout=PIPE, universal_newlines=True)
         if p.poll():
-            print("Error code %d from command:\n%s\n" % (' '.join(cmd) + '\n'))
-            exit(1)
+            raise SVPVError("exit code %d from command:\n%s\n" % (p.returncode, ' '.join(cmd)))
         return p
 
     # return a list of samples
     @staticmethod
     def get_samples(vcf):
+        BCFtools.check_installation()
         cmd = ["bcftools", "query", "-l", vcf]
         print(' '.join(cmd) + '\n')
+        Timer.count('subprocesses')
         return subprocess.check_output(cmd, universal_newlines=True).split()
@@ -0,0 +1,188 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+import sqlite3
+import subprocess
+from hashlib import sha1
+from .batch import RunJournal, run_batch
+from .errors import SVPVError
+
+
+# work queue shared by a coordinator and any number of workers through a directory on a shared filesystem
+# units of work are runs of SVs on the same chromosome, workers keep to one chromosome while they can
+# so that the pages of the alignments they read stay cached
+class WorkQueue:
+    db_name = 'svpv_queue.db'
+    # seconds a worker may hold a unit without renewing it before it can be reclaimed by another worker
+    # renewed after each SV, so only needs to cover plotting one SV (or rendering the batch of a unit)
+    lease = 3600
+    # number of times a unit is attempted before it is left as failed
+    max_attempts = 3
+
+    def __init__(self, queue_dir):
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+        self.path = os.path.join(queue_dir, WorkQueue.db_name)
+        # transactions are managed explicitly so that claiming a unit is atomic across processes
+        self.db = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS units (id INTEGER PRIMARY KEY, name TEXT UNIQUE, chrom TEXT, '
+                        'svs TEXT, status TEXT, worker TEXT, expires REAL, attempts INTEGER, done INTEGER, '
+                        'failed INTEGER)')
+
+    # split SVs into units of up to unit_size SVs from a single chromosome
+    # units completed by a previous run of the coordinator are kept
+    def add_svs(self, svs, unit_size=50):
+        chroms = {}
+        order = []
+        for sv in svs:
+            if sv.chrom not in chroms:
+                chroms[sv.chrom] = []
+                order.append(sv.chrom)
+            chroms[sv.chrom].append(RunJournal.sv_key(sv))
+        self.db.execute('BEGIN IMMEDIATE')
+        names = set()
+        added = 0
+        for chrom in order:
+            keys = chroms[chrom]
+            for i in range(0, len(keys), unit_size):
+                unit = keys[i:i + unit_size]
+                name = sha1('\n'.join(unit).encode('utf-8')).hexdigest()
+                cur = self.db.execute('INSERT OR IGNORE INTO units (name, chrom, svs, status, attempts, done, failed) '
+                                      'VALUES (?, ?, ?, ?, 0, 0, 0)', (name, chrom, '\n'.join(unit), 'pending'))
+                added += cur.rowcount
+                names.add(name)
+        # drop unfinished units of a previous run with different SVs
+        for unit_id, name in self.db.execute("SELECT id, name FROM units WHERE status != 'done'").fetchall():
+            if name not in names:
+                self.db.execute('DELETE FROM units WHERE id = ?', (unit_id,))
+        # give units that failed in a previous run another chance
+        self.db.execute("UPDATE units SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+        self.db.execute('COMMIT')
+        return added
+
+    # claim the next unit for worker, preferring the chromosome it last worked on,
+    # then chromosomes no other worker is on
+    # returns (id, chrom, list of SV keys) or None if there is nothing left to claim
+    def claim(self, worker, chrom=None):
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        row = self.db.execute("SELECT id, chrom, svs FROM units "
+                              "WHERE status = 'pending' OR (status = 'running' AND expires < ?) "
+                              "ORDER BY chrom = ? DESC, chrom IN (SELECT chrom FROM units WHERE status = 'running' "
+                              "AND expires >= ?) ASC, id LIMIT 1", (now, chrom, now)).fetchone()
+        if row is None:
+            self.db.execute('COMMIT')
+            return None
+        self.db.execute("UPDATE units SET status = 'running', worker = ?, expires = ?, attempts = attempts + 1 "
+                        "WHERE id = ?", (worker, now + WorkQueue.lease, row[0]))
+        self.db.execute('COMMIT')
+        return row[0], row[1], row[2].split('\n')
+
+    # extend the lease of a unit still held by worker, returns False if it has been reclaimed
+    def renew(self, unit_id, worker):
+        cur = self.db.execute("UPDATE units SET expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                              (time.time() + WorkQueue.lease, unit_id, worker))
+        return cur.rowcount > 0
+
+    def complete(self, unit_id, done, failed):
+        self.db.execute("UPDATE units SET status = 'done', done = ?, failed = ? WHERE id = ?", (done, failed, unit_id))
+
+    def fail(self, unit_id):
+        self.db.execute("UPDATE units SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END "
+                        "WHERE id = ?", (WorkQueue.max_attempts, unit_id))
+
+    # dict of counts of units by status, with the number of SVs plotted and failed by completed units
+    def progress(self):
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for status, n in self.db.execute('SELECT status, COUNT(*) FROM units GROUP BY status'):
+            counts[status] = n
+        done, failed = self.db.execute('SELECT SUM(done), SUM(failed) FROM units').fetchone()
+        counts['svs_done'] = done or 0
+        counts['svs_failed'] = failed or 0
+        return counts
+
+    def finished(self):
+        counts = self.progress()
+        return counts['pending'] == 0 and counts['running'] == 0
+
+    def close(self):
+        self.db.close()
+
+
+# fill the queue with the filtered SVs and wait for workers to work through it
+# local_workers worker processes are started on this machine with the same arguments
+def coordinate(par, svs, args):
+    queue = WorkQueue(par.run.queue_dir)
+    added = queue.add_svs(svs, unit_size=par.run.unit_size)
+    print('queued {} new work units in {}\n'.format(added, queue.path))
+    workers = []
+    if par.run.local_workers:
+        cmd = [sys.executable, os.path.abspath(sys.argv[0])]
+        skip = False
+        for a in args:
+            if skip:
+                skip = False
+            elif a == '-local_workers':
+                skip = True
+            elif a != '-coordinator':
+                cmd.append(a)
+        cmd.append('-worker')
+        for i in range(par.run.local_workers):
+            workers.append(subprocess.Popen(cmd))
+    last = None
+    while not queue.finished():
+        counts = queue.progress()
+        if counts != last:
+            print('units pending: {pending}, running: {running}, done: {done}, failed: {failed}'.format(**counts))
+            last = counts
+        if workers and all(w.poll() is not None for w in workers):
+            print('Error: all local workers exited with work left in the queue\n')
+            break
+        time.sleep(5)
+    for w in workers:
+        w.wait()
+    counts = queue.progress()
+    queue.close()
+    print('units done: {done}, failed: {failed}; SVs plotted: {svs_done}, failed: {svs_failed}\n'.format(**counts))
+    if counts['failed'] or counts['svs_failed']:
+        raise SVPVError('{} work units and {} SVs failed'.format(counts['failed'], counts['svs_failed']))
+
+
+# claim and plot units from the queue until it is empty
+def work(par, svs):
+    worker = '{}.{}'.format(socket.gethostname(), os.getpid())
+    by_key = dict((RunJournal.sv_key(sv), sv) for sv in svs)
+    queue = WorkQueue(par.run.queue_dir)
+    chrom = None
+    while True:
+        unit = queue.claim(worker, chrom=chrom)
+        if unit is None:
+            break
+        unit_id, chrom, keys = unit
+        missing = [k for k in keys if k not in by_key]
+        if missing:
+            print('Error: worker {} has different SVs to the coordinator, {} not found\n'.format(worker, missing[0]))
+            queue.fail(unit_id)
+            break
+
+        def renew():
+            if not queue.renew(unit_id, worker):
+                print('Warning: worker {} lost its lease on unit {}\n'.format(worker, unit_id))
+
+        # the journal is kept by unit so that a worker claiming a unit after another failed on it carries on
+        # from the SVs already completed
+        try:
+            done, failed = run_batch(par, [by_key[k] for k in keys], tag='.' + worker, unit=unit_id, progress=renew)
+        except (Exception, SystemExit) as e:
+            print('Error: worker {} failed on unit {}: {}\n'.format(worker, unit_id, e))
+            queue.fail(unit_id)
+            continue
+        # SVs completed by an earlier attempt at the unit are skipped by run_batch but count as done
+        queue.complete(unit_id, len(keys) - failed, failed)
+    queue.close()
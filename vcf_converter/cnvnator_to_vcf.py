@@ -2,25 +2,31 @@
 # """
 # author: Jacob Munro, Victor Chang Cardiac Research Institute
 # """
-
+from __future__ import print_function
+from __future__ import division
 import sys
-import copy
 import re
-import math
 import os
+import heapq
+import shutil
+import tempfile
+import subprocess
+from bisect import bisect_left
+import numpy as np
 
 
 def main():
     usage = "[Required]\n" \
         "-samples\tWhitespace delimited file, first column sample names,\n" \
         "\t\tsecond column CNVnator calls file.\n" \
-        "-o\t\toutput VCF file\n" \
+        "-o\t\toutput VCF file, bgzip compressed and tabix indexed if it ends with .gz\n" \
         "[Optional]\n" \
         "-thresh\t\tJaccard index threshold to use for clustering. Default 0.7\n" \
         "-chroms\t\tComma separated list of chromosomes to process. Default all.\n" \
         "-header\t\toutput vcf file header.\n" \
         "-e[1-4]\t\tthreshold for given CNVnator e-value [default 1e-6].\n" \
-        "\t\te.g. e1 1e-5\n"
+        "\t\te.g. e1 1e-5\n" \
+        "-threads\tNumber of processes to parse samples and cluster chromosomes/svtypes with. Default 1.\n"
     # set defaults
     sample_calls = None
     out_vcf = None
@@ -30,14 +36,15 @@ def main():
     e2 = 1e-6
     e3 = 1e-6
     e4 = 1e-6
-    header = file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vcf_header.txt'), 'r').read()
+    threads = 1
+    header = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vcf_header.txt'), 'r').read()
 
     # parse arguments
     for i, arg in enumerate(sys.argv):
         if arg == '-samples':
-            sample_calls = file(sys.argv[i+1], 'r')
+            sample_calls = open(sys.argv[i+1], 'r')
         elif arg == '-o':
-            out_vcf = file(sys.argv[i+1], 'w')
+            out_vcf = sys.argv[i+1]
         elif arg == '-chroms':
             chroms = sys.argv[i+1].split(',')
         elif arg == '-e1':
@@ -49,212 +56,242 @@ def main():
         elif arg == '-e4':
             e4 = float(sys.argv[i+1])
         elif arg == '-header':
-            header = file(sys.argv[i+1], 'r').read()
+            header = open(sys.argv[i+1], 'r').read()
+        elif arg == '-threads':
+            threads = int(sys.argv[i+1])
         elif arg == '-thresh':
             thresh = float(sys.argv[i+1])
             if thresh < 0.5:
-                print 'Please enter a threshold above 0.5'
+                print('Please enter a threshold above 0.5')
                 exit(1)
 
     if not (sample_calls and out_vcf):
-        print usage
+        print(usage)
         exit(1)
 
-    samples = parse_samples(sample_calls, chroms, e1, e2, e3, e4)
-    all_calls, edges = get_all_calls(samples, thresh)
-    clustered = cluster(all_calls, edges, thresh)
-    print_vcf(samples, clustered, out_vcf)
-
-
-def parse_samples(sample_calls, chroms, e1, e2, e3, e4):
-    print 'parsing sample files'
-    samples = []
+    # calls passing the e-value thresholds are spilled per sample, grouped by chromosome, so that only the calls of
+    # the chromosomes being clustered are held in memory
+    tmp_dir = tempfile.mkdtemp(prefix='cnvnator_to_vcf.', dir=os.path.dirname(os.path.abspath(out_vcf)))
+    try:
+        samples = parse_samples(sample_calls, chroms, e1, e2, e3, e4, tmp_dir, threads=threads)
+        writer = VCFWriter(out_vcf, header, [s.name for s in samples])
+        for lines in cluster(samples, thresh, threads=threads):
+            writer.write(lines)
+        writer.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# run jobs with fn in a pool of threads processes, results are yielded in the order of jobs as they are ready
+# the pool is stopped if a job fails or the results are not all used
+def map_jobs(fn, jobs, threads=1):
+    if threads > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(threads, len(jobs)))
+        try:
+            for result in pool.imap(fn, jobs):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for job in jobs:
+            yield fn(job)
+
+
+def parse_samples(sample_calls, chroms, e1, e2, e3, e4, tmp_dir, threads=1):
+    print('parsing sample files')
+    jobs = []
     for line in sample_calls:
         try:
             sample_name, sample_file = line.split()
         except ValueError:
-            print '%s skipped due to incorrect number of fields' % line
+            print('%s skipped due to incorrect number of fields' % line)
             continue
         if not os.path.isfile(sample_file):
-            print 'file not found: %s' % sample_file
+            print('file not found: %s' % sample_file)
             continue
-        samples.append(Sample(sample_name))
-        samples[-1].parse_calls(sample_file, chroms, f1=e1, f2=e2, f3=e3, f4=e4)
+        jobs.append((sample_name, sample_file, chroms, e1, e2, e3, e4, os.path.join(tmp_dir, str(len(jobs)))))
+    samples = list(map_jobs(parse_sample, jobs, threads))
     print('\tdone.\t\n')
     return samples
 
 
-def get_all_calls(samples, thresh):
-    print 'compiling all calls:'
-    all_calls = {}
+def parse_sample(job):
+    sample_name, sample_file, chroms, e1, e2, e3, e4, spill = job
+    sample = Sample(sample_name)
+    sample.parse_calls(sample_file, chroms, spill, f1=e1, f2=e2, f3=e3, f4=e4)
+    return sample
+
+
+# cluster the calls of each chromosome, yielding the list of its vcf lines. each chromosome and svtype is independent and
+# clustered in parallel, the svtypes of a chromosome are then merged back into position order
+def cluster(samples, thresh, threads=1):
+    print('clustering:')
+    svtypes = {}
     for sample in samples:
-        for chrom in sample.calls:
-            if chrom not in all_calls:
-                all_calls[chrom] = {}
-            for svtype in sample.calls[chrom]:
-                if svtype not in all_calls[chrom]:
-                    all_calls[chrom][svtype] = {}
-                for bin in sample.calls[chrom][svtype]:
-                    if bin not in all_calls[chrom][svtype]:
-                        all_calls[chrom][svtype][bin] = []
-                    all_calls[chrom][svtype][bin].extend(sample.calls[chrom][svtype][bin])
-                    all_calls[chrom][svtype][bin].sort(key=lambda x: x.start)
-    print('\tdone.\t\n')
-    # connect neighbours
-    # this done by passing through and connecting all those that are within +/- 1 size bin of bin of call
-    # adding only those with a start poisition >= our start position
-    print 'preprocessing:'
-    edges = Edges()
-    for chrom in all_calls:
-        for svtype in all_calls[chrom]:
-            print('\t%s, %s\t' % (chrom, svtype))
-            for bin in all_calls[chrom][svtype]:
-                # need to check bin-1 and bin+1 for neighbours as well
-                if (bin - 1) in all_calls[chrom][svtype]:
-                    lt_idx = 0
-                else:
-                    lt_idx = None
-                if (bin + 1) in all_calls[chrom][svtype]:
-                    gt_idx = 0
-                else:
-                    gt_idx = None
-                for i, sv in enumerate(all_calls[chrom][svtype][bin]):
-
-                    j = i+1
-                    # add neighbours from this size bin
-                    while j < len(all_calls[chrom][svtype][bin]) and sv.overlaps(all_calls[chrom][svtype][bin][j]):
-                        if sv.jaccard(all_calls[chrom][svtype][bin][j]) > thresh:
-                            edges.add(chrom, svtype, sv, all_calls[chrom][svtype][bin][j])
-                        j += 1
-                    # add neighbours from lesser size bin
-                    if lt_idx is not None:
-                        while lt_idx < len(all_calls[chrom][svtype][bin-1]):
-                            if sv.start <= all_calls[chrom][svtype][bin-1][lt_idx].start:
-                                break
-                            lt_idx += 1
-
-                        idx = lt_idx
-                        while (idx < len(all_calls[chrom][svtype][bin-1]) and
-                               sv.overlaps(all_calls[chrom][svtype][bin-1][idx])):
-                            if sv.jaccard(all_calls[chrom][svtype][bin-1][idx]) > thresh:
-                                edges.add(chrom, svtype, sv, all_calls[chrom][svtype][bin-1][idx])
-                            idx += 1
-
-                    # add neighbours from greater size bin
-                    if gt_idx is not None:
-                        while gt_idx < len(all_calls[chrom][svtype][bin+1]):
-                            if sv.start <= all_calls[chrom][svtype][bin+1][gt_idx].start:
-                                break
-                            gt_idx += 1
-
-                        idx = gt_idx
-                        while (idx < len(all_calls[chrom][svtype][bin+1]) and
-                                sv.overlaps(all_calls[chrom][svtype][bin+1][idx])):
-                            if sv.jaccard(all_calls[chrom][svtype][bin+1][idx]) > thresh:
-                                edges.add(chrom, svtype, sv, all_calls[chrom][svtype][bin+1][idx])
-                            idx += 1
-
-    for chrom in all_calls:
-        for svtype in all_calls[chrom]:
-            merged_bins = []
-            for bin in all_calls[chrom][svtype]:
-                merged_bins.extend(all_calls[chrom][svtype][bin])
-            all_calls[chrom][svtype] = merged_bins
-    print('\tdone.\t\n')
+        for chrom in sample.svtypes:
+            svtypes.setdefault(chrom, set()).update(sample.svtypes[chrom])
+    jobs = [(chrom, svtype, samples, thresh) for chrom in sorted(svtypes) for svtype in sorted(svtypes[chrom])]
+    chrom = None
+    parts = []
+    # progress is printed here in job order, as jobs may run in any order in the pool
+    for job, (progress, entries) in zip(jobs, map_jobs(cluster_svtype, jobs, threads)):
+        print('\t%s, %s\tlen clusters: %d, progress: %s' % (job[0], job[1], len(entries), str(progress)))
+        if job[0] != chrom and parts:
+            yield [line for key, line in heapq.merge(*parts)]
+            parts = []
+        chrom = job[0]
+        parts.append(entries)
+    if parts:
+        yield [line for key, line in heapq.merge(*parts)]
+
+
+# progress counts of the job and ((start, end, svtype), vcf line) of the merged calls of a chromosome and svtype,
+# in position order
+def cluster_svtype(job):
+    chrom, svtype, samples, thresh = job
+    calls = []
+    for sample in samples:
+        calls.extend(sv for sv in sample.read_calls(chrom) if sv.svtype == svtype)
+    calls.sort(key=lambda x: (x.start, x.end))
+    # counts are class attributes, left over from earlier jobs in the same worker process
+    Cluster.reset_progress()
+    merged = ClusterQueue(calls, thresh).run()
+    merged.sort(key=lambda x: (x.start, x.end))
+    lines = vcf_lines(merged, [s.name for s in samples])
+    return Cluster.get_progress(), [((sv.start, sv.end, sv.svtype), line) for sv, line in zip(merged, lines)]
+
+
+# vcf entries of merged calls, genotyped in each sample from the read depth of its calls in the merged call
+def vcf_lines(merged, sample_names):
+    if not merged:
+        return []
+    idxs = dict((s, i) for i, s in enumerate(sample_names))
+    rows = []
+    cols = []
+    svtypes = []
+    rds = []
+    for i, sv in enumerate(merged):
+        if isinstance(sv, Cluster):
+            members = sv.members
+        else:
+            members = [sv]
+        for call in members:
+            rows.append(i)
+            cols.append(idxs[call.sample_name])
+            svtypes.append(call.svtype)
+            rds.append(np.nan if call.rd is None else call.rd)
+    # merged calls x samples matrix of allele counts
+    gts = np.zeros((len(merged), len(sample_names)), dtype=np.int8)
+    flat = np.array(rows) * len(sample_names) + np.array(cols)
+    counts = SV.genotypes(np.array(svtypes), np.array(rds, dtype=float))
+    # a sample with more than one call in a merged call is genotyped by the last of them
+    last = len(flat) - 1 - np.unique(flat[::-1], return_index=True)[1]
+    gts.flat[flat[last]] = counts[last]
+    afs = gts.sum(axis=1) / (2 * len(sample_names))
+    gt_strs = np.array(['0/0', '0/1', '1/1'])[gts]
+    return [sv.to_vcf(af=af) + '\t' + '\t'.join(row) + '\n' for sv, af, row in zip(merged, afs, gt_strs)]
+
+
+# writes vcf entries as they are produced, through bgzip when the output ends with .gz, which is then tabix indexed
+class VCFWriter:
+    def __init__(self, path, header, sample_names):
+        self.path = path
+        self.bgzip = None
+        if path.endswith('.gz'):
+            try:
+                self.bgzip = subprocess.Popen(['bgzip', '-c'], stdin=subprocess.PIPE, stdout=open(path, 'wb'),
+                                              universal_newlines=True)
+            except OSError:
+                print('Error: could not run bgzip. Are you sure it is installed?')
+                exit(1)
+            self.out = self.bgzip.stdin
+        else:
+            self.out = open(path, 'w')
+        self.out.write(header + '\t'.join(sample_names) + '\n')
+
+    def write(self, lines):
+        self.out.writelines(lines)
+
+    def close(self):
+        self.out.close()
+        if self.bgzip is not None:
+            if self.bgzip.wait():
+                print('Error: bgzip failed writing %s' % self.path)
+                exit(1)
+            try:
+                subprocess.check_call(['tabix', '-f', '-p', 'vcf', self.path])
+            except (OSError, subprocess.CalledProcessError):
+                print('Error: could not index %s with tabix' % self.path)
+                exit(1)
 
-    return all_calls, edges
-
-
-# cluster sorted lists of all svs
-def cluster(all_calls, edges, thresh):
-    print 'clustering:'
-    for chrom in all_calls:
-        for svtype in all_calls[chrom]:
-            print('\t%s, %s\t' % (chrom, svtype))
-            progress = Cluster.get_progress()
-            while True:
-                print 'len clusters: %d, progress: %s' % (len(all_calls[chrom][svtype]), str(progress))
-                for sv in all_calls[chrom][svtype]:
-                    if sv not in edges.dict[chrom][svtype] or len(edges.dict[chrom][svtype][sv]) == 0:
-                        continue
-                    other = edges.dict[chrom][svtype][sv][0]
-                    if other is sv:
-                        print 'Error: self reference'
-                        exit(1)
-                    if sv.jaccard(other) > thresh and (sv is edges.dict[chrom][svtype][other][0] or sv.jaccard(other) >
-                                                       other.jaccard(edges.dict[chrom][svtype][other][0]) - 1e6):
-                        new = Cluster.cluster_pair(sv, other)
-                        edges.update(chrom, svtype, sv, other, new)
-                        all_calls[chrom][svtype].remove(other)
-                        all_calls[chrom][svtype].remove(sv)
-                        all_calls[chrom][svtype].append(new)
-                if progress == Cluster.get_progress():
-                    break
-                else:
-                    progress = Cluster.get_progress()
-    return all_calls
-
-
-# print out vcf entries
-def print_vcf(samples, clustered, out_vcf, header):
-    sample_names = []
-    default_gts = []
-    for s in samples:
-        sample_names.append(s.name)
-        default_gts.append('0/0')
-    out_vcf.write(header + '\t'.join(sample_names) + '\n')
-    for chrom in sorted(clustered.keys()):
-        merged_types = []
-        for svtype in clustered[chrom]:
-            merged_types.extend(clustered[chrom][svtype])
-        merged_types.sort(key=lambda x: x.start)
-        for sv in merged_types:
-            gts = copy.copy(default_gts)
-            if isinstance(sv, Cluster):
-                for call in sv.members:
-                    gts[sample_names.index(call.sample_name)] = call.genotype()
-            else:
-                gts[sample_names.index(sv.sample_name)] = sv.genotype()
-            out_vcf.write(sv.to_vcf() + '\t' + '\t'.join(gts) + '\n')
 
 # data structure to store sv calls originating from a given sample
+# calls are spilled to a file grouped by chromosome and read back one chromosome at a time
 class Sample:
     def __init__(self, name):
         self.name = name
-        # dict[chrom] of dict[svtype] of dict[bin] of lists of svs
-        self.calls = {}
-
-    def parse_calls(self, CNVnator_file, chroms, f1=1e-6, f2=1e-6, f3=1e-6, f4=1e-6 ):
-        for line in file(CNVnator_file):
+        # spill file and dict[chrom] of (offset, size) of its calls in the spill file
+        self.spill = None
+        self.index = {}
+        # dict[chrom] of the set of svtypes called on it
+        self.svtypes = {}
+
+    def parse_calls(self, CNVnator_file, chroms, spill, f1=1e-6, f2=1e-6, f3=1e-6, f4=1e-6):
+        # dict[chrom] of lists of spill lines
+        calls = {}
+        for line in open(CNVnator_file):
             (svtype, coor, length, read_depth, e1, e2, e3, e4) = line.split()[0:8]
             if float(e1) > f1 and float(e2) > f2 and float(e3) > f3 and float(e4) > f4:
                 continue
             (chrom, start, end) =  re.split('[:-]', coor)
             if chroms and chrom not in chroms:
                 continue
-            sv = SV(chrom, start, end, re.sub('deletion', 'DEL', re.sub('duplication', 'DUP', svtype)), rd=float(read_depth))
-            self.add_call(sv)
-
-    def add_call(self, call):
-        if call.chrom not in self.calls:
-            self.calls[call.chrom] = {}
-        if call.svtype not in self.calls[call.chrom]:
-            self.calls[call.chrom][call.svtype] = {}
-        bin = int(math.log((call.end - call.start), 2))
-        if bin not in self.calls[call.chrom][call.svtype]:
-            self.calls[call.chrom][call.svtype][bin] = []
-        call.sample_name = self.name
-        self.calls[call.chrom][call.svtype][bin].append(call)
+            if chrom not in calls:
+                calls[chrom] = []
+            svtype = re.sub('deletion', 'DEL', re.sub('duplication', 'DUP', svtype))
+            self.svtypes.setdefault(chrom, set()).add(svtype)
+            calls[chrom].append('\t'.join([start, end, svtype, read_depth]) + '\n')
+        self.spill = spill
+        out = open(spill, 'wb')
+        offset = 0
+        for chrom in sorted(calls.keys()):
+            block = ''.join(calls[chrom]).encode('utf-8')
+            out.write(block)
+            self.index[chrom] = (offset, len(block))
+            offset += len(block)
+        out.close()
+
+    # the calls of chrom
+    def read_calls(self, chrom):
+        if chrom not in self.index:
+            return []
+        offset, size = self.index[chrom]
+        f = open(self.spill, 'rb')
+        f.seek(offset)
+        block = f.read(size).decode('utf-8')
+        f.close()
+        calls = []
+        for line in block.splitlines():
+            start, end, svtype, rd = line.split('\t')
+            calls.append(SV(chrom, start, end, svtype, rd=rd))
+            calls[-1].sample_name = self.name
+        return calls
+
 
 # data structure to store details of a structural variant call
 class SV:
-    def __init__(self, chrom, start, end, svtype, rd):
+    def __init__(self, chrom, start, end, svtype, rd=None):
         self.chrom = chrom
         self.start = int(start)
         self.end = int(end)
         self.svtype = svtype
         self.sample_name = None
-        self.rd = float(rd)
+        if rd is not None:
+            rd = float(rd)
+        self.rd = rd
 
     def jaccard(self, other):
         if not self.chrom == other.chrom:
@@ -287,36 +324,65 @@ class SV:
         else:
             return '0/1'
 
+    # allele counts of calls as by genotype, for arrays of svtypes and read depths (nan if not known)
+    @staticmethod
+    def genotypes(svtypes, rds):
+        counts = np.ones(len(svtypes), dtype=np.int8)
+        with np.errstate(invalid='ignore'):
+            counts[(svtypes == 'DEL') & (rds < 0.25)] = 2
+            counts[(svtypes == 'DUP') & (rds > 1.8)] = 2
+        return counts
+
     def overlaps(self, other):
         return not (other.end < self.start or other.start > self.end)
 
-    def to_vcf(self):
-        return '\t'.join([self.chrom, str(self.start), '.', '.', '<'+self.svtype+'>', '.', '.', 'IMPRECISE;SVTYPE=%s;END=%d' % (self.svtype, self.end), 'GT'])
+    def to_vcf(self, af=None):
+        info = 'IMPRECISE;SVTYPE=%s;END=%d' % (self.svtype, self.end)
+        if af is not None:
+            info += ';AF=%.4f' % af
+        return '\t'.join([self.chrom, str(self.start), '.', '.', '<'+self.svtype+'>', '.', '.', info, 'GT'])
 
 
 # data structure to store result of merging similar structural variant calls
+# the cluster spans the mean start and end of its members
 class Cluster(SV):
+    # counts of clusters created, calls added to clusters and clusters merged
+    clusters = 0
+    additions = 0
+    merges = 0
+
     def __init__(self, r1, r2):
-        SV.__init__(self, r1.chrom, (r1.start + r2.start) / 2, (r1.end + r2.end) / 2, r1.svtype)
+        SV.__init__(self, r1.chrom, (r1.start + r2.start) // 2, (r1.end + r2.end) // 2, r1.svtype)
         self.members = [r1, r2]
+        self.start_sum = r1.start + r2.start
+        self.end_sum = r1.end + r2.end
 
     def update(self):
-        start_sum = 0
-        end_sum = 0
-        for mem in self.members:
-            start_sum += mem.start
-            end_sum += mem.end
-        self.start = start_sum / len(self.members)
-        self.end = end_sum / len(self.members)
+        self.start = self.start_sum // len(self.members)
+        self.end = self.end_sum // len(self.members)
 
     def add_to_cluster(self, region):
         self.members.append(region)
+        self.start_sum += region.start
+        self.end_sum += region.end
         self.update()
 
     def merge_clusters(self, other):
         self.members.extend(other.members)
+        self.start_sum += other.start_sum
+        self.end_sum += other.end_sum
         self.update()
 
+    @staticmethod
+    def get_progress():
+        return Cluster.clusters, Cluster.additions, Cluster.merges
+
+    @staticmethod
+    def reset_progress():
+        Cluster.clusters = 0
+        Cluster.additions = 0
+        Cluster.merges = 0
+
     @staticmethod
     def cluster_pair(r1, r2):
         if isinstance(r1, Cluster):
@@ -337,61 +403,55 @@ class Cluster(SV):
                 Cluster.clusters += 1
                 return Cluster(r1, r2)
 
-# data structure to store interval graph or structural variant calls
-# used to speed up merging process
-class Edges():
-    def __init__(self):
-        self.dict = {}
-
-    def add(self, chrom, svtype, sv1, sv2):
-        if chrom not in self.dict:
-            self.dict[chrom] = {}
-        if svtype not in self.dict[chrom]:
-            self.dict[chrom][svtype] = {}
-
-        if sv1 not in self.dict[chrom][svtype]:
-            self.dict[chrom][svtype][sv1] = [sv2]
-        elif sv2 not in self.dict[chrom][svtype][sv1]:
-            self.dict[chrom][svtype][sv1].append(sv2)
-        self.dict[chrom][svtype][sv1].sort(key=sv1.jaccard, reverse=True)
-
-        if sv2 not in self.dict[chrom][svtype]:
-            self.dict[chrom][svtype][sv2] = [sv1]
-        elif sv1 not in self.dict[chrom][svtype][sv2]:
-            self.dict[chrom][svtype][sv2].append(sv1)
-        self.dict[chrom][svtype][sv2].sort(key=sv2.jaccard, reverse=True)
-
-    def update(self, chrom, svtype, sv1, sv2, new):
-        if new not in self.dict[chrom][svtype]:
-            self.dict[chrom][svtype][new] = []
-
-        for n in self.dict[chrom][svtype][sv1]:
-            if n is sv1 or n is sv2:
-                continue
-            while sv1 in self.dict[chrom][svtype][n]:
-                self.dict[chrom][svtype][n].remove(sv1)
-            self.dict[chrom][svtype][n].append(new)
-            self.dict[chrom][svtype][n].sort(key=n.jaccard, reverse=True)
-            if n not in self.dict[chrom][svtype][new] and n is not new:
-                self.dict[chrom][svtype][new].append(n)
-
-        for n in self.dict[chrom][svtype][sv2]:
-            if n is sv1 or n is sv2:
+
+# greedy clustering of the calls of one chrom and svtype, the pair with the highest jaccard index is merged first
+# candidate pairs are found from the calls sorted by start and kept in a heap by jaccard index. a merged pair is
+# replaced by a new node, heap entries of nodes that no longer exist are skipped when popped.
+# a cluster's neighbours are the neighbours of the calls and clusters merged into it, pairs are re-scored as they move
+class ClusterQueue:
+    def __init__(self, calls, thresh):
+        self.thresh = thresh
+        # nodes by id, None once merged into another node
+        self.nodes = list(calls)
+        # dict by node id of set of neighbouring node ids
+        self.neighbours = {}
+        self.heap = []
+        starts = [c.start for c in self.nodes]
+        for i, a in enumerate(self.nodes):
+            # a call starting at or after start_a can only have jaccard > thresh with a if it starts before bound
+            bound = a.end + 1 - thresh * (a.end - a.start + 1)
+            for j in range(i + 1, bisect_left(starts, bound, i + 1)):
+                self.push(i, j)
+
+    # record a pair of calls as neighbours and queue them if they are similar enough, i < j
+    def push(self, i, j):
+        jaccard = self.nodes[i].jaccard(self.nodes[j])
+        if jaccard > self.thresh:
+            self.neighbours.setdefault(i, set()).add(j)
+            self.neighbours.setdefault(j, set()).add(i)
+            heapq.heappush(self.heap, (-jaccard, i, j))
+
+    def run(self):
+        while self.heap:
+            jaccard, i, j = heapq.heappop(self.heap)
+            if self.nodes[i] is None or self.nodes[j] is None:
                 continue
-            while sv2 in self.dict[chrom][svtype][n]:
-                self.dict[chrom][svtype][n].remove(sv2)
-            self.dict[chrom][svtype][n].append(new)
-            self.dict[chrom][svtype][n].sort(key=n.jaccard, reverse=True)
-            if n not in self.dict[chrom][svtype][new] and n is not new:
-                self.dict[chrom][svtype][new].append(n)
-
-        while sv1 in self.dict[chrom][svtype][new]:
-            self.dict[chrom][svtype][new].remove(sv1)
-        while sv2 in self.dict[chrom][svtype][new]:
-            self.dict[chrom][svtype][new].remove(sv2)
-        while new in self.dict[chrom][svtype][new]:
-            self.dict[chrom][svtype][new].remove(new)
-        self.dict[chrom][svtype][new].sort(key=new.jaccard, reverse=True)
+            new = Cluster.cluster_pair(self.nodes[i], self.nodes[j])
+            self.nodes[i] = None
+            self.nodes[j] = None
+            k = len(self.nodes)
+            self.nodes.append(new)
+            self.neighbours[k] = set()
+            for n in (self.neighbours.pop(i) | self.neighbours.pop(j)) - set([i, j]):
+                self.neighbours[n].discard(i)
+                self.neighbours[n].discard(j)
+                # neighbours that drop below the threshold are kept, a later merge may bring them back
+                self.neighbours[n].add(k)
+                self.neighbours[k].add(n)
+                jaccard = self.nodes[n].jaccard(new)
+                if jaccard > self.thresh:
+                    heapq.heappush(self.heap, (-jaccard, n, k))
+        return [n for n in self.nodes if n is not None]
 
 
 if __name__ == "__main__":
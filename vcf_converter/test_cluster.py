@@ -0,0 +1,93 @@
+# # -*- coding: utf-8 -*-
+# """
+# author: Jacob Munro, Victor Chang Cardiac Research Institute
+# """
+# ClusterQueue against a brute force greedy clustering: while any two neighbouring nodes have a jaccard index above the
+# threshold, merge the pair with the highest, the lowest node ids first on ties. merged nodes are new nodes at the end of
+# the list and span the mean start and end of their calls
+# as in the original edge lists, calls are neighbours if their jaccard index is above the threshold and merged nodes
+# take the neighbours of both nodes merged
+# run from the SVPV directory with: python -m unittest vcf_converter.test_cluster
+from __future__ import division
+import random
+import unittest
+from vcf_converter.cnvnator_to_vcf import SV, Cluster, ClusterQueue
+
+
+def jaccard(a, b):
+    return float(min(a[1], b[1]) - max(a[0], b[0]) + 1) / float(max(a[1], b[1]) - min(a[0], b[0]) + 1)
+
+
+def span(calls):
+    return sum(c[0] for c in calls) // len(calls), sum(c[1] for c in calls) // len(calls)
+
+
+# (start, end, ids of the calls) of each node left by greedy merging of calls, a list of (start, end, id)
+def reference(calls, thresh):
+    nodes = [[c] for c in calls]
+    edges = set((i, j) for i in range(len(calls)) for j in range(i + 1, len(calls))
+                if jaccard(calls[i], calls[j]) > thresh)
+    while True:
+        best = None
+        for i in range(len(nodes)):
+            if nodes[i] is None:
+                continue
+            for j in range(i + 1, len(nodes)):
+                if nodes[j] is None or (i, j) not in edges:
+                    continue
+                score = jaccard(span(nodes[i]), span(nodes[j]))
+                if score > thresh and (best is None or score > best[0]):
+                    best = (score, i, j)
+        if best is None:
+            break
+        score, i, j = best
+        k = len(nodes)
+        for n in range(k):
+            if n not in (i, j) and nodes[n] is not None and \
+                    set([(n, i), (i, n), (n, j), (j, n)]) & edges:
+                edges.add((n, k))
+        nodes.append(nodes[i] + nodes[j])
+        nodes[i] = None
+        nodes[j] = None
+    return sorted(span(n) + (tuple(sorted(c[2] for c in n)),) for n in nodes if n is not None)
+
+
+def queue(calls, thresh):
+    svs = []
+    for start, end, i in calls:
+        svs.append(SV('1', start, end, 'DEL'))
+        svs[-1].sample_name = i
+    result = []
+    for node in ClusterQueue(svs, thresh).run():
+        members = node.members if isinstance(node, Cluster) else [node]
+        result.append((node.start, node.end, tuple(sorted(m.sample_name for m in members))))
+    return sorted(result)
+
+
+# calls sorted by start and end as they are clustered, starts are drawn from few positions so that many are identical
+def random_calls(rand, num):
+    calls = []
+    for i in range(num):
+        start = rand.choice(range(1000, 20000, 250))
+        calls.append((start, start + rand.randint(200, 3000)))
+    calls.sort()
+    return [(s, e, i) for i, (s, e) in enumerate(calls)]
+
+
+class TestClusterQueue(unittest.TestCase):
+    def test_random(self):
+        rand = random.Random(0)
+        for thresh in (0.5, 0.5001, 0.55, 0.7, 0.9):
+            for trial in range(40):
+                calls = random_calls(rand, rand.randint(2, 40))
+                self.assertEqual(queue(calls, thresh), reference(calls, thresh),
+                                 'thresh {} trial {}: {}'.format(thresh, trial, calls))
+
+    def test_identical(self):
+        calls = [(1000, 2000, i) for i in range(5)] + [(1000, 2100, 5), (1500, 2000, 6)]
+        for thresh in (0.5, 0.7, 0.95):
+            self.assertEqual(queue(calls, thresh), reference(calls, thresh))
+
+
+if __name__ == '__main__':
+    unittest.main()